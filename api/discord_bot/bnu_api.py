@@ -12,39 +12,154 @@ from io import BytesIO
 from discord import app_commands
 from api.kavita_query.kavita_config import *
 from api.discord_bot.bot_config import *
-from api.kavita_query.kavitaqueries import KavitaQueries
-from api.kavita_query.kavitaactions import KavitaActions
 from assets.message_templates.server_status_template import server_status_template
-from utilities.series_embed import EmbedBuilder
 from utilities.job_scheduler import ScheduledJobs
+from utilities.admission_control import AdmissionControl
+from utilities.guild_config import GuildDirectory
+from utilities.app_context import AppContext
+from utilities.series_embed import embed_from_payload
+from utilities.attachment_registry import asset_file, send_embeds, respond_embeds
+from utilities.send_scheduler import shared_send_scheduler, priority_reaction
+from utilities.kavita_events import KavitaEventHandler, kavita_events_enabled
+from utilities.search_pages import SearchResultsView
+from utilities.outbox import Outbox, OutboxSender
+from utilities.notification_digest import notification_modes
+from utilities.profiler import ProfileSession, max_profile_seconds
+from utilities.loop_watchdog import LoopWatchdog
+from utilities.invite_pipeline import InvitePipeline
+from api.kavita_query.kavita_hub import KavitaHubClient
+from api.kavita_query.kavita_federation import subscription_id
 from utilities.notification_subscriptions import *
 
 # Setup logging
 logger = logging_config.setup_logging()
 
 
-class bnuAPI(discord.Client):
+# Run as an auto sharded client when BNU_SHARDED is set, so one bot can serve many guilds.
+# BNU_SHARD_COUNT and BNU_SHARD_IDS (comma separated) split the shards across several processes
+sharded_mode = os.environ.get('BNU_SHARDED', '').lower() in ('1', 'true', 'yes')
+ClientBase = discord.AutoShardedClient if sharded_mode else discord.Client
+
+
+def shard_options():
+    options = {}
+    if not sharded_mode:
+        return options
+    if os.environ.get('BNU_SHARD_COUNT'):
+        options['shard_count'] = int(os.environ['BNU_SHARD_COUNT'])
+    if os.environ.get('BNU_SHARD_IDS'):
+        options['shard_ids'] = [int(shard_id) for shard_id in os.environ['BNU_SHARD_IDS'].split(',')]
+    return options
+
+
+# Users allowed to run the owner only debug commands (comma separated ids), besides the application's owner(s)
+owner_ids = {int(user_id) for user_id in os.environ.get('BNU_OWNER_IDS', '').split(',') if user_id.strip()}
+
+
+class BotCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction):
+        # A /debug-profile waiting on a command starts sampling when that command comes in
+        session = self.client.profile_session
+        if session and interaction.command:
+            session.command_started(interaction.command.qualified_name)
+        # Noted so a stall while it runs can be put down to it
+        self.client.loop_watchdog.command_started(interaction)
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        self.client.loop_watchdog.command_finished(interaction)
+        await super().on_error(interaction, error)
+
+
+class bnuAPI(ClientBase):
     def __init__(self):
-        super().__init__(intents=discord.Intents.default())
-        self.tree = app_commands.CommandTree(self)
-        self.kavita_queries = KavitaQueries()
-        self.kavita_actions = KavitaActions()
-        self.kavita_queries.authenticate()
-        self.kavita_actions.authenticate()
+        # The send scheduler watches every request the client makes, for Discord's rate limit headers
+        super().__init__(intents=discord.Intents.default(), http_trace=shared_send_scheduler().trace_config(),
+                         **shard_options())
+        self.tree = BotCommandTree(self)
+        # The running /debug-profile, if any
+        self.profile_session = None
+        # Measures event loop lag and catches what's blocking it
+        self.loop_watchdog = LoopWatchdog()
+        # Per guild channels, jobs and Kavita server, defaults to the single bot_config guild
+        self.guild_configs = GuildDirectory(guild_id)
+        # The Kavita clients (one login and cache per server, over one connection pool), their federation and the
+        # render workers, shared by commands, jobs and cogs
+        self.context = AppContext(self.guild_configs)
+        self.context.authenticate()
+        self.kavita_servers = self.context.kavita_servers
+        self.federation = self.context.federation
+        self.render_workers = self.context.render_workers
+        # The default server's clients, used wherever there's no guild to route by
+        self.kavita_queries = self.context.default.queries
+        self.kavita_actions = self.context.default.actions
         self.scheduled_jobs = ScheduledJobs(self)
+        # Rate limits and a shared queue for the commands that hit Kavita the hardest
+        self.admission_control = AdmissionControl()
+        # /invite-me requests, validated and sent off the event loop
+        self.invite_pipeline = InvitePipeline(self.admission_control)
+        # Kavita event hub connections, with their tasks, and the event handler of each Kavita server
+        self.event_listeners = []
+        self.event_handlers = {}
+        # Scheduled broadcasts and DMs are queued here and delivered in the background, across restarts
+        self.outbox_sender = OutboxSender(self, Outbox())
+        self.outbox_task = None
+
+    def kavita_for(self, guild_id):
+        return self.context.kavita_for(guild_id)
+
+    def federation_for(self, guild_id):
+        return self.context.federation_for(guild_id)
+
+    async def is_owner(self, user):
+        if user.id in owner_ids:
+            return True
+        application = await self.application_info()
+        if application.team:
+            return user.id in {member.id for member in application.team.members}
+        return application.owner and user.id == application.owner.id
+
+    async def on_app_command_completion(self, interaction, command):
+        self.loop_watchdog.command_finished(interaction)
+        if self.profile_session:
+            self.profile_session.command_completed(command.qualified_name)
+
+    def owns_guild(self, guild_id):
+        # A shard only sees the guilds it is connected to, jobs for other guilds belong to another shard
+        return self.get_guild(int(guild_id)) is not None
 
     async def setup_hook(self):
-        # Create a discord.Object for the guild using the guild ID
-        guild = discord.Object(id=int(guild_id))
-
+        # Fork the render and cover workers before the scheduler and fetch threads start
+        self.context.start_workers()
+        self.loop_watchdog.start()
+        # Follow each Kavita server's event hub for near real-time updates
+        if kavita_events_enabled:
+            for server in self.kavita_servers.values():
+                self.start_event_listener(server)
+        self.outbox_task = asyncio.create_task(self.outbox_sender.run())
+        self.invite_pipeline.start()
         try:
             # Sync the command tree
             await self.tree.sync()
-            self.tree.copy_global_to(guild=guild)
-            logger.info(f"Successfully synced commands to {guild_id}...")
+            # Copy the commands to every configured guild so they show up there right away
+            for settings in self.guild_configs:
+                self.tree.copy_global_to(guild=discord.Object(id=settings.guild_id))
+                logger.info(f"Successfully synced commands to {settings.guild_id}...")
         except discord.HTTPException as e:
             logger.info(f"Failed to sync commands: {e}")
 
+    def start_event_listener(self, server):
+        handler = KavitaEventHandler(self, server)
+        self.event_handlers[server.name] = handler
+        listener = KavitaHubClient(server.queries.kAPI, handler.handlers(), name=server.name)
+        self.event_listeners.append((listener, asyncio.create_task(self.run_event_listener(handler, listener))))
+
+    @staticmethod
+    async def run_event_listener(handler, listener):
+        # Note the current chapters of subscribed series first, so the first update can be diffed
+        await asyncio.to_thread(handler.warm_up)
+        await listener.run()
+
     async def on_ready(self):
         # Set the bots' status to "Listening to '/'"
         activity = discord.Activity(type=discord.ActivityType.listening, name="/")
@@ -77,13 +192,22 @@ class bnuAPI(discord.Client):
     async def close(self):
         logger.info("Shutting down...")
         self.scheduled_jobs.stop_scheduler()  # Stop the scheduler when closing
+        for listener, task in self.event_listeners:
+            listener.close()
+            task.cancel()
+        if self.profile_session:
+            self.profile_session.finish()
+        self.loop_watchdog.stop()
+        self.invite_pipeline.stop()
+        if self.outbox_task:
+            self.outbox_task.cancel()
+            self.outbox_sender.close()
+        self.context.shutdown()
         await super().close()
 
 
 intents = discord.Intents.default()
 bot = bnuAPI()
-# Source the series embed function
-embed_builder = EmbedBuilder(server_address=kavita_base_url, kavita_queries=bot.kavita_queries)
 # Create a dictionary for holding reaction message IDs
 bot.reaction_messages = {}
 
@@ -99,32 +223,40 @@ async def on_reaction_add(reaction, user):
     if reaction.message.id in bot.reaction_messages:
         emoji_manga_list = bot.reaction_messages[reaction.message.id]
 
+        # Use the Kavita server of the guild the message is in
+        guild_id = reaction.message.guild.id if reaction.message.guild else None
+        kavita = bot.kavita_for(guild_id)
+        federation = bot.federation_for(guild_id)
+
         # Find the corresponding manga for the reacted emoji
         for emoji_symbol, manga_title in emoji_manga_list.items():
             if reaction.emoji == emoji_symbol:
-                series_id = bot.kavita_queries.get_id_from_name(manga_title)
+                if federation:
+                    # A federated listing mixes servers, look the title up on all of them
+                    found, series_id = await asyncio.to_thread(federation.find_series, manga_title)
+                    kavita = found or kavita
+                else:
+                    series_id = await asyncio.to_thread(kavita.queries.get_id_from_name, manga_title)
 
                 logger.info(
                     f"User {user} requests series info for {manga_title}, series ID {series_id}, "
                     f"querying Kavita server and responding...")
                 if series_id:
-                    # Gather metadata
-                    metadata = bot.kavita_queries.get_series_metadata(series_id)
-                    series = bot.kavita_queries.get_series_info(series_id)
-                    series_name = bot.kavita_queries.get_name_from_id(series_id)
-                    series_embed, file = embed_builder.build_series_embed(series=series, metadata=metadata,
-                                                                          thumbnail=False)
-
-                    await reaction.message.channel.send(embed=series_embed, file=file if file else None)
-                    embed_builder.cleanup_temp_cover(file.fp.name) if file else None
-
-                    recent_chapters = bot.kavita_queries.get_recent_chapters(series_id)
-                    chapter_embeds = bot.kavita_queries.send_recent_chapters_embed(manga_title=series_name,
-                                                                                   recent_chapters=recent_chapters)
-
-                    for chapter_embed, file in chapter_embeds:
-                        await reaction.message.channel.send(embed=chapter_embed, file=file if file else None)
-                        embed_builder.cleanup_temp_cover(file.fp.name) if file else None
+                    # Fetch and render the series and its recent chapters off the gateway
+                    rendered, _ = await bot.render_workers.render(kavita, 'series-with-chapters', series_id)
+                    if not rendered:
+                        await reaction.message.channel.send(f"Unable to pull info for {manga_title} from the "
+                                                            f"Kavita server.")
+                        break
+                    series_payload, chapter_payloads = rendered
+                    series_embed, file = embed_from_payload(series_payload)
+
+                    await send_embeds(reaction.message.channel.send, [series_embed], [file], priority=priority_reaction)
+
+                    for chapter_payload in chapter_payloads:
+                        chapter_embed, file = embed_from_payload(chapter_payload)
+                        await send_embeds(reaction.message.channel.send, [chapter_embed], [file],
+                                          priority=priority_reaction)
                 else:
                     await reaction.message.channel.send(f"Invalid series ID {series_id}.")
                 break
@@ -160,23 +292,35 @@ async def bot_info(interaction: discord.Interaction):
 
 @bot.tree.command(name='server-stats', description="List server stats and popular series")
 async def server_stats(interaction: discord.Interaction):
-    # Acknowledge the interaction to prevent it from timing out, so we can gather data to respond with
-    await interaction.response.defer()
-    logger.info(f"User {interaction.user} requests mangastats, querying Kavita server and responding...")
-
-    # Get the server stats from function
-    stats_message, embeds = bot.kavita_queries.generate_server_stats(interaction=interaction)
-
-    if stats_message and embeds:
-        # Send the message to the channel
-        await interaction.followup.send(stats_message)
-
-        # Send all the embeds in one message
-        for embed, file in embeds:
-            await interaction.followup.send(embed=embed, file=file if file else None)
-            embed_builder.cleanup_temp_cover(file.fp.name) if file else None
-    else:
-        await interaction.followup.send("No server stats available.", ephemeral=True)
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
+    # Deferred by admission control once a slot is free, so we can gather data to respond with
+    async with bot.admission_control.slot(interaction, 'server-stats') as admitted:
+        if not admitted:
+            return
+        logger.info(f"User {interaction.user} requests mangastats, querying Kavita server and responding...")
+
+        federation = bot.federation_for(interaction.guild_id)
+        if federation:
+            # Every server's snapshot, combined
+            stats_message, embeds = await asyncio.to_thread(federation.stats_messages, interaction)
+        else:
+            # Build the snapshot off the event loop if the background job hasn't produced one yet
+            if not kavita.stats_snapshot.is_ready():
+                await asyncio.to_thread(kavita.stats_snapshot.refresh)
+            # Answer straight from the pre-rendered snapshot
+            stats_message, embeds = kavita.stats_snapshot.messages(interaction=interaction)
+
+        if stats_message and embeds:
+            # Send the message to the channel
+            await interaction.followup.send(stats_message)
+
+            # Send all the embeds in one message
+            for embed, file in embeds:
+                await send_embeds(interaction.followup.send, [embed], [file], wait=True)
+            await send_stale_notice(interaction)
+        else:
+            await interaction.followup.send("No server stats available.", ephemeral=True)
 
 
 # Return series info when given a series ID
@@ -185,60 +329,61 @@ async def server_stats(interaction: discord.Interaction):
                        series_id="Enter the series ID (optional")
 async def series_info(interaction: discord.Interaction, series_name: str = None, series_id: int = None,
                       verbose: bool = False):
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
     await interaction.response.defer()
     logger.info(f"User {interaction.user} requests series info for {series_name if series_name else series_id}, "
              f"querying Kavita server and responding...")
 
     # Find the series ID if only the series_name was given
     if series_name and not series_id:
-        # Send the safe query to the Kavita API
-        search_results = bot.kavita_queries.search_server(series_name)
+        # Send the safe query to the Kavita API (every server's, for federated guilds)
+        kavita, top_result = await find_top_result(interaction, kavita, series_name)
 
-        series_id = search_results['series'][0]['seriesId']
+        series_id = top_result['seriesId'] if top_result else None
     if series_id:
-        # Gather metadata
-        metadata = bot.kavita_queries.get_series_metadata(series_id)
-        series = bot.kavita_queries.get_series_info(series_id=series_id, verbose=verbose)
-        series_embed, file = embed_builder.build_series_embed(series=series, metadata=metadata, thumbnail=False)
+        # Fetch and render the series off the gateway
+        series_payload, notice = await bot.render_workers.render(kavita, 'series', series_id, False, verbose)
+        if series_payload:
+            series_embed, file = embed_from_payload(series_payload)
 
-        await interaction.followup.send(embed=series_embed, file=file if file else None)
-        embed_builder.cleanup_temp_cover(file.fp.name) if file else None
+            await send_embeds(interaction.followup.send, [series_embed], [file], wait=True)
+            await send_stale_notice(interaction, notice)
+        else:
+            await interaction.followup.send(f"Unable to pull info for series ID {series_id} from the Kavita server.",
+                                            ephemeral=True)
     else:
-        await interaction.followup.send_message(f"Invalid series ID {series_id}.", ephemeral=True)
+        await interaction.followup.send(f"Invalid series ID {series_id}.", ephemeral=True)
 
 
 @bot.tree.command(name='series-cover', description="Find the series cover and display it")
 async def series_cover(interaction: discord.Interaction, series_name: str, series_id: int = None):
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
     await interaction.response.defer()
     logger.info(f"User {interaction.user} requests series cover for series {series_id}, "
              f"querying Kavita server and responding...")
 
     cover_image_stream = None  # Initialize to None to check later
-    cover_image_path = None  # To track the file path for cleanup
 
     # Find the series ID if only the series_name was given
     if series_name and not series_id:
-        # Send the safe query to the Kavita API
-        search_results = bot.kavita_queries.search_server(series_name)
+        # Send the safe query to the Kavita API (every server's, for federated guilds)
+        kavita, top_result = await find_top_result(interaction, kavita, series_name)
 
-        series_id = search_results['series'][0]['seriesId']
+        series_id = top_result['seriesId'] if top_result else None
     if series_id:
         try:
             # Fetch series cover data from Kavita server
-            series_cover_data = bot.kavita_queries.get_series_cover(series_id)
+            series_cover_data = await asyncio.to_thread(kavita.queries.get_series_cover, series_id)
 
             if series_cover_data:
-                # Create a file-like object from the image data
+                # Create a file-like object from the image data, no need to touch the disk
                 cover_image_stream = BytesIO(series_cover_data)
-                cover_image_stream.name = f"series_cover_{series_id}.jpg"
-
-                # Save the image to a temporary file so we don't spam the script root directory with pngs
-                cover_image_path = cover_image_stream.name
-                with open(cover_image_path, 'wb') as f:
-                    f.write(series_cover_data)
+                cover_image_name = f"series_cover_{series_id}.jpg"
 
                 # Send the image as a file in response
-                await interaction.followup.send(file=discord.File(cover_image_stream, filename=cover_image_stream.name))
+                await interaction.followup.send(file=discord.File(cover_image_stream, filename=cover_image_name))
             else:
                 # If no cover data found, inform the user
                 await interaction.followup.send(f"No cover image found for series ID {series_id}.")
@@ -247,11 +392,6 @@ async def series_cover(interaction: discord.Interaction, series_name: str, serie
             logger.error(f"Error fetching cover for series {series_id}: {e}")
             await interaction.followup.send(f"An error occurred: {str(e)}", ephemeral=True)
         finally:
-            # Cleanup: Remove the temporary file if it was created
-            if cover_image_path and os.path.exists(cover_image_path):
-                os.remove(cover_image_path)
-                logger.info(f"Removed temporary file: {cover_image_path}")
-
             # Ensure the BytesIO stream is properly closed to prevent memory leaks
             if cover_image_stream:
                 cover_image_stream.close()
@@ -265,18 +405,20 @@ async def series_cover(interaction: discord.Interaction, series_name: str, serie
 @bot.tree.command(name='next-update', description="Get the next expected chapter update for the given series. "
                                                   "Not yet working due to limited data...")
 async def next_update(interaction: discord.Interaction, series_name: str, series_id: int = None):
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
     logger.info(f"User {interaction.user} requests next chapter update for series {series_id}, "
              f"querying Kavita server and responding....")
 
     # Find the series ID if only the series_name was given
     if series_name and not series_id:
-        # Send the safe query to the Kavita API
-        search_results = bot.kavita_queries.search_server(series_name)
+        # Send the safe query to the Kavita API (every server's, for federated guilds)
+        kavita, top_result = await find_top_result(interaction, kavita, series_name)
 
-        series_id = search_results['series'][0]['seriesId']
+        series_id = top_result['seriesId'] if top_result else None
     if series_id:
         # Query the server for the next series update
-        update = bot.kavita_queries.get_series_next_update(series_id)
+        update = await asyncio.to_thread(kavita.queries.get_series_next_update, series_id)
 
         if update and update['expectedDate'] is not None:
             # Gather the expected date
@@ -308,165 +450,192 @@ async def next_update(interaction: discord.Interaction, series_name: str, series
             await interaction.response.send_message(f"No current chapter update info is known for {series_id}, "
                                                     f"this may indicate that not enough chapter updates have "
                                                     f"been gathered to predict the next one.", ephemeral=True)
+    else:
+        await interaction.response.send_message(f"Unable to locate series `{series_name}`.", ephemeral=True)
 
 
-@bot.tree.command(name='manga-search')
+@bot.tree.command(name='manga-search', description="Search for a manga and page through the results")
 @app_commands.describe(search_query="Search for a manga by search term")
 async def manga_search(interaction: discord.Interaction, *, search_query: str):
-    await interaction.response.defer()
-    logger.info(f"User {interaction.user} searched for {search_query}, querying Kavita server and responding...")
-
-    # Send the safe query to the Kavita API
-    search_results = bot.kavita_queries.search_server(search_query)
-
-    # We may have multiple results, so we need an embed list object
-    embeds = []
-
-    if search_results['series']:
-        # Limit the results to the first 3 and build the embeds
-        for series in search_results['series'][:3]:
-            series_id = series['seriesId']
-            # Build variables and a clickable url to the server page for the series
-            metadata = bot.kavita_queries.get_series_metadata(series_id)
-            # Gather series metadata
-            embed_result = embed_builder.build_series_embed(series, metadata, thumbnail=True)
-            embeds.append(embed_result)
-
-        # Send all the embeds in one message
-        for embed, file in embeds:
-            await interaction.followup.send(embed=embed, file=file if file else None)
-    else:
-        await interaction.followup.send(f"No search results found for `{search_query}`", ephemeral=True)
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
+    # Wait for a free slot, admission control defers the interaction for us
+    async with bot.admission_control.slot(interaction, 'manga-search') as admitted:
+        if not admitted:
+            return
+        logger.info(f"User {interaction.user} searched for {search_query}, querying Kavita server and responding...")
+
+        federation = bot.federation_for(interaction.guild_id)
+        if federation:
+            # Every server at once, merged and ranked, each result tagged with the server it came from
+            search_results = {'series': await asyncio.to_thread(federation.search, search_query)}
+        else:
+            # Send the safe query to the Kavita API, the result list is cached per query
+            search_results = await asyncio.to_thread(kavita.queries.search_server, search_query)
+
+        if search_results and search_results.get('series'):
+            # Only the first page is rendered now, the rest as the user pages through them
+            view = SearchResultsView(bot.render_workers, kavita, interaction.user.id, search_query,
+                                     search_results['series'], federation=federation)
+            embeds, files, notice = await view.page_contents(0)
+            if embeds:
+                view.message = await send_embeds(interaction.followup.send, embeds, files, view=view, wait=True,
+                                                 remember=False)
+                await send_stale_notice(interaction, notice)
+            else:
+                await interaction.followup.send(f"Unable to pull info for the results of `{search_query}` from the "
+                                                f"Kavita server.", ephemeral=True)
+        else:
+            await interaction.followup.send(f"No search results found for `{search_query}`", ephemeral=True)
 
 
 @bot.tree.command(name='recently-updated', description="See recently updated series info")
 async def recently_updated(interaction: discord.Interaction):
-    # Defer the interaction so we can do background logic
-    await interaction.response.defer()
-    logger.info(f"User {interaction.user} requests recently updated series list, querying server...")
-    updated_series = bot.kavita_queries.get_recently_updated()
-    if updated_series:
-        logger.info(f"Generating emoji map...")
-        # Build a list of the manga titles
-        series_names = [series['seriesName'] for series in updated_series if 'seriesName' in series]
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
+    # Wait for a free slot, admission control defers the interaction so we can do background logic
+    async with bot.admission_control.slot(interaction, 'recently-updated') as admitted:
+        if not admitted:
+            return
+        logger.info(f"User {interaction.user} requests recently updated series list, querying server...")
+        federation = bot.federation_for(interaction.guild_id)
+        if federation:
+            # Every server's listing, newest first
+            updated_series = await asyncio.to_thread(federation.recently_updated)
+        else:
+            updated_series = await asyncio.to_thread(kavita.queries.get_recently_updated)
+            # A changed listing means the library changed, so the stats snapshot is out of date
+            kavita.stats_snapshot.note_recently_updated(updated_series)
+        if updated_series:
+            logger.info(f"Generating emoji map...")
+            # Build a list of the manga titles
+            series_names = [series['seriesName'] for series in updated_series if 'seriesName' in series]
+
+            # Generate the emoji mapping using the correct list
+            emoji_manga_list = map_emojis(manga_titles=series_names)  # Use the list of series names
+
+            # Create an embed for the response, with one mosaic of the covers instead of an upload per series
+            if federation:
+                embed, files = await asyncio.to_thread(federation.build_recently_updated_embed, emoji_manga_list,
+                                                       updated_series)
+            else:
+                series_ids_by_name = {series['seriesName']: series['seriesId'] for series in updated_series
+                                      if 'seriesName' in series}
+                embed, files = await asyncio.to_thread(kavita.embed_builder.build_recently_updated_embed,
+                                                       emoji_manga_list, series_ids_by_name)
 
-        # Generate the emoji mapping using the correct list
-        emoji_manga_list = map_emojis(manga_titles=series_names)  # Use the list of series names
+            # Send the embed message to the channel
+            message = await send_embeds(interaction.followup.send, [embed], files, wait=True)
 
-        # Create an embed for the response
-        embed = discord.Embed(
-            title="Recently Updated Series",
-            description="React to see series update info:\n\n" + "\n".join(
-                f"{emoji_symbol}: {manga}" for emoji_symbol, manga in emoji_manga_list.items()
-            ),
-            color=0x4ac694  # You can change the color to match your theme
-        )
-        # Path to thumbnail
-        thumb_img_path = 'assets/images/server_icon.png'
-        # Use discord.File with the file path directly
-        file = discord.File(thumb_img_path, filename='thumbnail.jpg')
-        embed.set_thumbnail(url="attachment://thumbnail.jpg")
-        embed.set_footer(text=f"\nUse the emoji reacts below to get more info for the selected series:")
-
-        # Send the embed message to the channel
-        message = await interaction.followup.send(embed=embed, file=file if file else None)
-
-        # Preload the interactions on the message
-        for emoji_symbol in emoji_manga_list.keys():  # Use keys() to get the emoji symbols
-            await asyncio.sleep(0.15)
-            await message.add_reaction(emoji_symbol)
-
-        # Store the message ID and emoji-manga mapping for this interaction
-        bot.reaction_messages[message.id] = emoji_manga_list
-    else:
-        logger.error(f"Unable to pull recently updated series from Kavita server.")
-        await interaction.followup.send("Unable to pull recently updated series from Kavita server.", ephemeral=True)
+            # Preload the interactions on the message, after any other user's replies
+            await shared_send_scheduler().add_reactions(priority_reaction, message, emoji_manga_list.keys())
+
+            # Store the message ID and emoji-manga mapping for this interaction
+            bot.reaction_messages[message.id] = emoji_manga_list
+            await send_stale_notice(interaction)
+        else:
+            logger.error(f"Unable to pull recently updated series from Kavita server.")
+            await interaction.followup.send("Unable to pull recently updated series from Kavita server.",
+                                            ephemeral=True)
 
 
 @bot.tree.command(name='invite-me', description="Get an invite to the server!")
 @app_commands.describe(email="address@mail.com")
 async def invite_me(interaction: discord.Interaction, email: str):
-    # Prep actions before we respond
-    await interaction.response.defer()
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
+    if not await bot.admission_control.admit_rate(interaction, 'invite-me'):
+        return
     logger.info(f"User {interaction.user} requests invite to BNU Kavita server with email address {email}, verifying "
                 f"email address, inviting user via email, and responding...")
-    # Generate the email invite
-    user_invite = bot.kavita_actions.new_user_invite(email)
-    if user_invite:
-        await interaction.followup.send(f"User {interaction.user.mention} invited to the BNU Manga server!")
-        # Respond so only the user can see (To keep the email used private)
-        await interaction.followup.send(f"User invite send to `{email}`, you may need to check your junk mail "
-                                        f"if it's not in your inbox, happy reading!", ephemeral=True)
-    else:
-        await interaction.followup.send(f"Unable to generate invite with provided email "
-                                        f"`{email}`, please try again...", ephemeral=True)
+    # Queued, the address is checked and the invite sent in the background and the user told how it went
+    await bot.invite_pipeline.submit(interaction, kavita, email)
 
 
 @bot.tree.command(name='server-address', description="Get a link to the BNU Kavita server!")
 async def server_address(interaction: discord.Interaction):
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
     logger.info(f"User {interaction.user} requests server URL, building fancy embed and responding with server address "
              f"({kavita_base_url})...")
     # Respond to the user with the Server address
-    embed, file = embed_builder.create_server_address_embed()
-    await interaction.response.send_message(embed=embed, file=file)
+    embed, file = kavita.embed_builder.create_server_address_embed()
+    await respond_embeds(interaction, [embed], [file])
 
 
 @bot.tree.command(name='random-manga')
-@app_commands.describe(library="Enter Library name to query from [Manga, IT Books, default is 'Manga']")
-async def random_manga(interaction: discord.Interaction, library: str = "Manga"):
-    await interaction.response.defer()
-
-    # Try to fetch a random series ID
-    try:
-        random_manga_id = bot.kavita_queries.get_random_series_id(library)
-        logger.info(f"Random Manga ID: {random_manga_id}")  # Debug print
-
-        if random_manga_id:
-            # Gather metadata
-            metadata = bot.kavita_queries.get_series_metadata(random_manga_id)
-            series = bot.kavita_queries.get_series_info(random_manga_id)
-
-            # Check if metadata and series are valid
-            if metadata and series:
-                series_embed, file = embed_builder.build_series_embed(series, metadata)
-                await interaction.followup.send(embed=series_embed, file=file if file else None)
-                embed_builder.cleanup_temp_cover(file.fp.name) if file else None
+@app_commands.describe(library="Enter Library name to query from [Manga, IT Books, default is 'Manga']",
+                       popular="Favor the most read series")
+async def random_manga(interaction: discord.Interaction, library: str = "Manga", popular: bool = False):
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
+    # Wait for a free slot, admission control defers the interaction for us
+    async with bot.admission_control.slot(interaction, 'random-manga') as admitted:
+        if not admitted:
+            return
+        # Try to fetch a random series ID
+        try:
+            # Build the index off the event loop if the background job hasn't filled it yet
+            if not kavita.series_index.libraries:
+                await asyncio.to_thread(kavita.series_index.refresh)
+            # Pick from the local index, avoiding recent picks in this channel
+            random_manga_id = kavita.series_index.sample(library, channel_id=interaction.channel_id, weighted=popular)
+            logger.info(f"Random Manga ID: {random_manga_id}")  # Debug print
+
+            if random_manga_id:
+                # Fetch and render the series off the gateway, None if Kavita had no data for it
+                series_payload, _ = await bot.render_workers.render(kavita, 'series', random_manga_id)
+
+                if series_payload:
+                    series_embed, file = embed_from_payload(series_payload)
+                    await send_embeds(interaction.followup.send, [series_embed], [file], wait=True)
+                else:
+                    await interaction.followup.send(f"No information found for series ID {random_manga_id}.")
             else:
-                await interaction.followup.send(f"No information found for series ID {random_manga_id}.")
-        else:
-            await interaction.followup.send(f"No series IDs found for library {library}.")
+                await interaction.followup.send(f"No series IDs found for library {library}.")
 
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")  # Debug print
-        await interaction.followup.send(f"An error occurred while fetching random manga: {e}")
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")  # Debug print
+            await interaction.followup.send(f"An error occurred while fetching random manga: {e}")
 
 
 @bot.tree.command(name='notify-me', description="Subscribe for notifications of series updates.")
 @app_commands.describe(series_name="The series name you wish to subscribe to.")
 async def notify_me(interaction: discord.Interaction, series_name: str, series_id: int = None):
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
     user_id = str(interaction.user.id)
-    # Source User subscriptions
-    user_notify = load_subscriptions()
+    # Source User subscriptions from this guild's namespace
+    settings = bot.guild_configs.get(interaction.guild_id)
+    namespace = settings.subscription_namespace
+    user_notify = load_subscriptions(namespace)
     if user_id not in user_notify:
         user_notify[user_id] = []
 
     # Find the series ID if only the series_name was given
     if series_name and not series_id:
-        # Set the proper series name and ID from a series name query
-        search_results = bot.kavita_queries.search_server(series_name)
-
-        series_info = search_results['series'][0]
+        # Set the proper series name and ID from a series name query (on every server, for federated guilds)
+        kavita, series_info = await find_top_result(interaction, kavita, series_name)
+        if not series_info:
+            await interaction.response.send_message(f"Unable to find a series matching `{series_name}`.",
+                                                    ephemeral=True)
+            return
 
         # Set the proper series name for user confirmation
         series_name = series_info['name']
         series_id = series_info['seriesId']
     elif series_id and not series_name:
         # Set the proper series name from the ID
-        series_name = bot.kavita_queries.get_name_from_id(series_id)
-
-    if series_id not in user_notify[user_id]:
-        user_notify[user_id].append(series_id)
-        save_subscriptions(user_notify)
+        series_name = await asyncio.to_thread(kavita.queries.get_name_from_id, series_id)
+
+    # Series on another server than the guild's own are stored with their server's name
+    subscription = subscription_id(kavita.name, series_id, settings.kavita_server)
+    if subscription not in user_notify[user_id]:
+        user_notify[user_id].append(subscription)
+        save_subscriptions(user_notify, namespace)
+        # Start following the series' chapters so its next update can be told apart
+        if kavita.name in bot.event_handlers:
+            bot.event_handlers[kavita.name].track(series_id)
         await interaction.response.send_message(f"You have been subscribed to updates for `{series_name}`.\n"
                                                 f"To list active notifications, use `/list-notifications`",
                                                 ephemeral=True)
@@ -479,16 +648,22 @@ async def notify_me(interaction: discord.Interaction, series_name: str, series_i
                   description="Remove notifications for updates from a series or all series")
 @app_commands.describe(series_name="The series name to unsubscribe from, or 'all' to remove all subscriptions.")
 async def remove_notification(interaction: discord.Interaction, series_name: str = None, series_id: int = None):
+    # Use the Kavita server configured for this guild
+    kavita = bot.kavita_for(interaction.guild_id)
     user_id = str(interaction.user.id)
-    # Source User subscriptions
-    user_notify = load_subscriptions()
+    # Source User subscriptions from this guild's namespace
+    settings = bot.guild_configs.get(interaction.guild_id)
+    namespace = settings.subscription_namespace
+    user_notify = load_subscriptions(namespace)
 
     # Find the series ID if only the series_name was given
     if series_name and series_name != 'all' and not series_id:
-        # Set the proper series name and ID from a series name query
-        search_results = bot.kavita_queries.search_server(series_name)
-
-        series_info = search_results['series'][0]
+        # Set the proper series name and ID from a series name query (on every server, for federated guilds)
+        kavita, series_info = await find_top_result(interaction, kavita, series_name)
+        if not series_info:
+            await interaction.response.send_message(f"Unable to find a series matching `{series_name}`.",
+                                                    ephemeral=True)
+            return
 
         # Set the proper series name for user confirmation
         series_name = series_info['name']
@@ -498,18 +673,19 @@ async def remove_notification(interaction: discord.Interaction, series_name: str
         if series_name == "all":
             # Remove all subscriptions for the user
             del user_notify[user_id]
-            save_subscriptions(user_notify)
+            save_subscriptions(user_notify, namespace)
             await interaction.response.send_message(
                 "You have been unsubscribed from all updates.",
                 ephemeral=True
             )
         elif series_id:
             # Remove specific series if it exists
-            if series_id in user_notify[user_id]:
-                user_notify[user_id].remove(series_id)
+            subscription = subscription_id(kavita.name, series_id, settings.kavita_server)
+            if subscription in user_notify[user_id]:
+                user_notify[user_id].remove(subscription)
                 if not user_notify[user_id]:
                     del user_notify[user_id]  # Remove the user if no subscriptions are left
-                save_subscriptions(user_notify)
+                save_subscriptions(user_notify, namespace)
                 await interaction.response.send_message(
                     f"You have been unsubscribed from updates for `{series_name}`.",
                     ephemeral=True
@@ -534,12 +710,17 @@ async def remove_notification(interaction: discord.Interaction, series_name: str
 @bot.tree.command(name='list-notifications', description="Display your current notification subscriptions.")
 async def list_notifications(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
-    # Source User subscriptions
-    user_notify = load_subscriptions()
+    # Source User subscriptions from this guild's namespace
+    settings = bot.guild_configs.get(interaction.guild_id)
+    namespace = settings.subscription_namespace
+    user_notify = load_subscriptions(namespace)
     if user_id in user_notify and user_notify[user_id]:
         series_names = []
+        # Resolve every subscribed series in one bulk request per Kavita server
+        series_by_id = await asyncio.to_thread(bot.federation.bulk_by_value, user_notify[user_id],
+                                               settings.kavita_server)
         for series_id in user_notify[user_id]:
-            series_name = bot.kavita_queries.get_name_from_id(series_id)
+            series_name = series_by_id[series_id][1].get('name') if series_id in series_by_id else None
             if series_name:
                 series_names.append(f"{series_name}")
             else:
@@ -557,9 +738,8 @@ async def list_notifications(interaction: discord.Interaction):
         # Add the list of series to the embed
         embed.add_field(name="Subscribed Series", value=f"```{series_list}```", inline=False)
 
-        # Use discord.File with the file path directly
-        header_img_path = 'assets/images/server_icon.png'
-        file = discord.File(header_img_path, filename='header.jpg')
+        # The server icon, uploaded once and linked after that
+        file = asset_file('assets/images/server_icon.png', filename='header.jpg')
         embed.set_thumbnail(url="attachment://header.jpg")
 
         embed.add_field(name="*Tip:*", value="Use `/remove-notification` `series_name:` "
@@ -567,7 +747,7 @@ async def list_notifications(interaction: discord.Interaction):
                                              "notifications.")
 
         # Send the embed as an ephemeral message
-        await interaction.response.send_message(embed=embed, file=file, ephemeral=True)
+        await respond_embeds(interaction, [embed], [file], ephemeral=True)
 
     else:
         # If the user has no subscriptions, send a different embed
@@ -577,12 +757,22 @@ async def list_notifications(interaction: discord.Interaction):
             color=0x4ac694  # Kavita favicon color
         )
 
-        # Use discord.File with the file path directly
-        header_img_path = 'assets/images/server_icon.png'
-        file = discord.File(header_img_path, filename='header.jpg')
+        # The server icon, uploaded once and linked after that
+        file = asset_file('assets/images/server_icon.png', filename='header.jpg')
         embed.set_thumbnail(url="attachment://header.jpg")
 
-        await interaction.response.send_message(embed=embed, file=file, ephemeral=True)
+        await respond_embeds(interaction, [embed], [file], ephemeral=True)
+
+
+@bot.tree.command(name='notification-mode', description="Choose how your series update notifications are delivered.")
+@app_commands.describe(mode="digest (default), compact or separate")
+@app_commands.choices(mode=[app_commands.Choice(name=f"{name}: {description}"[:100], value=name)
+                            for name, description in notification_modes.items()])
+async def notification_mode_command(interaction: discord.Interaction, mode: app_commands.Choice[str]):
+    save_notification_mode(interaction.user.id, mode.value)
+    logger.info(f"User {interaction.user} set their notification mode to {mode.value}.")
+    await interaction.response.send_message(f"Your notifications will now be delivered as `{mode.value}`: "
+                                            f"{notification_modes[mode.value]}.", ephemeral=True)
 
 
 @bot.tree.command(name='add-manga', description="Add a manga URL from mangadex to the server to be downloaded nightly"
@@ -643,6 +833,70 @@ async def add_manga(interaction: discord.Interaction, manga_url: str):
                                         f"please verify and try again", ephemeral=True)
 
 
+@bot.tree.command(name='debug-profile', description="Profile the bot for a while or for the next uses of a command "
+                                                     "(owner only).")
+@app_commands.describe(seconds=f"How long to profile for, up to {max_profile_seconds}s",
+                       command_name="Profile the next uses of this command instead",
+                       invocations="How many uses of the command to profile (default 1)")
+async def debug_profile(interaction: discord.Interaction, seconds: int = 30, command_name: str = None,
+                        invocations: int = 1):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("This command is only available to the bot owner.", ephemeral=True)
+        return
+    if bot.profile_session:
+        await interaction.response.send_message(f"Already profiling {bot.profile_session.describe()}.",
+                                                ephemeral=True)
+        return
+
+    command_name = command_name.strip().lstrip('/') if command_name else None
+    if command_name and not bot.tree.get_command(command_name):
+        await interaction.response.send_message(f"There's no `/{command_name}` command.", ephemeral=True)
+        return
+    session = ProfileSession(interaction.user, seconds=None if command_name else max(1, seconds),
+                             command_name=command_name, invocations=max(1, invocations))
+    bot.profile_session = session
+    if not command_name:
+        session.start()
+    logger.info(f"User {interaction.user} started profiling {session.describe()}.")
+    await interaction.response.send_message(f"Profiling {session.describe()}, the profile will be posted here.",
+                                            ephemeral=True)
+
+    try:
+        # The sampler runs on its own thread, this only waits for it to be done
+        deadline = asyncio.get_running_loop().time() + session.seconds
+        while not session.done.is_set() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.5)
+    finally:
+        sampled = session.finish()
+        bot.profile_session = None
+
+    if not sampled:
+        await interaction.followup.send(f"`/{command_name}` wasn't used within {session.seconds}s, nothing was "
+                                        f"profiled.", ephemeral=True)
+        return
+    profiler = session.profiler
+    collapsed = await asyncio.to_thread(profiler.collapsed)
+    file = discord.File(BytesIO(collapsed.encode()), filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt")
+    logger.info(f"Profile for {interaction.user} done, {profiler.samples} samples.")
+    await interaction.followup.send(f"Collapsed stacks (flamegraph.pl / speedscope):\n{profiler.summary()}",
+                                    file=file, ephemeral=True)
+
+
+@bot.tree.command(name='debug-stalls', description="Show what has been blocking the bot's event loop (owner only).")
+async def debug_stalls(interaction: discord.Interaction):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("This command is only available to the bot owner.", ephemeral=True)
+        return
+    metrics = bot.loop_watchdog.metrics()
+    lines = [f"{metrics['stalls']} stalls over {metrics['threshold_seconds']}s, {metrics['stalled_seconds']}s "
+             f"blocked in total. Current lag {metrics['current_lag_seconds'] * 1000:.0f}ms."]
+    # Worst offenders first, by total time the loop was blocked there
+    for entry in metrics['hotspots'][:10]:
+        lines.append(f"`{entry['hotspot']}`: {entry['count']}x, {entry['total_seconds']:.2f}s total, "
+                     f"worst {entry['worst_seconds']:.2f}s (last during {entry['last_command']})")
+    await interaction.response.send_message('\n'.join(lines)[:2000], ephemeral=True)
+
+
 # Function to check file, ensure the URL is unique, and append it if necessary
 def add_manga_to_staging_list(manga_url: str):
     # Check if the directory for the file exists
@@ -687,6 +941,24 @@ async def send_message_to_channel(message: str):
         logger.exception(f"An HTTP error occurred: {e}")
 
 
+async def find_top_result(interaction: discord.Interaction, kavita, series_name: str):
+    # Best match for a series name, returns the Kavita server that has it along with the result.
+    # Federated guilds search every server, the others just their own
+    federation = bot.federation_for(interaction.guild_id)
+    if not federation:
+        return kavita, await asyncio.to_thread(kavita.queries.get_top_search_result, series_name)
+    top_result = await asyncio.to_thread(federation.top_search_result, series_name)
+    return (federation.server(top_result['server']) if top_result else kavita), top_result
+
+
+async def send_stale_notice(interaction: discord.Interaction, notice: str = None):
+    # Let the user know if part of the response came from the cache while Kavita is down.
+    # Responses rendered by a worker pass the notice from the worker's own Kavita clients
+    notice = notice or bot.kavita_for(interaction.guild_id).queries.stale_notice()
+    if notice:
+        await interaction.followup.send(notice, ephemeral=True)
+
+
 def format_command_list(commands, first_line_text=None, max_width=100):
     """
     Formats the list of commands to ensure the output does not exceed the max_width per line.
@@ -4,20 +4,20 @@ from discord.ext import commands
 from discord import app_commands
 from discord_bot.bot_config import *
 from io import BytesIO
-from kavita_query.kavitaqueries import KavitaQueries
-from kavita_query.kavitaactions import KavitaActions
 from assets.message_templates.server_status_template import server_status_template
+from utilities.email_check import shared_email_checker
 
 
 class BNUCommandListener(commands.Cog):
-    def __init__(self, bot: commands.Bot, guild_id: int, log_channel_id: int):
+    def __init__(self, bot: commands.Bot, guild_id: int, log_channel_id: int, context):
         self.bot = bot
         self.guild_id = guild_id
         self.log_channel_id = log_channel_id
-        self.kavita_queries = KavitaQueries()  # Source the Kavita server queries
-        self.kavita_actions = KavitaActions()  # Source the Kavita server actions
-        self.kavita_queries.authenticate()  # Authenticate to the Kavita server
-        self.kavita_actions.authenticate()  # Authenticate to the Kavita server
+        # The bot's AppContext, already logged in to Kavita, so the cog reuses its clients, cache and renderer
+        kavita = context.kavita_for(guild_id)
+        self.kavita_queries = kavita.queries  # Source the Kavita server queries
+        self.kavita_actions = kavita.actions  # Source the Kavita server actions
+        self.embed_builder = kavita.embed_builder
 
     # Respond with current server stats
     @app_commands.command(name='mangastats', description="List server stats and popular series")
@@ -36,42 +36,18 @@ class BNUCommandListener(commands.Cog):
             # Create a list to hold the embeds
             embeds = []
 
-            for series in most_read:
-                # Build variables and a clickable url to the server page for the series
-                series_id = series['value']['id']
-                series_name = series['value']['name']
-                series_library = series['value']['libraryId']
-                server_address = "http://hillnet.jaykillmanstudios.com:23566"  # Replace with actual server address
-                series_url = f"{server_address}/library/{series_library}/series/{series_id}"
+            # Gather every series' metadata up front instead of one request at a time
+            metadata_by_id = self.kavita_queries.get_series_metadata_bulk(series['value']['id']
+                                                                          for series in most_read)
 
+            for series in most_read:
                 # Gather series metadata
-                metadata = self.kavita_queries.get_series_metadata(series_id)
-
-                # Build the description field
-                description = (f"\n\n**Author**:\n- {metadata['writers'][0]['name']}"
-                               f"\n**Summary**:\n{metadata['summary']}\n[**Read here**]({series_url})")
-
-                # Build an embed for the series
-                embed = discord.Embed(
-                    title=f"{series_name}",
-                    description=description if description else None,
-                    color=0x4ac694  # Kavita favicon color
-                )
-                # Attempt to pull cover data
-                series_cover_data = self.kavita_queries.get_series_cover(series_id)
-                if series_cover_data:
-                    # Create a file-like object from the image data and add it to the embed
-                    cover_image_file = BytesIO(series_cover_data)
-                    cover_image_file.name = f"series_cover_{series_id}.jpg"
-                    # Send the image as an attachment
-                    image_url = f"attachment://{cover_image_file.name}"
-                    embed.set_image(url=image_url)
-
-                    # Add the embed to the list
-                    embeds.append((embed, discord.File(cover_image_file, filename=cover_image_file.name)))
-                else:
-                    # Add the embed to the list without the image
-                    embeds.append((embed,))
+                metadata = metadata_by_id.get(series['value']['id'])
+                if not metadata:
+                    continue
+
+                # The same series embed (and cover) the bot's own commands render
+                embeds.append(self.embed_builder.build_series_embed(series=series, metadata=metadata))
 
             # Send all the embeds in one message
             for embed, file in embeds:
@@ -129,6 +105,11 @@ class BNUCommandListener(commands.Cog):
     async def invite_me(self, interaction: discord.Interaction, email_addr: str):
         # Clear the calling message
         await interaction.message.delete()
+        # The address is checked once here, the invite uses its normalized form
+        email_addr, reason = shared_email_checker().check(email_addr)
+        if not email_addr:
+            await interaction.response.send_message(f"Unable to send an invite: {reason}")
+            return
         # Generate the email invite
         user_invite = self.kavita_actions.new_user_invite(email_addr)
         if user_invite:
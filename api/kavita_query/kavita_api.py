@@ -1,18 +1,55 @@
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import utilities.logging_config as logging_config
 from urllib.parse import urlparse
+from api.kavita_query.kavita_cassette import cassette_from_env, interaction_key
 
 
 logger = logging_config.setup_logging()
 
+# (connect, read) timeout in seconds for every call to the Kavita server
+request_timeout = (3.05, 15)
+# Kept-alive connections per Kavita host, enough for the bulk, embed and federation thread pools together
+http_pool_size = 32
+login_endpoint = "/api/Plugin/authenticate"
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def shared_http_session():
+    # One connection pool for every Kavita client in the process, so connections are reused across them
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=http_pool_size)
+            _shared_session.mount('http://', adapter)
+            _shared_session.mount('https://', adapter)
+        return _shared_session
+
+
+def reset_shared_http_session():
+    # A forked process mustn't share its parent's open connections, so it starts its own pool
+    global _shared_session
+    with _shared_session_lock:
+        _shared_session = None
+    return shared_http_session()
+
 
 class KavitaAPI:
-    def __init__(self, url):
+    # One per Kavita server: the login (shared by the queries and actions clients of that server) and the HTTP pool
+    def __init__(self, url, session=None):
         self.url = url
+        self.session = session or shared_http_session()
         self.jwt_token = None
         self.host_address = None
         self.api_key = None
         self.headers = None
+        # Recorded Kavita traffic to record to or replay from, see kavita_cassette
+        self.cassette = cassette_from_env()
+        self._login_lock = threading.Lock()
         self._parse_url()
 
     def _parse_url(self):
@@ -21,12 +58,10 @@ class KavitaAPI:
         self.api_key = parsed_url.path.split('/')[-1]
 
     def authenticate(self):
-        login_endpoint = "/api/Plugin/authenticate"
         try:
-            response = requests.post(
-                f"{self.host_address}{login_endpoint}?apiKey={self.api_key}&pluginName=pythonScanScript"
+            response = self.request(
+                "POST", login_endpoint, params={"apiKey": self.api_key, "pluginName": "pythonScanScript"}
             )
-            response.raise_for_status()
             self.jwt_token = response.json().get('token')
             self.headers = {
                 "Authorization": f"Bearer {self.jwt_token}",
@@ -36,3 +71,31 @@ class KavitaAPI:
         except requests.exceptions.RequestException as e:
             logger.exception(f"Error during authentication: {e}")
             return False
+
+    def request(self, method, endpoint, headers=None, timeout=request_timeout, **kwargs):
+        # Send a request to the Kavita server, raising on connection errors, timeouts and error status codes
+        response = self._send(method, endpoint, headers, timeout, **kwargs)
+        if response.status_code == 401 and endpoint != login_endpoint and headers and 'Authorization' in headers:
+            # The token ran out, log in again and retry once with the new one
+            self.refresh_login(headers['Authorization'])
+            response = self._send(method, endpoint, dict(headers, Authorization=f"Bearer {self.jwt_token}"),
+                                  timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def refresh_login(self, rejected_authorization: str):
+        # Every client of this server shares the login, the first thread to see it rejected logs in for all of them
+        with self._login_lock:
+            if rejected_authorization == f"Bearer {self.jwt_token}":
+                logger.info(f"Kavita login for {self.host_address} expired, logging in again.")
+                self.authenticate()
+
+    def _send(self, method, endpoint, headers, timeout, **kwargs):
+        def send():
+            return self.session.request(method, f"{self.host_address}{endpoint}", headers=headers, timeout=timeout,
+                                        **kwargs)
+
+        if self.cassette:
+            key = interaction_key(self.host_address, method, endpoint, kwargs.get('params'), kwargs.get('json'))
+            return self.cassette.request(key, send)
+        return send()
@@ -0,0 +1,159 @@
+import os
+import gzip
+import json
+import time
+import base64
+import atexit
+import hashlib
+import tempfile
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# BNU_KAVITA_CASSETTE names a cassette file: every Kavita request is recorded to it ("record") or answered from it
+# ("replay", the default) at BNU_KAVITA_CASSETTE_LATENCY milliseconds per request
+cassette_path = os.environ.get('BNU_KAVITA_CASSETTE')
+cassette_mode = os.environ.get('BNU_KAVITA_CASSETTE_MODE', 'replay').lower()
+cassette_latency = float(os.environ.get('BNU_KAVITA_CASSETTE_LATENCY', 0)) / 1000
+# Recordings are written out every this many new responses, and on exit
+save_every = 50
+# Request parameters and response fields that carry credentials, never written to a cassette
+scrubbed_params = {'apiKey'}
+scrubbed_fields = {'token', 'refreshToken', 'apiKey'}
+scrubbed_value = "scrubbed"
+# Response headers worth keeping, the rest only make the cassette bigger
+kept_headers = ('Content-Type', 'Content-Length')
+
+
+def interaction_key(host: str, method: str, endpoint: str, params=None, json_body=None):
+    # The same request always gives the same key, whatever the credentials it was made with
+    query = sorted((key, str(value)) for key, value in (params or {}).items() if key not in scrubbed_params)
+    body = json.dumps(json_body, sort_keys=True) if json_body is not None else ""
+    return f"{method.upper()} {host}{endpoint} {query} {body}"
+
+
+def scrub(value):
+    if isinstance(value, dict):
+        return {key: scrubbed_value if key in scrubbed_fields else scrub(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+
+def scrub_body(response):
+    # JSON bodies with credential fields blanked, anything else (covers) as is
+    if 'json' not in response.headers.get('Content-Type', ''):
+        return response.content
+    try:
+        return json.dumps(scrub(response.json())).encode()
+    except ValueError:
+        return response.content
+
+
+class KavitaCassette:
+    # Recorded Kavita responses: request key -> the responses it got, in order. Bodies are stored once by hash,
+    # so a cover fetched a hundred times costs one copy. The file is gzipped JSON
+    def __init__(self, path: str, mode: str = 'replay', latency: float = 0.0):
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.interactions = {}
+        self.bodies = {}
+        # How far through each key's responses replay has got
+        self.positions = {}
+        self.unsaved = 0
+        self._lock = threading.Lock()
+        # Saves take turns, a slow one finishing after a newer one would put older data on disk
+        self._save_lock = threading.Lock()
+        if mode == 'replay' or os.path.exists(path):
+            self.load()
+        if mode == 'record':
+            atexit.register(self.save)
+        logger.info(f"Kavita cassette {path} in {mode} mode, {len(self.interactions)} recorded requests.")
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rt') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            logger.error(f"Kavita cassette {self.path} doesn't exist, every request will fail.")
+            return
+        self.interactions = data['interactions']
+        self.bodies = data['bodies']
+
+    def save(self):
+        with self._save_lock:
+            # Copied under the lock, recording carries on while the copy is written out
+            with self._lock:
+                data = {'version': 1, 'bodies': dict(self.bodies),
+                        'interactions': {key: list(entries) for key, entries in self.interactions.items()}}
+                self.unsaved = 0
+            directory = os.path.dirname(self.path) or '.'
+            os.makedirs(directory, exist_ok=True)
+            # Written next to the cassette and moved over it, so a crash never leaves half a file behind
+            descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path), suffix='.tmp')
+            try:
+                with os.fdopen(descriptor, 'wb') as raw_file, gzip.open(raw_file, 'wt') as file:
+                    json.dump(data, file, separators=(',', ':'))
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+    def request(self, key: str, send):
+        # send() makes the real request when recording
+        if self.mode == 'record':
+            response = send()
+            self.record(key, response)
+            return response
+        return self.replay(key)
+
+    def record(self, key: str, response):
+        body = scrub_body(response)
+        body_hash = hashlib.sha1(body).hexdigest()
+        entry = {'status': response.status_code, 'reason': response.reason, 'body': body_hash,
+                 'headers': {name: response.headers[name] for name in kept_headers if name in response.headers}}
+        with self._lock:
+            self.bodies.setdefault(body_hash, base64.b64encode(body).decode())
+            self.interactions.setdefault(key, []).append(entry)
+            self.unsaved += 1
+            save_now = self.unsaved >= save_every
+        if save_now:
+            self.save()
+
+    def replay(self, key: str):
+        # Responses for a key come back in the order they were recorded, the last one repeats
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            entries = self.interactions.get(key)
+            if not entries:
+                raise requests.exceptions.ConnectionError(f"No recorded Kavita response for {key}")
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+            entry = entries[min(position, len(entries) - 1)]
+            body = base64.b64decode(self.bodies[entry['body']])
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = body
+        response.url = key.split(' ')[1]
+        return response
+
+
+_shared_cassettes = {}
+
+
+def cassette_from_env():
+    # The cassette named by BNU_KAVITA_CASSETTE, shared by every Kavita client in the process, or None
+    if not cassette_path:
+        return None
+    if cassette_path not in _shared_cassettes:
+        _shared_cassettes[cassette_path] = KavitaCassette(cassette_path, cassette_mode, cassette_latency)
+    return _shared_cassettes[cassette_path]
@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+import utilities.logging_config as logging_config
+from utilities.series_embed import embed_from_payload
+from assets.message_templates.server_status_template import server_status_template, stats_reply_line
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Most servers queried at once
+federation_workers = 8
+
+
+def origin_id(server_name: str, series_id: int):
+    # A series id tagged with the Kavita server it lives on, e.g. "books:42"
+    return f"{server_name}:{series_id}"
+
+
+def split_origin_id(value, home_server: str = "default"):
+    # Returns (server name, series id). Plain ids belong to the guild's own server, (None, None) if unreadable
+    if isinstance(value, int):
+        return home_server, value
+    if isinstance(value, str):
+        server_name, _, series_id = value.rpartition(':')
+        if series_id.isdigit():
+            return server_name or home_server, int(series_id)
+    return None, None
+
+
+def subscription_id(server_name: str, series_id: int, home_server: str = "default"):
+    # Subscriptions to the guild's own server keep plain ids, so existing subscription files stay valid
+    return series_id if server_name == home_server else origin_id(server_name, series_id)
+
+
+def match_rank(series_name: str, query: str):
+    # Exact matches first, then prefix matches, then anything containing the query
+    series_name, query = series_name.lower(), query.lower().strip()
+    if series_name == query:
+        return 0
+    if series_name.startswith(query):
+        return 1
+    return 2 if query in series_name else 3
+
+
+def merge_stats(stats_list):
+    # Server stats summed across servers, counts and totals add up, everything else is left out. Kavita only gives
+    # a count of genres and people, so ones that several servers share are counted once per server
+    merged = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+class KavitaFederation:
+    def __init__(self, servers: dict):
+        # servers is the bot's name -> KavitaServer mapping, every one of them takes part
+        self.servers = servers
+        self.pool = ThreadPoolExecutor(max_workers=federation_workers, thread_name_prefix='kavita-federation')
+
+    def _each(self, call):
+        # Run call(server) against every server at once, returns {server name: result}.
+        # A server that fails is left out rather than failing the whole query
+        futures = {name: self.pool.submit(call, server) for name, server in self.servers.items()}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.error(f"Kavita server '{name}' failed a federated query: {e}")
+        return results
+
+    def server(self, server_name: str):
+        return self.servers.get(server_name)
+
+    def resolve(self, value, home_server: str = "default"):
+        # (KavitaServer, series id) for a plain or origin tagged id, (None, None) if the server is unknown
+        server_name, series_id = split_origin_id(value, home_server)
+        server = self.servers.get(server_name)
+        return (server, series_id) if server else (None, None)
+
+    def bulk_by_value(self, values, home_server: str = "default", lookup: str = "get_series_bulk"):
+        # Subscription values (plain or origin tagged ids) -> (server name, result of the bulk lookup for that id),
+        # each server answering for its own series in one bulk request
+        ids_by_server = {}
+        for value in values:
+            server_name, series_id = split_origin_id(value, home_server)
+            if server_name in self.servers:
+                ids_by_server.setdefault(server_name, set()).add(series_id)
+        futures = {name: self.pool.submit(getattr(self.servers[name].queries, lookup), ids)
+                   for name, ids in ids_by_server.items()}
+        results = {}
+        for value in values:
+            server_name, series_id = split_origin_id(value, home_server)
+            try:
+                found = futures[server_name].result().get(series_id) if server_name in futures else None
+            except Exception as e:
+                logger.error(f"Kavita server '{server_name}' failed a bulk series lookup: {e}")
+                found = None
+            if found:
+                results[value] = (server_name, found)
+        return results
+
+    @staticmethod
+    def _tag(server_name: str, series: dict, id_key: str):
+        # Copy a series entry and note where it came from
+        return dict(series, server=server_name, originId=origin_id(server_name, series[id_key]))
+
+    def search(self, search_query: str):
+        # Series matching the query on every server, best matches first, otherwise in each server's own order
+        results = self._each(lambda server: server.queries.search_server(search_query))
+        ranked = []
+        for server_name, search_results in results.items():
+            for position, series in enumerate((search_results or {}).get('series') or []):
+                ranked.append((match_rank(series.get('name', ''), search_query), position,
+                               self._tag(server_name, series, 'seriesId')))
+        ranked.sort(key=lambda item: item[:2])
+        return [series for _, _, series in ranked]
+
+    def top_search_result(self, search_query: str):
+        results = self.search(search_query)
+        if results:
+            return results[0]
+        logger.info(f"No federated search results for {search_query}.")
+        return None
+
+    def find_series(self, series_name: str):
+        # (KavitaServer, series id) of the series with exactly this name on any server
+        for series in self.search(series_name):
+            if series['name'] == series_name:
+                return self.servers[series['server']], series['seriesId']
+        return None, None
+
+    def recently_updated(self):
+        # Every server's recently updated series, newest first
+        results = self._each(lambda server: server.queries.get_recently_updated())
+        updated_series = []
+        for server_name, server_series in results.items():
+            if server_name in self.servers:
+                # A changed listing means the library changed, so that server's stats snapshot is out of date
+                self.servers[server_name].stats_snapshot.note_recently_updated(server_series)
+            updated_series.extend(self._tag(server_name, series, 'seriesId') for series in server_series or []
+                                  if 'seriesId' in series)
+        updated_series.sort(key=lambda series: str(series.get('created', '')), reverse=True)
+        return updated_series
+
+    def series_thumbnail(self, value):
+        # Thumbnail cover of an origin tagged series, for mosaics mixing several servers
+        server, series_id = self.resolve(value)
+        return server.embed_builder.series_thumbnail(series_id) if server else None
+
+    def build_recently_updated_embed(self, emoji_manga_list, updated_series):
+        # The recently updated listing of every server, one mosaic of covers from all of them
+        origin_ids_by_name = {series['seriesName']: series['originId'] for series in updated_series
+                              if 'seriesName' in series}
+        default = next(iter(self.servers.values()))
+        return default.embed_builder.build_recently_updated_embed(emoji_manga_list, origin_ids_by_name,
+                                                                  fetch_thumbnail=self.series_thumbnail)
+
+    def stats_messages(self, interaction=None, daily_update=False):
+        # Combined stats of every server: summed counts and the most read series across all of them.
+        # Builds any snapshot that isn't ready yet, so run it off the event loop
+        self._each(lambda server: server.stats_snapshot.is_ready() or server.stats_snapshot.refresh())
+        snapshots = [server.stats_snapshot.current for server in self.servers.values()
+                     if server.stats_snapshot.current]
+        if not snapshots:
+            return None, None
+
+        stats_text, _ = server_status_template(data=merge_stats(snapshot['stats'] for snapshot in snapshots),
+                                               daily_update=daily_update, summed_totals=len(snapshots) > 1)
+        most_read = sorted((item for snapshot in snapshots for item in snapshot['most_read']),
+                           key=lambda item: item[0], reverse=True)[:3]
+        return stats_reply_line(interaction) + stats_text, [embed_from_payload(payload) for _, payload in most_read]
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,118 @@
+import json
+import asyncio
+import aiohttp
+from urllib.parse import quote
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# SignalR JSON protocol: every message ends with the ASCII record separator
+record_separator = '\x1e'
+message_invocation = 1
+message_ping = 6
+message_close = 7
+
+# Keep-alive interval the hub expects from clients, and the longest wait between reconnect attempts
+hub_ping_seconds = 15
+reconnect_max_seconds = 300
+
+
+def split_frames(text: str):
+    # A websocket message can carry several SignalR messages, drop the empty tail after the last separator
+    return [frame for frame in text.split(record_separator) if frame]
+
+
+class KavitaHubClient:
+    def __init__(self, kavita_api, handlers: dict, name: str = "default"):
+        # kavita_api is the logged in KavitaAPI, handlers maps hub event names to coroutines taking the event body
+        self.kavita_api = kavita_api
+        self.handlers = handlers
+        self.name = name
+        self.connected = False
+        self._closed = False
+
+    def hub_url(self):
+        host = self.kavita_api.host_address
+        scheme = "wss" if host.startswith("https") else "ws"
+        return (f"{scheme}{host[host.index(':'):]}/hubs/messages"
+                f"?access_token={quote(self.kavita_api.jwt_token or '')}")
+
+    async def run(self):
+        # Stay connected until close(), backing off while Kavita is unreachable
+        backoff = 1
+        while not self._closed:
+            try:
+                await self._listen()
+            except aiohttp.WSServerHandshakeError as e:
+                if e.status == 401:
+                    # The token expired, log in again before the next attempt
+                    logger.warning(f"Kavita hub '{self.name}' rejected our token, re-authenticating.")
+                    await asyncio.to_thread(self.kavita_api.authenticate)
+                else:
+                    logger.error(f"Kavita hub '{self.name}' refused the connection: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Kavita hub '{self.name}' connection lost: {e}")
+            if self.connected:
+                # The connection was up, so start backing off from scratch
+                backoff = 1
+            self.connected = False
+            if self._closed:
+                break
+            logger.info(f"Reconnecting to Kavita hub '{self.name}' in {backoff} seconds...")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, reconnect_max_seconds)
+
+    async def _listen(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.hub_url()) as websocket:
+                # Handshake, the hub answers with an empty JSON object
+                await websocket.send_str(json.dumps({"protocol": "json", "version": 1}) + record_separator)
+                ping_task = asyncio.create_task(self._ping(websocket))
+                try:
+                    async for message in websocket:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            for frame in split_frames(message.data):
+                                await self._handle_frame(frame)
+                        elif message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+                finally:
+                    ping_task.cancel()
+
+    async def _ping(self, websocket):
+        while True:
+            await asyncio.sleep(hub_ping_seconds)
+            await websocket.send_str(json.dumps({"type": message_ping}) + record_separator)
+
+    async def _handle_frame(self, frame: str):
+        message = json.loads(frame)
+        message_type = message.get('type')
+
+        if message_type is None:
+            # Handshake response
+            if message.get('error'):
+                raise ConnectionError(f"Handshake failed: {message['error']}")
+            self.connected = True
+            logger.info(f"Connected to Kavita hub '{self.name}', listening for library events.")
+        elif message_type == message_invocation:
+            await self._dispatch(message.get('target'), message.get('arguments') or [])
+        elif message_type == message_close:
+            raise ConnectionError(f"Hub closed the connection: {message.get('error') or 'no reason given'}")
+
+    async def _dispatch(self, target, arguments):
+        handler = self.handlers.get(target)
+        if not handler:
+            return
+        # Kavita wraps every event in a message with the event data under 'body'
+        event = arguments[0] if arguments else {}
+        body = event.get('body', event) if isinstance(event, dict) else event
+        try:
+            await handler(body)
+        except Exception as e:
+            # One bad event shouldn't take the listener down
+            logger.error(f"Failed to handle Kavita event {target}: {e}")
+
+    def close(self):
+        self._closed = True
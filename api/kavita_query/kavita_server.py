@@ -0,0 +1,36 @@
+import utilities.logging_config as logging_config
+from kavita_api import KavitaAPI
+from kavita_config import opds_url
+from api.kavita_query.kavitaqueries import KavitaQueries
+from api.kavita_query.kavitaactions import KavitaActions
+from utilities.stats_snapshot import StatsSnapshot
+from utilities.series_index import SeriesIndex
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+
+class KavitaServer:
+    def __init__(self, name: str = "default", server_url: str = None, server_address: str = None, session=None):
+        # Everything the bot keeps per Kavita server: the API clients and the data we precompute from them
+        self.name = name
+        self.server_url = server_url
+        self.server_address = server_address
+        # One login for the server, used by both clients over the shared connection pool
+        self.api = KavitaAPI(f"{server_url or opds_url}", session=session)
+        self.queries = KavitaQueries(server_url=server_url, server_address=server_address, kavita_api=self.api)
+        self.actions = KavitaActions(server_url=server_url, kavita_api=self.api)
+        # Pre-rendered server stats, kept fresh by the job scheduler
+        self.stats_snapshot = StatsSnapshot(self.queries)
+        # Library to series id index for instant random picks
+        self.series_index = SeriesIndex(self.queries)
+
+    @property
+    def embed_builder(self):
+        return self.queries.embed_builder
+
+    def authenticate(self):
+        if not self.api.authenticate():
+            logger.error(f"Failed to authenticate with Kavita server '{self.name}'.")
+            return False
+        return True
@@ -1,119 +1,258 @@
 import requests
-import random
-import os
-import tempfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import utilities.logging_config as logging_config
 from kavita_api import KavitaAPI
 from kavita_config import *
-import urllib.parse
-from assets.message_templates.server_status_template import server_status_template
 from utilities.series_embed import EmbedBuilder
+from utilities.circuit_breaker import CircuitBreakerRegistry, LastKnownGoodCache
+from utilities.cache_backend import cache_from_env, MemoryCache
+from utilities.chapter_timeline import ChapterTimelineCache
+from utilities.series_index import (filter_field_libraries, filter_comparison_equal, filter_combination_and,
+                                    sort_field_created)
 
 # Create the logger object
 logger = logging_config.setup_logging()
 
+# How long (seconds) responses are served from the shared cache before asking Kavita again
+metadata_max_age = 600
+cover_max_age = 3600
+search_max_age = 120
+stats_max_age = 60
+libraries_max_age = 600
+# Shared cache entries outlive their max age this long, as a stale fallback for replicas and restarts
+shared_stale_seconds = 24 * 3600
+
+# Series ids per bulk request, and parallel requests for endpoints that only take one id
+bulk_batch_size = 100
+bulk_fetch_workers = 8
+
 
 class KavitaQueries:
-    def __init__(self):
-        self.kAPI = KavitaAPI(f"{opds_url}")
+    def __init__(self, server_url: str = None, server_address: str = None, kavita_api: KavitaAPI = None):
+        # Defaults to the server in kavita_config, other servers pass their OPDS url and web address.
+        # kavita_api shares an existing login and connection pool for the server
+        self.kAPI = kavita_api or KavitaAPI(f"{server_url or opds_url}")
+        self.api_key = self.kAPI.api_key if server_url else kavi_api_key
         # Source the series embed function
-        self.embed_builder = EmbedBuilder(server_address=kavita_base_url, kavita_queries=self)
+        self.embed_builder = EmbedBuilder(server_address=server_address or kavita_base_url, kavita_queries=self)
+        # One circuit per Kavita endpoint, and the last good response for every request we've made
+        self.breakers = CircuitBreakerRegistry()
+        self.last_good = LastKnownGoodCache()
+        self.stale_since = None
+        # Cache shared with other replicas (and kept across restarts) depending on BNU_CACHE_BACKEND
+        self.shared_cache = cache_from_env(namespace=f"kavita:{self.kAPI.host_address}")
+        # Compact per-series chapter lists so recent chapters don't need the full series detail every time
+        self.chapter_timeline = ChapterTimelineCache(self)
+        # Bounded parallelism for multi-series lookups without a bulk endpoint
+        self.bulk_pool = ThreadPoolExecutor(max_workers=bulk_fetch_workers, thread_name_prefix='kavita-bulk')
+        # Called with (kind, args) on every invalidation, so other processes holding these caches can follow
+        self.invalidation_listeners = []
 
     def authenticate(self):
         # Login to the Kavita API
         return self.kAPI.authenticate()
 
-    def generate_server_stats(self, daily_update=False, interaction=None):
-        message = self.get_server_stats()
-        if message:
-            # Format the stats message
-            stats_message, most_read = server_status_template(data=message, daily_update=daily_update,
-                                                              interaction=interaction)
-
-            # Create a list to hold the embeds
-            embeds = []
-
-            for series in most_read:
-                series_id = series['value']['id']
-                # Build variables and a clickable url to the server page for the series
-                metadata = self.get_series_metadata(series_id)
-                # Gather series metadata
-                embed_result = self.embed_builder.build_series_embed(series, metadata, thumbnail=True)
-                embeds.append(embed_result)
+    @staticmethod
+    def _cache_key(endpoint, params, method, json_body):
+        # The API key is left out so it never ends up in a shared cache
+        cache_params = sorted((key, value) for key, value in (params or {}).items() if key != "apiKey")
+        return f"{method} {endpoint}?{cache_params} {json_body}"
 
-            return stats_message, embeds
-
-    def get_series_info(self, series_id: int, verbose: bool = False):
+    def _fetch(self, endpoint, params=None, method="GET", accept="application/json", raw=False,
+               description="data", json_body=None, max_age=None):
         # Ensure the API is authenticated
         if not self.kAPI.jwt_token:
             raise Exception("Authentication is required before accessing the API.")
 
-        # Define request headers
+        cache_key = self._cache_key(endpoint, params, method, json_body)
+        if max_age:
+            # Serve from the shared cache while it's fresh, with only one caller refreshing it at a time
+            return self.shared_cache.get_or_load(
+                cache_key, max_age, lambda: self._fetch_live(cache_key, endpoint, params, method, accept, raw,
+                                                             description, json_body),
+                ttl=shared_stale_seconds)
+        return self._fetch_live(cache_key, endpoint, params, method, accept, raw, description, json_body)[0]
+
+    def _fetch_live(self, cache_key, endpoint, params, method, accept, raw, description, json_body):
+        # Returns (payload, fresh), fresh is False for errors and stale fallbacks so they're never cached
         headers = {
             "Authorization": f"Bearer {self.kAPI.jwt_token}",
+            "Accept": accept,
             "Content-Type": "application/json"
         }
+        breaker = self.breakers.get(endpoint)
+
+        # Fail fast while Kavita is known to be down on this endpoint
+        if not breaker.allow_request():
+            return self._serve_stale(cache_key, endpoint, description), False
+
+        try:
+            response = self.kAPI.request(method, endpoint, headers=headers, params=params, json=json_body)
+            if not raw and not response.content.strip():
+                # Answered with nothing (e.g. a 204 for a chapter without a summary), there's nothing to cache
+                breaker.record_success()
+                return None, False
+            payload = response.content if raw else response.json()
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code < 500:
+                # The server answered, so the endpoint is healthy even if this request was bad
+                breaker.record_success()
+                logger.error(f"Error fetching {description}: {e}")
+                return None, False
+            breaker.record_failure()
+            logger.error(f"Error fetching {description}: {e}")
+            return self._serve_stale(cache_key, endpoint, description), False
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Connection problems, timeouts and bodies that aren't the JSON we asked for
+            breaker.record_failure()
+            logger.error(f"Error fetching {description}: {e}")
+            return self._serve_stale(cache_key, endpoint, description), False
+
+        breaker.record_success()
+        self.last_good.put(cache_key, payload)
+        return payload, True
+
+    def _serve_stale(self, cache_key, endpoint, description):
+        # Our own last good copy first, then whatever another replica (or our last run) left in the shared cache
+        cached = self.last_good.get(cache_key) or self.shared_cache.get_entry(cache_key)
+        if not cached:
+            logger.warning(f"Kavita endpoint {endpoint} is unavailable and no cached {description} exists.")
+            return None
+
+        payload, stored_at = cached
+        self.stale_since = stored_at if self.stale_since is None else min(self.stale_since, stored_at)
+        logger.warning(f"Kavita endpoint {endpoint} is unavailable, serving cached {description} from "
+                       f"{datetime.fromtimestamp(stored_at).strftime('%Y-%m-%d %H:%M:%S')}.")
+        # Mark JSON objects as stale so callers can tell, without touching the cached copy
+        if isinstance(payload, dict):
+            return {**payload, '_stale_since': stored_at}
+        return payload
+
+    def stale_notice(self):
+        # Returns a user facing warning if any endpoint is currently being served from cache
+        if not self.breakers.open_circuits():
+            self.stale_since = None
+            return None
+        if self.stale_since is None:
+            return None
+        cached_at = datetime.fromtimestamp(self.stale_since).strftime('%B %d, %Y %H:%M')
+        return f"*The Kavita server isn't responding right now, some of this info is cached from {cached_at}.*"
+
+    def probe_circuits(self):
+        # Background health check: close every circuit as soon as Kavita answers again
+        open_circuits = self.breakers.open_circuits()
+        if not open_circuits:
+            return
+        try:
+            self.kAPI.request("GET", "/api/Health", timeout=(3.05, 5))
+        except requests.exceptions.RequestException as e:
+            logger.info(f"Kavita health probe failed, {len(open_circuits)} circuits still open: {e}")
+            return
+        logger.info(f"Kavita health probe succeeded, closing {len(open_circuits)} circuits.")
+        self.breakers.close_all()
+        self.stale_since = None
+
+    def _notify_invalidation(self, kind: str, *args):
+        for listener in self.invalidation_listeners:
+            try:
+                listener(kind, args)
+            except Exception as e:
+                logger.error(f"Invalidation listener failed on {kind} {args}: {e}")
+
+    def invalidate_series(self, series_id: int):
+        # Kavita reported a change to the series, drop what we cached about it
+        self.shared_cache.delete(self._cache_key("/api/Series/metadata", {"seriesId": series_id}, "GET", None))
+        self._drop_cover("series", series_id)
+        self.chapter_timeline.invalidate(series_id)
+        self._notify_invalidation("series", series_id)
+
+    def invalidate_cover(self, kind: str, item_id: int):
+        self._drop_cover(kind, item_id)
+        self._notify_invalidation("cover", kind, item_id)
+
+    def _drop_cover(self, kind: str, item_id: int):
+        if kind == "series":
+            self.shared_cache.delete(self._cache_key("/api/image/series-cover", {"seriesId": item_id}, "GET", None))
+            self.embed_builder.cover_pipeline.forget_series(item_id)
+        elif kind == "chapter":
+            self.shared_cache.delete(self._cache_key("/api/Image/chapter-cover", {"chapterId": item_id}, "GET", None))
+
+    def forget_local_caches(self):
+        # Drop everything this process holds for itself, caches shared with other processes are left alone
+        if isinstance(self.shared_cache, MemoryCache):
+            self.shared_cache.clear()
+        self.chapter_timeline.clear()
+        self.embed_builder.cover_pipeline.clear()
 
+    def get_series_info(self, series_id: int, verbose: bool = False):
         if verbose:
             # Retrieve series info from the server
-            scan_endpoint = f"/api/Series/series-detail?seriesId={series_id}"
-            try:
-                response = requests.get(f"{self.kAPI.host_address}{scan_endpoint}", headers=headers)
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error fetching series info: {e}")
-                return None
+            return self._fetch("/api/Series/series-detail", params={"seriesId": series_id},
+                               description="series info")
         else:
             # Retrieve series info from the server
-            scan_endpoint = f"/api/Series/{series_id}"
-            try:
-                response = requests.get(f"{self.kAPI.host_address}{scan_endpoint}", headers=headers)
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error fetching series info: {e}")
-                return None
+            return self._fetch(f"/api/Series/{series_id}", description="series info")
+
+    def _fetch_each(self, fetch, ids):
+        # One request per id, at most bulk_fetch_workers at a time. Returns {id: result} without the misses
+        results = dict(zip(ids, self.bulk_pool.map(fetch, ids)))
+        return {item_id: result for item_id, result in results.items() if result}
+
+    def get_series_bulk(self, series_ids):
+        # Series info for many ids in one request per batch, returns {series_id: series}
+        series_ids = list(dict.fromkeys(series_ids))
+        series_by_id = {}
+        for start in range(0, len(series_ids), bulk_batch_size):
+            batch = series_ids[start:start + bulk_batch_size]
+            series_list = self._fetch("/api/Series/series-by-ids", method="POST", json_body={"seriesIds": batch},
+                                      description="series by ids")
+            if series_list is None:
+                # Older Kavita versions (or an outage), look the batch up one series at a time instead
+                series_by_id.update(self._fetch_each(self.get_series_info, batch))
+                continue
+            series_by_id.update({series['id']: series for series in series_list})
+        return series_by_id
+
+    def get_series_metadata_bulk(self, series_ids):
+        # Kavita has no multi-id metadata endpoint, so fetch them side by side. Returns {series_id: metadata}
+        return self._fetch_each(self.get_series_metadata, list(dict.fromkeys(series_ids)))
 
     def get_recent_chapters(self, series_id: int):
-        # Get series detailed info
-        detailed_info = self.get_series_info(series_id=series_id, verbose=True)
-
-        if detailed_info:
-            # Sort chapters by title in descending order and limit the results to the 3 most recent chapters
-            recent_chapters = sorted(
-                detailed_info['chapters'],
-                key=lambda x: x['created'],  # Assuming 'created' exists in each chapter
-                reverse=True
-            )[:3]
-            return recent_chapters
-        else:
+        # Take the 3 most recently added chapters from the cached chapter timeline
+        recent_chapters = self.chapter_timeline.recent(series_id, count=3)
+
+        if recent_chapters is None:
             logger.error(f"No detailed info found for series: {series_id}")
-            return None
+        return recent_chapters
+
+    def get_chapter_info(self, chapter_id: int):
+        # Retrieve a single chapter from the server
+        return self._fetch("/api/Series/chapter", params={"chapterId": chapter_id}, description="chapter info")
 
-    def send_recent_chapters_embed(self, manga_title, recent_chapters):
+    def send_recent_chapters_embed(self, series, recent_chapters):
+        # Render all the chapter embeds for one series in a single batch
         if recent_chapters:
-            chapter_embeds = []
-            for recent_chapter in recent_chapters:
-                if 'id' in recent_chapter:
-                    embed_results = self.embed_builder.build_chapter_embed(
-                        series_name=manga_title,
-                        chapter_info=recent_chapter,
-                        thumbnail=True
-                    )
-                    chapter_embeds.append(embed_results)
-                else:
-                    logger.warning("Unable to find chapter ID in provided info.")
-            return chapter_embeds
+            if any('id' not in recent_chapter for recent_chapter in recent_chapters):
+                logger.warning("Unable to find chapter ID in provided info.")
+            return self.embed_builder.build_chapter_embeds(series, recent_chapters, thumbnail=True)
         else:
             logger.error("Unable to find recent Chapters")
             return None
 
+    def get_top_search_result(self, search_query: str):
+        # Returns the best matching series for the query, or None if the search failed or found nothing
+        search_results = self.search_server(search_query)
+        if search_results and search_results.get('series'):
+            return search_results['series'][0]
+        logger.info(f"No search results for {search_query}.")
+        return None
+
     def get_id_from_name(self, series_name):
         series = self.search_server(series_name)
 
         # Check if 'series' exists in the response and has items
-        if 'series' in series and series['series']:
+        if series and series.get('series'):
             for item in series['series']:
                 if item['name'] == series_name:
                     return item['seriesId']
@@ -142,196 +281,79 @@ class KavitaQueries:
             return None
 
     def get_series_cover(self, series_id):
-        # Ensure the API is authenticated
-        if not self.kAPI.jwt_token:
-            raise Exception("Authentication is required before accessing the API.")
-
-        # Construct the full URL with the seriesId and apiKey
-        url = f"{self.kAPI.host_address}/api/image/series-cover"
+        # Returns the raw series cover image bytes
         params = {
             "seriesId": series_id,
-            "apiKey": kavi_api_key  # Assuming you have the API key available in your instance
-        }
-
-        headers = {
-            "Authorization": f"Bearer {self.kAPI.jwt_token}",
-            "Accept": "*/*"
+            "apiKey": self.api_key  # The API key of the server these queries are bound to
         }
-        try:
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            # Create a temporary file for the series cover image
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.jpg')
-            temp_file.write(response.content)
-            temp_file.flush()
-            temp_file.seek(0)  # Go back to the start of the file
-
-            return temp_file.name  # Return the temporary file path
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching series cover: {e}")
-            return None
+        return self._fetch("/api/image/series-cover", params=params, accept="*/*", raw=True,
+                           description="series cover", max_age=cover_max_age)
 
     def get_chapter_cover(self, chapter_id):
-        # Ensure the API is authenticated
-        if not self.kAPI.jwt_token:
-            raise Exception("Authentication is required before accessing the API.")
-
-        # Construct the full URL with the seriesId and apiKey
-        url = f"{self.kAPI.host_address}/api/Image/chapter-cover"
+        # Returns the raw chapter cover image bytes
         params = {
             "chapterId": chapter_id,
-            "apiKey": kavi_api_key  # Assuming you have the API key available in your instance
+            "apiKey": self.api_key  # The API key of the server these queries are bound to
         }
-
-        headers = {
-            "Authorization": f"Bearer {self.kAPI.jwt_token}",
-            "Accept": "*/*"
-        }
-        try:
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            # Create a temporary file for the chapter cover image
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.jpg')
-            temp_file.write(response.content)
-            temp_file.flush()
-            temp_file.seek(0)  # Go back to the start of the file
-
-            return temp_file.name  # Return the temporary file path
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching chapter cover: {e}")
-            return None
+        return self._fetch("/api/Image/chapter-cover", params=params, accept="*/*", raw=True,
+                           description="chapter cover", max_age=cover_max_age)
 
     def get_series_metadata(self, series_id: int):
-        # API Auth
-        if not self.kAPI.jwt_token:
-            raise Exception("Authentication is required before accessing the API.")
-
-        # Define request headers
-        headers = {
-            "Authorization": f"Bearer {self.kAPI.jwt_token}",
-            "Accept": "application/json"
-        }
-
         # Retrieve series metadata from the server
-        scan_endpoint = f"/api/Series/metadata?seriesId={series_id}"
-        try:
-            response = requests.get(f"{self.kAPI.host_address}{scan_endpoint}", headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching series info: {e}")
-            return None
+        return self._fetch("/api/Series/metadata", params={"seriesId": series_id}, description="series metadata",
+                           max_age=metadata_max_age)
 
     def get_chapter_metadata(self, chapter_id: int):
-        # API Auth
-        if not self.kAPI.jwt_token:
-            raise Exception("Authentication is required before accessing the API.")
-
-        # Define request headers
-        headers = {
-            "Authorization": f"Bearer {self.kAPI.jwt_token}",
-            "Accept": "application/json"
-        }
-
-        # Retrieve series metadata from the server
-        scan_endpoint = f"/api/Metadata/chapter-summary?chapterId={chapter_id}"
-        try:
-            response = requests.get(f"{self.kAPI.host_address}{scan_endpoint}", headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching series info: {e}")
-            return None
+        # Retrieve chapter summary from the server
+        return self._fetch("/api/Metadata/chapter-summary", params={"chapterId": chapter_id},
+                           description="chapter summary", max_age=metadata_max_age)
 
     def get_series_next_update(self, series_id: int):
-        # API Auth
-        if not self.kAPI.jwt_token:
-            raise Exception("Authentication is required before accessing the API.")
-
-        # Define request headers
-        headers = {
-            "Authorization": f"Bearer {self.kAPI.jwt_token}",
-            "Accept": "application/json"
-        }
-
-        # Retrieve series metadata from the server
-        scan_endpoint = f"/api/Series/next-expected?seriesId={series_id}"
-        try:
-            response = requests.get(f"{self.kAPI.host_address}{scan_endpoint}", headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching series next expected: {e}")
-            return None
+        # Retrieve the next expected chapter from the server
+        return self._fetch("/api/Series/next-expected", params={"seriesId": series_id},
+                           description="series next expected")
 
     def get_server_stats(self):
-        # Ensure the API is authenticated
-        if not self.kAPI.jwt_token:
-            raise Exception("Authentication is required before accessing the API.")
-
-        headers = {
-            "Authorization": f"Bearer {self.kAPI.jwt_token}",
-            "Content-Type": "application/json"
-        }
-
         # Retrieve server stats
-        scan_endpoint = "/api/Stats/server/stats"
-        try:
-            response = requests.get(f"{self.kAPI.host_address}{scan_endpoint}", headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching server stats: {e}")
-            return None
+        return self._fetch("/api/Stats/server/stats", description="server stats", max_age=stats_max_age)
 
     def get_recently_updated(self):
-        # Ensure API is authenticated
-        if not self.kAPI.jwt_token:
-            raise Exception("Authentication is required before accessing the API.")
-
-        headers = {
-            "Authorization": f"Bearer {self.kAPI.jwt_token}",
-            "Content-Type": "application/json"
-        }
-
         # Retrieve the updated series list
-        scan_endpoint = "/api/Series/recently-updated-series"
-        try:
-            response = requests.post(f"{self.kAPI.host_address}{scan_endpoint}", headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.exception(f"Error fetching recently updated series: {e}")
-            return None
-        
-    def search_server(self, search_query: str):
-        # Verify the query is URL safe
-        url_safe_query = urllib.parse.quote(search_query)
+        updated_series = self._fetch("/api/Series/recently-updated-series", method="POST",
+                                     description="recently updated series")
+        # Fold any new chapters into the timelines we already hold
+        self.chapter_timeline.note_recently_updated(updated_series)
+        if updated_series:
+            self._notify_invalidation("recently-updated", [{'seriesId': series.get('seriesId'),
+                                                            'chapterId': series.get('chapterId')}
+                                                           for series in updated_series])
+        return updated_series
 
-        # Ensure the API is authenticated
-        if not self.kAPI.jwt_token:
-            raise Exception("Authentication is required before accessing the API.")
-
-        headers = {
-            "Authorization": f"Bearer {self.kAPI.jwt_token}",
-            "Content-Type": "application/json"
+    def search_server(self, search_query: str):
+        # Send the search query to the API, requests takes care of making the query URL safe
+        params = {
+            "queryString": search_query,
+            "includeChapterAndFiles": "false"
         }
+        return self._fetch("/api/Search/search", params=params, description="search results", max_age=search_max_age)
 
-        # Send the search query to the API
-        scan_endpoint = f"/api/Search/search?queryString={url_safe_query}&includeChapterAndFiles=false"
-        try:
-            response = requests.get(f"{self.kAPI.host_address}{scan_endpoint}", headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.info(f"Error fetching server stats: {e}")
-            return None
-
-    def search_series_by_library_name(self, library_name):
-        library_query = self.search_server(library_name)
-
-        logger.info(f"{library_query}")
+    def get_libraries(self):
+        # Retrieve the list of libraries on the server
+        return self._fetch("/api/Library/libraries", description="libraries", max_age=libraries_max_age)
 
-    def get_random_series_id(self, library_id):
-        series_ids = self.search_series_by_library_name(library_id)
-        return random.choice(series_ids) if series_ids else None
\ No newline at end of file
+    def get_library_series_page(self, library_id: int, page: int = 1, page_size: int = 500):
+        # Retrieve one page of the series in a library, newest first
+        params = {
+            "PageNumber": page,
+            "PageSize": page_size
+        }
+        series_filter = {
+            "statements": [
+                {"comparison": filter_comparison_equal, "field": filter_field_libraries, "value": str(library_id)}
+            ],
+            "combination": filter_combination_and,
+            "sortOptions": {"sortField": sort_field_created, "isAscending": False},
+            "limitTo": 0
+        }
+        return self._fetch("/api/Series/all-v2", params=params, method="POST", json_body=series_filter,
+                           description="library series")
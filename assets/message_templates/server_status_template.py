@@ -1,9 +1,11 @@
-def server_status_template(data, daily_update=False, interaction=None):
+def server_status_template(data, daily_update=False, interaction=None, summed_totals=False):
     """
     Formats a JSON object into a stylized Discord message.
 
     Parameters:
     - data (dict): The JSON object to format.
+    - summed_totals (bool): The stats were added up across Kavita servers, genres and authors several servers
+      share are counted once per server.
 
     Returns:
     - str: The formatted Discord message.
@@ -40,11 +42,14 @@ def server_status_template(data, daily_update=False, interaction=None):
     # Placeholder in case we use this in the future
     most_read_series_text = ""
 
+    # Genres and authors are only counted per server, a federated total can count the same one more than once
+    totals_label = " (summed per server)" if summed_totals else ""
+
     # Stylized title line
     title_line = "━━━━━━━━━━━━━━ **__BNU Manga Server__** ━━━━━━━━━━━━━━"
 
     # Reply to the user that requested the stats if provided
-    user_reply = f"Hey {interaction.user.mention} here's the current server stats,\n" if interaction else ""
+    user_reply = stats_reply_line(interaction)
     # Add a daily status message if we are doing the daily status channel blast
     daily_status = f"Daily Server Stats" if daily_update else ""
     total_width = len(title_line)
@@ -61,11 +66,24 @@ def server_status_template(data, daily_update=False, interaction=None):
         f" Chapter Count: {chapter_count}\n"
         f" Volume Count: {volume_count}\n"
         f" Series Count: {series_count}\n"
-        f" Total Genres: {total_genres}\n"
-        f" Total Authors: {total_authors}\n"
+        f" Total Genres{totals_label}: {total_genres}\n"
+        f" Total Authors{totals_label}: {total_authors}\n"
         f" Total Reading Time: {total_reading_time} hours\n"
         f"{prompt_line}"
         f"```"
     )
 
-    return message, limit_series
\ No newline at end of file
+    return message, limit_series
+
+
+def stats_reply_line(interaction=None):
+    """
+    Builds the line addressing the user that requested the stats.
+
+    Parameters:
+    - interaction (discord.Interaction): The interaction that requested the stats, if any.
+
+    Returns:
+    - str: The reply line, or an empty string when there is no interaction.
+    """
+    return f"Hey {interaction.user.mention} here's the current server stats,\n" if interaction else ""
@@ -0,0 +1,96 @@
+import sys
+import os
+import time
+import argparse
+import statistics
+# Add the parent directory of src to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark embed and template rendering against recorded Kavita "
+                                                 "traffic (see BNU_KAVITA_CASSETTE in the README).")
+    parser.add_argument('cassette', help="Cassette file to replay, or to record to with --record")
+    parser.add_argument('--record', action='store_true',
+                        help="Make the requests against the live Kavita server in kavita_config and record them")
+    parser.add_argument('--latency', type=float, default=0, help="Milliseconds added to every replayed request")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--series', type=int, nargs='*',
+                        help="Series ids to render, defaults to the server's recently updated series")
+    return parser.parse_args()
+
+
+def timed(name, iterations, call):
+    # Runs call() iterations times and prints min / median / max in milliseconds
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        call()
+        durations.append((time.perf_counter() - started) * 1000)
+    print(f"{name:<40} min {min(durations):8.2f}ms  median {statistics.median(durations):8.2f}ms  "
+          f"max {max(durations):8.2f}ms")
+
+
+def main():
+    args = parse_args()
+    # The cassette is picked up from the environment when the Kavita clients are created
+    os.environ['BNU_KAVITA_CASSETTE'] = args.cassette
+    os.environ['BNU_KAVITA_CASSETTE_MODE'] = 'record' if args.record else 'replay'
+    os.environ['BNU_KAVITA_CASSETTE_LATENCY'] = str(args.latency)
+    from api.kavita_query.kavita_config import kavita_base_url
+    from api.kavita_query.kavita_server import KavitaServer
+    from assets.message_templates.server_status_template import server_status_template
+    from utilities.series_embed import embed_payload
+    from utilities.notification_digest import plan_updates, wants_compact, notification_modes
+    from utilities.message_bundle import MessageBundle
+
+    # Recording only needs one pass to capture every request the benchmarks make
+    iterations = 1 if args.record else args.iterations
+    server = KavitaServer()
+    if not server.authenticate():
+        sys.exit(f"Unable to authenticate against {kavita_base_url}.")
+    queries, embed_builder = server.queries, server.embed_builder
+
+    # Inputs are fetched once, the benchmarks time rendering them
+    series_ids = args.series or [series['seriesId'] for series in queries.get_recently_updated() or []][:10]
+    series_by_id = queries.get_series_bulk(series_ids)
+    metadata_by_id = queries.get_series_metadata_bulk(series_ids)
+    series_ids = [series_id for series_id in series_ids if series_id in series_by_id and series_id in metadata_by_id]
+    chapters_by_id = {series_id: queries.get_recent_chapters(series_id) or [] for series_id in series_ids}
+    stats = queries.get_server_stats()
+    if not series_ids or not stats:
+        sys.exit("No series or server stats to benchmark with, record the cassette against a live server first.")
+    print(f"Benchmarking {len(series_ids)} series, {iterations} iterations"
+          f"{'' if args.record else f', {args.latency}ms replay latency'}.")
+
+    timed("EmbedBuilder.build_series_embed", iterations, lambda: [
+        embed_builder.build_series_embed(series_by_id[series_id], metadata_by_id[series_id])
+        for series_id in series_ids])
+    timed("EmbedBuilder.build_chapter_embed", iterations, lambda: [
+        embed_builder.build_chapter_embed(series_by_id[series_id]['name'], chapter, thumbnail=True)
+        for series_id in series_ids for chapter in chapters_by_id[series_id]])
+    timed("server_status_template", iterations, lambda: server_status_template(data=stats, daily_update=True))
+
+    def notification_job(mode):
+        # The notification job's rendering for one subscriber following every series: embeds, then messages
+        payloads = None
+        if not wants_compact(mode, len(series_ids)):
+            payloads = [embed_payload(*embed_builder.build_series_embed(
+                series_by_id[series_id], metadata_by_id[series_id], thumbnail=mode == "digest"))
+                for series_id in series_ids]
+        compact_lines = [f"[{series_by_id[series_id]['name']}]("
+                         f"{embed_builder.build_series_url(series_id, series_by_id[series_id]['libraryId'])})"
+                         for series_id in series_ids]
+        return MessageBundle.from_payload_messages(plan_updates(mode, payloads, compact_lines,
+                                                                title="Your Series Updates"))
+
+    for mode in notification_modes:
+        timed(f"notification job ({mode})", iterations, lambda: notification_job(mode))
+
+    if args.record:
+        server.queries.kAPI.cassette.save()
+        print(f"Recorded to {args.cassette}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+import os
+import sys
+import types
+
+# Run from the repository root like the bot does, with the Kavita clients importable the way they import each other
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [root, os.path.join(root, 'api', 'kavita_query')]
+
+try:
+    import kavita_config  # noqa: F401
+except ImportError:
+    # kavita_config.py holds the server's credentials and isn't checked in, the tests never reach a real server
+    kavita_config = types.ModuleType('kavita_config')
+    kavita_config.opds_url = "http://kavita.test:5000/api/opds/test-key"
+    kavita_config.kavita_base_url = "http://kavita.test:5000"
+    kavita_config.kavi_api_key = "test-key"
+    sys.modules['kavita_config'] = kavita_config
+    sys.modules['api.kavita_query.kavita_config'] = kavita_config
@@ -0,0 +1,53 @@
+import types
+import asyncio
+from io import BytesIO
+import discord
+from utilities.attachment_registry import AttachmentRegistry, respond_embeds, shared_attachment_registry
+
+cdn = "https://cdn.discordapp.com/attachments/1/2/cover.jpg?ex=7fffffff&is=1&hm=abc"
+
+
+def cover_embed():
+    embed = discord.Embed(title="Series")
+    embed.set_image(url="attachment://cover.jpg")
+    return embed
+
+
+def cover_file():
+    return discord.File(BytesIO(b"cover bytes"), filename="cover.jpg")
+
+
+def sent_message(url=cdn):
+    return types.SimpleNamespace(attachments=[types.SimpleNamespace(filename="cover.jpg", url=url)])
+
+
+def test_uploaded_covers_are_linked_until_dropped():
+    registry = AttachmentRegistry()
+    files, pending = registry.prepare([cover_embed()], [cover_file()])
+    assert len(files) == 1
+    registry.remember(sent_message(), pending)
+
+    embed = cover_embed()
+    files, _ = registry.prepare([embed], [cover_file()])
+    assert files == [] and embed.image.url == cdn
+
+    # An edit replaced the message's attachments, a freshly signed link to the same upload is forgotten too
+    registry.forget(sent_message(cdn.replace("hm=abc", "hm=def")).attachments)
+    files, _ = registry.prepare([cover_embed()], [cover_file()])
+    assert len(files) == 1
+
+
+def test_ephemeral_responses_are_not_remembered():
+    sent = []
+
+    async def send_message(**kwargs):
+        sent.append(kwargs)
+
+    async def original_response():
+        return sent_message()
+
+    interaction = types.SimpleNamespace(response=types.SimpleNamespace(send_message=send_message),
+                                        original_response=original_response, user="reader")
+    asyncio.run(respond_embeds(interaction, [cover_embed()], [cover_file()], ephemeral=True))
+    assert len(sent) == 1
+    assert shared_attachment_registry().prepare([cover_embed()], [cover_file()])[0] != []
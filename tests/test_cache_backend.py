@@ -0,0 +1,266 @@
+import os
+import time
+import socket
+import threading
+import socketserver
+import pytest
+import utilities.cache_backend as cache_backend
+from utilities.cache_backend import (MemoryCache, SQLiteCache, RedisCache, RespConnection, RespError, encode_entry,
+                                     decode_entry)
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    # Just enough of a Redis server for the cache: PING, AUTH, SELECT, GET, SET (NX, PX) and DEL
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(('127.0.0.1', 0), RespHandler)
+        self.password = password
+        self.data = {}
+        self.commands = []
+        self.lock = threading.Lock()
+        self.connections = []
+
+    @property
+    def url(self):
+        credentials = f":{self.password}@" if self.password else ""
+        return f"redis://{credentials}127.0.0.1:{self.server_address[1]}/2"
+
+    def drop_connections(self):
+        for connection in self.connections:
+            connection.shutdown(socket.SHUT_RDWR)
+        self.connections = []
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections.append(self.request)
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            with self.server.lock:
+                self.server.commands.append([args[0].decode().upper()] + args[1:])
+                reply = self.execute(args[0].decode().upper(), args[1:])
+            self.wfile.write(reply)
+
+    def execute(self, command, args):
+        data = self.server.data
+        if command == 'PING':
+            return b'+PONG\r\n'
+        if command == 'AUTH':
+            return b'+OK\r\n' if args[0].decode() == self.server.password else b'-WRONGPASS invalid password\r\n'
+        if command == 'SELECT':
+            return b'+OK\r\n'
+        if command == 'GET':
+            value = data.get(args[0])
+            if value is None or value[1] < time.time():
+                return b'$-1\r\n'
+            return b'$%d\r\n%s\r\n' % (len(value[0]), value[0])
+        if command == 'SET':
+            options = [arg.decode().upper() for arg in args[2:]]
+            expires_at = float('inf')
+            if 'PX' in options:
+                expires_at = time.time() + int(options[options.index('PX') + 1]) / 1000
+            current = data.get(args[0])
+            if 'NX' in options and current and current[1] >= time.time():
+                return b'$-1\r\n'
+            data[args[0]] = (args[1], expires_at)
+            return b'+OK\r\n'
+        if command == 'DEL':
+            return b':%d\r\n' % (data.pop(args[0], None) is not None)
+        return b'-ERR unknown command\r\n'
+
+
+@pytest.fixture
+def resp_server():
+    server = RespStandIn(password="hunter2")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_entry_encoding():
+    small, large = {'name': "Series"}, {'chapters': list(range(2000))}
+    assert decode_entry(encode_entry(small, stored_at=5.0)) == (small, 5.0)
+    # Large JSON is compressed, bytes that don't compress are kept as they are
+    assert encode_entry(large)[:1] == b'J'
+    assert decode_entry(encode_entry(large))[0] == large
+    cover = os.urandom(4096)
+    assert encode_entry(cover)[:1] == b'b'
+    assert decode_entry(encode_entry(cover))[0] == cover
+
+
+def test_resp_command_encoding():
+    assert RespConnection.encode_command('SET', 'key', b'va\r\nl', 'PX', 1000) == \
+        b'*5\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\nva\r\nl\r\n$2\r\nPX\r\n$4\r\n1000\r\n'
+
+
+def test_redis_cache(resp_server):
+    cache = RedisCache("test", url=resp_server.url)
+    assert cache.connection.command('PING') == "PONG"
+    # The password and database come from the URL
+    assert resp_server.commands[:2] == [['AUTH', b'hunter2'], ['SELECT', b'2']]
+
+    cache.set("series:1", {'name': "Series"}, ttl=60)
+    cache.set("cover:1", b'\x89PNG\r\n', ttl=60)
+    assert cache.get("series:1") == {'name': "Series"}
+    assert cache.get("cover:1") == b'\x89PNG\r\n'
+    assert b'test:series:1' in resp_server.data
+    cache.delete("series:1")
+    assert cache.get("series:1") is None
+
+    assert cache._add_raw("test:lock", b'a', 60) is True
+    assert cache._add_raw("test:lock", b'b', 60) is False
+    cache.set("short", 1, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get("short") is None
+
+
+def test_redis_reconnects(resp_server):
+    cache = RedisCache("test", url=resp_server.url)
+    cache.set("series:1", 1, ttl=60)
+    resp_server.drop_connections()
+    assert cache.get("series:1") == 1
+
+
+def test_redis_errors(resp_server):
+    connection = RespConnection(port=resp_server.server_address[1], password="wrong")
+    with pytest.raises(RespError):
+        connection.command('PING')
+    # A cache that can't be read is a miss, not an error
+    cache = RedisCache("test", url="redis://127.0.0.1:1/0")
+    cache.connection.timeout = 0.2
+    assert cache.get("series:1") is None
+
+
+def test_sqlite_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SQLiteCache("test", path=path)
+    cache.set("series:1", {'name': "Series"}, ttl=60)
+    cache.set("cover:1", b'cover', ttl=60)
+    assert cache.get("series:1") == {'name': "Series"}
+    assert cache.get("cover:1") == b'cover'
+    cache.delete("cover:1")
+    assert cache.get("cover:1") is None
+
+    # Another process on the host sees the same entries
+    assert SQLiteCache("test", path=path).get("series:1") == {'name': "Series"}
+    assert SQLiteCache("other", path=path).get("series:1") is None
+
+    cache.set("short", 1, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get("short") is None
+    # An expired lock can be taken again
+    assert cache._add_raw("test:lock", b'a', 0.05) is True
+    assert cache._add_raw("test:lock", b'b', 60) is False
+    time.sleep(0.1)
+    assert cache._add_raw("test:lock", b'c', 60) is True
+
+
+def test_get_or_load_uses_fresh_entries():
+    cache = MemoryCache("test")
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return len(calls), True
+
+    assert cache.get_or_load("key", 60, loader) == 1
+    assert cache.get_or_load("key", 60, loader) == 1
+    # Too old for this caller, loaded again
+    assert cache.get_or_load("key", 0, loader) == 2
+    # Uncacheable results aren't stored
+    assert cache.get_or_load("other", 60, lambda: ("error", False)) == "error"
+    assert cache.get("other") is None
+
+
+def test_get_or_load_single_flight():
+    cache = MemoryCache("test")
+    calls = []
+    release = threading.Event()
+
+    def slow_loader():
+        calls.append(1)
+        release.wait(5)
+        return "value", True
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("key", 60, slow_loader)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    # Other keys don't wait behind a slow load
+    started = time.time()
+    assert cache.get_or_load("other", 60, lambda: ("other", True)) == "other"
+    assert time.time() - started < 0.5
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["value"] * 8
+    assert len(calls) == 1
+    assert cache._fills == {}
+
+
+def test_get_or_load_failed_load():
+    cache = MemoryCache("test")
+    started = threading.Event()
+
+    def failing_loader():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("Kavita is down")
+
+    errors = []
+
+    def first():
+        try:
+            cache.get_or_load("key", 60, failing_loader)
+        except ValueError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    started.wait(5)
+    # A waiter whose load failed tries for itself
+    assert cache.get_or_load("key", 60, lambda: ("value", True)) == "value"
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_fill_lock_across_replicas(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_backend, 'fill_wait_seconds', 2)
+    path = str(tmp_path / "cache.sqlite3")
+    replica_a, replica_b = SQLiteCache("test", path=path), SQLiteCache("test", path=path)
+
+    # Replica A is loading the key, B waits for its result instead of loading it too
+    assert replica_a._acquire_fill("key", "a-token")
+    threading.Timer(0.2, lambda: replica_a.set("key", "from a", ttl=60)).start()
+    assert replica_b.get_or_load("key", 60, lambda: pytest.fail("replica B loaded the key")) == "from a"
+
+    # Only the owner releases its lock
+    replica_b._release_fill("key", "b-token")
+    assert not replica_b._acquire_fill("key", "b-token")
+    replica_a._release_fill("key", "a-token")
+    assert replica_b._acquire_fill("key", "b-token")
+    replica_b._release_fill("key", "b-token")
+
+
+def test_fill_lock_wait_gives_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_backend, 'fill_wait_seconds', 0.2)
+    path = str(tmp_path / "cache.sqlite3")
+    replica_a, replica_b = SQLiteCache("test", path=path), SQLiteCache("test", path=path)
+    # Replica A took the lock and never filled the key, B loads it itself after the wait
+    assert replica_a._acquire_fill("key", "a-token")
+    started = time.time()
+    assert replica_b.get_or_load("key", 60, lambda: ("from b", True)) == "from b"
+    assert time.time() - started >= 0.2
+    assert replica_a.get("key") == "from b"
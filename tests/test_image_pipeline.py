@@ -0,0 +1,36 @@
+import os
+import signal
+import time
+from io import BytesIO
+from PIL import Image
+from utilities.image_pipeline import CoverPipeline
+
+
+def cover_bytes():
+    output = BytesIO()
+    Image.new("RGB", (300, 450), (200, 0, 0)).save(output, format="JPEG")
+    return output.getvalue()
+
+
+def test_mosaic_without_workers():
+    pipeline = CoverPipeline(workers=0)
+    mosaic = pipeline.mosaic([1, 2], [cover_bytes(), None])
+    assert Image.open(BytesIO(mosaic)).size == (240, 180)
+    assert pipeline.cached_mosaic([1, 2]) == mosaic
+    pipeline.forget_series(2)
+    assert pipeline.cached_mosaic([1, 2]) is None
+
+
+def test_broken_pool_sends_no_mosaic():
+    pipeline = CoverPipeline(workers=1)
+    pipeline.start()
+    try:
+        assert pipeline.mosaic([1], [cover_bytes()])
+        for pid in list(pipeline.executor._processes):
+            os.kill(pid, signal.SIGKILL)
+        time.sleep(0.5)
+        assert pipeline.mosaic([2], [cover_bytes()]) is None
+        # Covers fall back to the original image
+        assert pipeline.variant("series", 3, cover_bytes()) == (cover_bytes(), "jpg")
+    finally:
+        pipeline.shutdown()
@@ -0,0 +1,53 @@
+import os
+import time
+import types
+import asyncio
+from utilities.admission_control import AdmissionControl
+from utilities.invite_pipeline import InvitePipeline
+
+limits_path = os.path.join(os.path.dirname(__file__), '..', 'assets', 'subscriptions', 'command_limits.json')
+
+
+class FakeResponse:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, message, ephemeral=False):
+        self.messages.append(message)
+
+
+def make_interaction(user_id=1, guild_id=10):
+    return types.SimpleNamespace(user=types.SimpleNamespace(id=user_id, mention=f"<@{user_id}>"), guild_id=guild_id,
+                                 response=FakeResponse())
+
+
+def user_tokens(admission_control, user_id=1):
+    return admission_control.user_buckets[('invite-me', user_id)].tokens
+
+
+def test_turned_away_invites_are_refunded():
+    admission_control = AdmissionControl(limits_path)
+    kavita = types.SimpleNamespace(name="default")
+
+    async def scenario():
+        pipeline = InvitePipeline(admission_control)
+        pipeline.queue = asyncio.Queue(maxsize=1)
+
+        async def submit(email, user_id=1):
+            interaction = make_interaction(user_id)
+            assert await admission_control.admit_rate(interaction, 'invite-me')
+            await pipeline.submit(interaction, kavita, email)
+            return interaction.response.messages[-1]
+
+        # Queued invites keep their token, the ones turned away get it back
+        assert (await submit("reader@example.com")).startswith("Sending an invite")
+        assert user_tokens(admission_control) < 2
+        tokens = user_tokens(admission_control)
+        assert "isn't a valid email address" in await submit("not an address")
+        assert "already on its way" in await submit("Reader@example.com")
+        pipeline.recent[("default", "other@example.com")] = time.time()
+        assert "already sent" in await submit("other@example.com")
+        assert "Too many invites" in await submit("third@example.com")
+        assert abs(user_tokens(admission_control) - tokens) < 0.01
+
+    asyncio.run(scenario())
@@ -0,0 +1,44 @@
+import os
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+from api.kavita_query.kavita_cassette import KavitaCassette, interaction_key
+
+
+def make_response(body: bytes, status: int = 200):
+    response = requests.Response()
+    response.status_code = status
+    response.reason = "OK"
+    response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+    response._content = body
+    return response
+
+
+def test_concurrent_saves(tmp_path, monkeypatch):
+    monkeypatch.setattr('api.kavita_query.kavita_cassette.save_every', 5)
+    path = str(tmp_path / "kavita.cassette.gz")
+    cassette = KavitaCassette(path, mode='record')
+    errors = []
+
+    def record(thread):
+        try:
+            for index in range(100):
+                key = interaction_key("http://kavita", "GET", f"/api/Series/{thread}", {"seriesId": index})
+                cassette.request(key, lambda: make_response(b'{"id": %d, "token": "secret"}' % index))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=record, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cassette.save()
+
+    assert errors == []
+    # Only the cassette itself is left, no temp files
+    assert os.listdir(tmp_path) == ["kavita.cassette.gz"]
+    replay = KavitaCassette(path, mode='replay')
+    assert len(replay.interactions) == 800
+    response = replay.request(interaction_key("http://kavita", "GET", "/api/Series/3", {"seriesId": 42}), None)
+    assert response.json() == {"id": 42, "token": "scrubbed"}
@@ -0,0 +1,261 @@
+import json
+import types
+import asyncio
+from aiohttp import web
+import api.kavita_query.kavita_hub as kavita_hub
+import utilities.kavita_events as kavita_events
+from api.kavita_query.kavita_hub import KavitaHubClient, record_separator, message_invocation, message_ping
+from utilities.chapter_timeline import ChapterTimelineCache
+from utilities.kavita_events import KavitaEventHandler
+
+
+def frame(message):
+    return json.dumps(message) + record_separator
+
+
+class FakeHub:
+    # Kavita's message hub on localhost: rejects the first connections with the given HTTP statuses, then answers
+    # the SignalR handshake, sends its frames and hangs up
+    def __init__(self, rejections=(), frames=()):
+        self.rejections = list(rejections)
+        self.frames = list(frames)
+        self.tokens = []
+        self.handshakes = []
+        self.runner = None
+        self.port = None
+
+    async def handle(self, request):
+        self.tokens.append(request.query.get('access_token'))
+        if self.rejections:
+            return web.Response(status=self.rejections.pop(0))
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        handshake = await websocket.receive()
+        self.handshakes.append(json.loads(kavita_hub.split_frames(handshake.data)[0]))
+        await websocket.send_str("{}" + record_separator)
+        if self.frames:
+            # Several SignalR messages in one websocket message, like the hub sends them
+            await websocket.send_str("".join(self.frames))
+        await websocket.close()
+        return websocket
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/hubs/messages', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class FakeKavitaAPI:
+    def __init__(self, port):
+        self.host_address = f"http://127.0.0.1:{port}"
+        self.jwt_token = "token-1"
+        self.authentications = 0
+
+    def authenticate(self):
+        self.authentications += 1
+        self.jwt_token = f"token-{self.authentications + 1}"
+
+
+def patch_reconnect_sleep(monkeypatch, on_sleep):
+    # Reconnect waits are recorded and skipped, the keep-alive ping keeps its real (long) wait
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay, *args, **kwargs):
+        if delay == kavita_hub.hub_ping_seconds:
+            return await real_sleep(delay)
+        on_sleep(delay)
+        await real_sleep(0)
+
+    patched = types.SimpleNamespace(**{name: getattr(asyncio, name) for name in dir(asyncio)
+                                       if not name.startswith('_')})
+    patched.sleep = sleep
+    monkeypatch.setattr(kavita_hub, 'asyncio', patched)
+
+
+def test_hub_handshake_and_dispatch(monkeypatch):
+    received = []
+
+    async def scenario():
+        hub = FakeHub(frames=[
+            frame({"type": message_invocation, "target": "ScanSeries", "arguments": [{"body": {"seriesId": 5}}]}),
+            frame({"type": message_ping}),
+            frame({"type": message_invocation, "target": "NotHandled", "arguments": [{"body": {}}]}),
+            frame({"type": message_invocation, "target": "CoverUpdate",
+                   "arguments": [{"body": {"entityType": "series", "id": 7}}]})
+        ])
+        await hub.start()
+        api = FakeKavitaAPI(hub.port)
+        client = None
+
+        async def on_event(body):
+            received.append(body)
+            if len(received) == 2:
+                client.close()
+
+        client = KavitaHubClient(api, {'ScanSeries': on_event, 'CoverUpdate': on_event}, name="test")
+        patch_reconnect_sleep(monkeypatch, lambda delay: None)
+        await asyncio.wait_for(client.run(), 5)
+        await hub.stop()
+        return hub
+
+    hub = asyncio.run(scenario())
+    assert hub.handshakes == [{"protocol": "json", "version": 1}]
+    assert hub.tokens == ["token-1"]
+    assert received == [{"seriesId": 5}, {"entityType": "series", "id": 7}]
+
+
+def test_hub_reconnects_with_backoff(monkeypatch):
+    delays = []
+    monkeypatch.setattr(kavita_hub, 'reconnect_max_seconds', 3)
+
+    async def scenario():
+        # Two refusals, an expired token, one good connection, then Kavita goes away again
+        hub = FakeHub(rejections=[500, 500, 401])
+        await hub.start()
+        api = FakeKavitaAPI(hub.port)
+        client = KavitaHubClient(api, {}, name="test")
+
+        def on_sleep(delay):
+            delays.append(delay)
+            if len(delays) == 4:
+                hub.rejections.append(500)
+            if len(delays) == 5:
+                client.close()
+
+        patch_reconnect_sleep(monkeypatch, on_sleep)
+        await asyncio.wait_for(client.run(), 5)
+        await hub.stop()
+        return hub, api
+
+    hub, api = asyncio.run(scenario())
+    # Doubling up to the cap, back to the start once a connection got through
+    assert delays == [1, 2, 3, 1, 2]
+    assert api.authentications == 1
+    assert hub.tokens == ["token-1", "token-1", "token-1", "token-2", "token-2"]
+    assert len(hub.handshakes) == 1
+
+
+class FakeQueries:
+    # Kavita's chapters per series, served through a real chapter timeline cache
+    def __init__(self, chapters):
+        self.chapters = chapters
+        self.invalidated = []
+        self.chapter_timeline = ChapterTimelineCache(self)
+
+    def get_series_info(self, series_id, verbose=False):
+        if series_id not in self.chapters:
+            return None
+        return {'chapters': [{'id': chapter_id, 'number': str(chapter_id), 'created': f"2024-01-{chapter_id:02d}"}
+                             for chapter_id in self.chapters[series_id]]}
+
+    def invalidate_series(self, series_id):
+        self.invalidated.append(series_id)
+        self.chapter_timeline.invalidate(series_id)
+
+
+class FakeStats:
+    def __init__(self):
+        self.reasons = []
+
+    def invalidate(self, reason):
+        self.reasons.append(reason)
+
+
+class FakeSeriesIndex:
+    def add_series(self, library_id, series_id):
+        pass
+
+
+def make_handler(chapters):
+    kavita = types.SimpleNamespace(name="default", queries=FakeQueries(chapters), stats_snapshot=FakeStats(),
+                                   series_index=FakeSeriesIndex())
+    return KavitaEventHandler(bot=None, kavita=kavita)
+
+
+def test_events_are_debounced(monkeypatch):
+    monkeypatch.setattr(kavita_events, 'event_debounce_seconds', 0.1)
+    handler = make_handler({1: [10, 11], 2: [20]})
+    handler.known_chapters = {1: {10}, 2: {20}}
+    notified = []
+
+    async def notify_subscribers(series_id, new_chapters):
+        notified.append((series_id, [chapter['id'] for chapter in new_chapters]))
+
+    handler.notify_subscribers = notify_subscribers
+
+    async def scenario():
+        # A scan's burst of events, each one restarts the quiet period
+        await handler.on_series_scanned({'seriesId': 1})
+        await asyncio.sleep(0.05)
+        await handler.on_series_added({'libraryId': 3, 'seriesId': 2})
+        await asyncio.sleep(0.05)
+        await handler.on_series_scanned({'seriesId': 1})
+        assert handler.kavita.queries.invalidated == []
+        await asyncio.sleep(0.3)
+
+    asyncio.run(scenario())
+    assert sorted(handler.kavita.queries.invalidated) == [1, 2]
+    assert notified == [(1, [11])]
+    assert handler.kavita.stats_snapshot.reasons == ["2 series updated"]
+
+
+def test_chapter_diffing():
+    chapters = {1: [10, 11], 2: [20], 3: [30]}
+    handler = make_handler(chapters)
+    timeline = handler.kavita.queries.chapter_timeline
+
+    # A tracked series reports what it didn't have, newest first and at most max_notified_chapters
+    handler.known_chapters[1] = {10, 11}
+    chapters[1] += [12, 13, 14, 15]
+    assert [chapter['id'] for chapter in handler.refresh_series(1)] == [15, 14, 13]
+    assert handler.refresh_series(1) == []
+
+    # Never looked at before: the first refresh only sets the baseline
+    assert handler.refresh_series(2) == []
+    assert handler.known_chapters[2] == {20}
+
+    # Not tracked, but its timeline was fetched before the change, so the new chapter is still caught
+    timeline.timeline(3)
+    chapters[3].append(31)
+    assert [chapter['id'] for chapter in handler.refresh_series(3)] == [31]
+
+
+def test_subscribing_tracks_the_series():
+    chapters = {4: [40]}
+    handler = make_handler(chapters)
+
+    async def subscribe():
+        handler.track(4)
+        await asyncio.gather(*handler._tracking_tasks)
+
+    asyncio.run(subscribe())
+    assert handler.known_chapters[4] == {40}
+    # Drop the timeline so only the seeded chapters can tell the new one apart
+    handler.kavita.queries.chapter_timeline.invalidate(4)
+    chapters[4].append(41)
+    assert [chapter['id'] for chapter in handler.refresh_series(4)] == [41]
+
+
+def test_long_scans_flush_within_the_max_wait(monkeypatch):
+    monkeypatch.setattr(kavita_events, 'event_debounce_seconds', 0.1)
+    monkeypatch.setattr(kavita_events, 'event_max_wait_seconds', 0.25)
+    handler = make_handler({series_id: [series_id * 10] for series_id in range(20)})
+
+    async def scenario():
+        # Events keep coming faster than the quiet period, for well past the max wait
+        for series_id in range(12):
+            await handler.on_series_scanned({'seriesId': series_id})
+            await asyncio.sleep(0.05)
+        flushed_during_scan = len(handler.kavita.stats_snapshot.reasons)
+        await asyncio.sleep(0.3)
+        return flushed_during_scan
+
+    assert asyncio.run(scenario()) >= 1
+    assert sorted(handler.kavita.queries.invalidated) == list(range(12))
@@ -0,0 +1,36 @@
+import time
+import asyncio
+import types
+from utilities.loop_watchdog import LoopWatchdog
+
+
+def block(seconds):
+    time.sleep(seconds)
+
+
+def test_short_blocks_dont_take_the_next_stall(tmp_path):
+    watchdog = LoopWatchdog(threshold=0.3, metrics_path=str(tmp_path / "stalls.json"))
+
+    async def scenario():
+        watchdog.start()
+        await asyncio.sleep(0.2)
+        watchdog.command_started(types.SimpleNamespace(id=1, command=types.SimpleNamespace(qualified_name="short"),
+                                                       user="reader"))
+        # Just under the threshold: no stall, and nothing left behind for the next one
+        block(0.25)
+        await asyncio.sleep(0.3)
+        watchdog.command_finished(types.SimpleNamespace(id=1))
+        assert watchdog.stalls == 0
+        assert watchdog._capture is None
+
+        watchdog.command_started(types.SimpleNamespace(id=2, command=types.SimpleNamespace(qualified_name="slow"),
+                                                       user="reader"))
+        block(0.6)
+        await asyncio.sleep(0.3)
+        watchdog.stop()
+
+    asyncio.run(scenario())
+    assert watchdog.stalls == 1
+    hotspot = watchdog.metrics()['hotspots'][0]
+    assert hotspot['hotspot'].endswith("block")
+    assert hotspot['last_command'] == "/slow by reader"
@@ -0,0 +1,64 @@
+import types
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import utilities.render_workers as render_workers
+from utilities.render_workers import RenderWorkers
+
+
+class FakeQueries:
+    def __init__(self):
+        self.invalidation_listeners = []
+        self.invalidated = []
+        self.forgotten = 0
+
+    def invalidate_series(self, series_id):
+        self.invalidated.append(series_id)
+
+    def forget_local_caches(self):
+        self.forgotten += 1
+
+    def stale_notice(self):
+        return None
+
+
+def test_workers_get_only_new_invalidations(monkeypatch):
+    gateway, worker = FakeQueries(), FakeQueries()
+    monkeypatch.setattr(render_workers, '_worker_queries', {'default': worker})
+    monkeypatch.setattr(render_workers, '_applied_invalidation', 0)
+    monkeypatch.setitem(render_workers.render_tasks, 'echo', lambda queries, value: value)
+    server = types.SimpleNamespace(name='default', queries=gateway)
+    workers = RenderWorkers({'default': server}, workers=1)
+    # Threads stand in for the worker process, the module globals play its state
+    workers._executor = ThreadPoolExecutor(max_workers=1)
+
+    def notify(series_id):
+        for listener in gateway.invalidation_listeners:
+            listener("series", (series_id,))
+
+    async def scenario():
+        notify(1)
+        notify(2)
+        assert workers._invalidations_to_send() == ((1, 'default', 'series', (1,)), (2, 'default', 'series', (2,)))
+        assert await workers.render(server, 'echo', "page") == ("page", None)
+        assert worker.invalidated == [1, 2]
+        # Up to date: only the newest entry goes along, and it's not applied twice
+        assert workers._invalidations_to_send() == ((2, 'default', 'series', (2,)),)
+        notify(3)
+        assert [entry[0] for entry in workers._invalidations_to_send()] == [3]
+        await workers.render(server, 'echo', "page")
+        assert worker.invalidated == [1, 2, 3]
+        assert worker.forgotten == 0
+
+    asyncio.run(scenario())
+    workers.shutdown()
+
+
+def test_worker_behind_drops_its_caches(monkeypatch):
+    worker = FakeQueries()
+    monkeypatch.setattr(render_workers, '_worker_queries', {'default': worker})
+    monkeypatch.setattr(render_workers, '_applied_invalidation', 3)
+    # The log only goes back to 8, this worker missed 4 to 7
+    render_workers._apply_invalidations(((8, 'default', 'series', (8,)),))
+    assert worker.forgotten == 1
+    assert worker.invalidated == [8]
+    assert render_workers._applied_invalidation == 8
@@ -0,0 +1,56 @@
+import utilities.series_index as series_index
+from utilities.series_index import SeriesIndex
+
+
+class FakeQueries:
+    # One library, series listed newest first like Kavita's listing endpoint
+    def __init__(self, series_ids):
+        self.series_ids = series_ids
+        self.most_read = {}
+        self.pages_listed = 0
+
+    def get_libraries(self):
+        return [{'id': 1, 'name': "Manga"}]
+
+    def get_server_stats(self):
+        return {'mostReadSeries': [{'value': {'id': series_id}, 'count': count}
+                                   for series_id, count in self.most_read.items()]}
+
+    def get_library_series_page(self, library_id, page, page_size):
+        self.pages_listed += 1
+        start = (page - 1) * page_size
+        return [{'id': series_id} for series_id in self.series_ids[start:start + page_size]]
+
+
+def test_incremental_refresh(monkeypatch):
+    monkeypatch.setattr(series_index, 'listing_page_size', 2)
+    queries = FakeQueries([5, 4, 3, 2, 1])
+    queries.most_read = {3: 9}
+    index = SeriesIndex(queries)
+    assert index.refresh()
+    library = index.library("manga")
+    assert sorted(library.series_ids) == [1, 2, 3, 4, 5]
+    assert library.weights[library.positions[3]] == 10.0
+
+    # New series show up on the first page, the listing stops at the first page it already knows
+    queries.series_ids = [7, 6] + queries.series_ids
+    queries.most_read = {1: 4}
+    queries.pages_listed = 0
+    assert index.refresh()
+    assert index.library(1) is library
+    assert sorted(library.series_ids) == [1, 2, 3, 4, 5, 6, 7]
+    assert queries.pages_listed == 2
+    # Weights follow the read counts for series that were already indexed
+    assert library.weights[library.positions[1]] == 5.0
+    assert library.weights[library.positions[3]] == 1.0
+    assert all(index.sample(1, weighted=True) in library for _ in range(20))
+
+
+def test_failed_listing_keeps_the_index(monkeypatch):
+    queries = FakeQueries([2, 1])
+    index = SeriesIndex(queries)
+    index.refresh()
+    monkeypatch.setattr(queries, 'get_library_series_page', lambda *args: None)
+    index.last_full_refresh = 0
+    assert index.refresh()
+    assert sorted(index.library(1).series_ids) == [1, 2]
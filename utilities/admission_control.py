@@ -0,0 +1,197 @@
+import json
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Fallback limits for commands that aren't listed in the limits file
+default_command_limits = {
+    "user_rate": 0.1,  # Tokens regained per second
+    "user_burst": 3,  # Bucket size, i.e. how many calls can be made back to back
+    "guild_rate": 0.5,
+    "guild_burst": 8
+}
+
+# Drop idle buckets once we are tracking this many of them
+max_tracked_buckets = 2048
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, tokens: int = 1):
+        # Returns 0 if the tokens were taken, otherwise the seconds until they would be available
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (tokens - self.tokens) / self.rate
+
+    def refund(self, tokens: int = 1):
+        self.tokens = min(self.burst, self.tokens + tokens)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class AdmissionControl:
+    def __init__(self, config_path='assets/subscriptions/command_limits.json'):
+        self.max_concurrent = 4
+        self.max_queue = 12
+        self.command_limits = {}
+        self.user_buckets = {}
+        self.guild_buckets = {}
+        # Number of expensive commands currently running and the FIFO of commands waiting for a slot
+        self.active = 0
+        self.waiters = deque()
+        self.load_limits(config_path)
+
+    def load_limits(self, config_path):
+        # Load per command limits from file, keeping the defaults if the file is missing or broken
+        try:
+            with open(config_path, 'r') as file:
+                config = json.load(file)
+            self.max_concurrent = int(config.get('max_concurrent', self.max_concurrent))
+            self.max_queue = int(config.get('max_queue', self.max_queue))
+            self.command_limits = config.get('commands', {})
+            logger.info(f"Loaded admission limits for {len(self.command_limits)} commands "
+                        f"(max concurrent: {self.max_concurrent}, max queue: {self.max_queue}).")
+        except Exception as e:
+            logger.error(f"Failed to load command limits, using defaults: {e}")
+
+    def limits_for(self, command_name):
+        limits = dict(default_command_limits)
+        limits.update(self.command_limits.get(command_name, {}))
+        return limits
+
+    def _bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= max_tracked_buckets:
+                # Forget buckets that have fully refilled, they behave the same as a brand new bucket
+                for stale_key in [k for k, b in buckets.items() if b.is_full()]:
+                    del buckets[stale_key]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def check_rate(self, command_name, user_id, guild_id=None):
+        # Returns 0 if the call is allowed, otherwise how many seconds the caller should wait
+        limits = self.limits_for(command_name)
+        user_bucket = self._bucket(self.user_buckets, (command_name, user_id),
+                                   limits['user_rate'], limits['user_burst'])
+        retry_after = user_bucket.try_consume()
+        if retry_after:
+            return retry_after
+
+        if guild_id is not None:
+            guild_bucket = self._bucket(self.guild_buckets, (command_name, guild_id),
+                                        limits['guild_rate'], limits['guild_burst'])
+            retry_after = guild_bucket.try_consume()
+            if retry_after:
+                # Don't charge the user for a call the guild limit rejected
+                user_bucket.refund()
+                return retry_after
+        return 0.0
+
+    def refund(self, command_name, user_id, guild_id=None):
+        # Give back the tokens for a call that was admitted by the rate limits but never ran
+        if (command_name, user_id) in self.user_buckets:
+            self.user_buckets[(command_name, user_id)].refund()
+        if (command_name, guild_id) in self.guild_buckets:
+            self.guild_buckets[(command_name, guild_id)].refund()
+
+    async def _acquire(self, on_queued=None):
+        # Take a free slot right away if nobody is waiting ahead of us
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return True
+
+        # Shed the load if the queue is already full
+        if len(self.waiters) >= self.max_queue:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            if on_queued:
+                await on_queued(len(self.waiters))
+            # The releasing command hands its slot directly to us
+            await waiter
+            return True
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # We were handed a slot but won't use it, pass it on
+                self._release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    @staticmethod
+    async def _reply(interaction, message: str):
+        if interaction.response.is_done():
+            await interaction.followup.send(message, ephemeral=True)
+        else:
+            await interaction.response.send_message(message, ephemeral=True)
+
+    async def admit_rate(self, interaction, command_name: str):
+        # Rate limit the user and guild, telling the user when to try again. Returns whether the call may go ahead
+        retry_after = self.check_rate(command_name, interaction.user.id, interaction.guild_id)
+        if retry_after:
+            logger.warning(f"User {interaction.user} is rate limited on /{command_name} "
+                           f"for {retry_after:.0f} more seconds.")
+            await self._reply(interaction, f"You're using `/{command_name}` too quickly, please try again "
+                                           f"in {max(1, round(retry_after))} seconds.")
+            return False
+        return True
+
+    @asynccontextmanager
+    async def slot(self, interaction, command_name: str, defer: bool = True):
+        # Rate limit the user and guild first, these are cheap and don't need a queue slot
+        if not await self.admit_rate(interaction, command_name):
+            yield False
+            return
+
+        async def notify_queued(position):
+            logger.info(f"/{command_name} from {interaction.user} queued at position {position}.")
+            await self._reply(interaction, f"The bot is busy right now, your `/{command_name}` request is "
+                                           f"number {position} in the queue...")
+
+        if not await self._acquire(on_queued=notify_queued):
+            logger.warning(f"Queue full, shedding /{command_name} from {interaction.user}.")
+            self.refund(command_name, interaction.user.id, interaction.guild_id)
+            await self._reply(interaction, "The bot is too busy to take this request right now, "
+                                           "please try again in a minute.")
+            yield False
+            return
+
+        try:
+            # Acknowledge the interaction now that we have a slot (a queued request already has a response)
+            if defer and not interaction.response.is_done():
+                await interaction.response.defer()
+            yield True
+        finally:
+            self._release()
@@ -0,0 +1,53 @@
+import utilities.logging_config as logging_config
+from kavita_api import shared_http_session
+from api.kavita_query.kavita_server import KavitaServer
+from api.kavita_query.kavita_federation import KavitaFederation
+from utilities.image_pipeline import shared_cover_pipeline
+from utilities.render_workers import RenderWorkers
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+
+class AppContext:
+    # What commands, jobs and cogs share: one HTTP connection pool, one login per Kavita server (with that server's
+    # response cache and embed renderer), the federation across servers and the render workers
+    def __init__(self, guild_configs):
+        self.guild_configs = guild_configs
+        self.http_session = shared_http_session()
+        self.kavita_servers = {"default": KavitaServer(session=self.http_session)}
+        for name, server in guild_configs.kavita_servers.items():
+            self.kavita_servers[name] = KavitaServer(name, server_url=server['opds_url'],
+                                                     server_address=server['base_url'], session=self.http_session)
+        # Queries across every Kavita server at once, for federated guilds and origin tagged series ids
+        self.federation = KavitaFederation(self.kavita_servers)
+        # Kavita fetching and embed rendering, in worker processes when BNU_RENDER_WORKERS is set
+        self.render_workers = RenderWorkers(self.kavita_servers)
+
+    @property
+    def default(self):
+        # The kavita_config server, used wherever there's no guild to route by
+        return self.kavita_servers["default"]
+
+    def start_workers(self):
+        # Fork the worker processes before the bot starts threads of its own
+        self.render_workers.start()
+        shared_cover_pipeline().start()
+
+    def authenticate(self):
+        for server in self.kavita_servers.values():
+            server.authenticate()
+
+    def kavita_for(self, guild_id):
+        # The Kavita server a guild is configured to use
+        return self.kavita_servers[self.guild_configs.get(guild_id).kavita_server]
+
+    def federation_for(self, guild_id):
+        # The federation if the guild searches every Kavita server, else None
+        return self.federation if self.guild_configs.get(guild_id).federated else None
+
+    def shutdown(self):
+        shared_cover_pipeline().shutdown()  # Stop the cover transcoding workers
+        self.render_workers.shutdown()
+        self.federation.shutdown()
+        self.http_session.close()
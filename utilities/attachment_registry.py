@@ -0,0 +1,166 @@
+import time
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import urlparse, parse_qs
+import discord
+import utilities.logging_config as logging_config
+from utilities.send_scheduler import shared_send_scheduler, message_route, priority_interactive
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Discord's signed CDN links carry their expiry (hex unix time) in the "ex" parameter,
+# stop reusing a link this long before it runs out
+url_expiry_margin = 3600
+# How long to trust a link without an expiry
+url_default_lifetime = 12 * 3600
+registry_max_entries = 2048
+
+
+@lru_cache(maxsize=None)
+def _asset_bytes(path: str):
+    with open(path, 'rb') as asset:
+        return asset.read()
+
+
+def asset_file(path: str, filename: str):
+    # A bundled image as a discord.File, read from disk once per process
+    return discord.File(BytesIO(_asset_bytes(path)), filename=filename)
+
+
+def url_expiry(url: str):
+    expires = parse_qs(urlparse(url).query).get('ex')
+    if expires:
+        try:
+            return int(expires[0], 16)
+        except ValueError:
+            pass
+    return time.time() + url_default_lifetime
+
+
+def attachment_key(file: discord.File):
+    # The file name carries the asset or cover id, the hash tells a changed cover apart
+    data = file.fp.read()
+    file.reset()
+    return f"{file.filename}:{hashlib.sha1(data).hexdigest()}"
+
+
+def replace_attachment_url(embeds, filename: str, url: str):
+    # Point every embed image that uses the attachment at url instead, returns whether any did
+    attachment_url = f"attachment://{filename}"
+    replaced = False
+    for embed in embeds:
+        if embed.image.url == attachment_url:
+            embed.set_image(url=url)
+            replaced = True
+        if embed.thumbnail.url == attachment_url:
+            embed.set_thumbnail(url=url)
+            replaced = True
+    return replaced
+
+
+class AttachmentRegistry:
+    def __init__(self, max_entries: int = registry_max_entries):
+        self.max_entries = max_entries
+        # attachment key -> (CDN url, expiry)
+        self.urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key: str):
+        with self._lock:
+            entry = self.urls.get(key)
+            if not entry:
+                return None
+            url, expires = entry
+            if expires - url_expiry_margin <= time.time():
+                # Expired (or about to), the next send uploads the image again
+                del self.urls[key]
+                return None
+            self.urls.move_to_end(key)
+            return url
+
+    def store(self, key: str, url: str):
+        with self._lock:
+            self.urls[key] = (url, url_expiry(url))
+            self.urls.move_to_end(key)
+            while len(self.urls) > self.max_entries:
+                self.urls.popitem(last=False)
+
+    def forget(self, attachments):
+        # Attachments an edit is dropping, Discord deletes them so their links stop working.
+        # Compared by path, the signature in the query changes every time Discord hands out a link
+        paths = {urlparse(attachment.url).path for attachment in attachments or []}
+        if not paths:
+            return
+        with self._lock:
+            for key in [key for key, (url, _) in self.urls.items() if urlparse(url).path in paths]:
+                del self.urls[key]
+
+    def prepare(self, embeds, files):
+        # Swap attachments we've already uploaded for their CDN links.
+        # Returns the files that still need uploading and their keys by file name, for remember()
+        upload, pending = [], {}
+        for file in files or []:
+            if file is None:
+                continue
+            key = attachment_key(file)
+            url = self.lookup(key)
+            # Only images shown by an embed can be swapped, plain attachments are always uploaded
+            if url and replace_attachment_url(embeds, file.filename, url):
+                file.close()
+                continue
+            upload.append(file)
+            pending[file.filename] = key
+        return upload, pending
+
+    def remember(self, message, pending):
+        # Record the CDN links Discord gave the files we just uploaded. Only for messages whose attachments stay put,
+        # an edit that replaces them deletes the uploads
+        if not message or not pending:
+            return
+        for attachment in message.attachments:
+            key = pending.get(attachment.filename)
+            if key:
+                self.store(key, attachment.url)
+
+
+# Shared by everything that sends embeds, a CDN link works in any channel or DM
+_shared_registry = None
+
+
+def shared_attachment_registry():
+    global _shared_registry
+    if _shared_registry is None:
+        _shared_registry = AttachmentRegistry()
+    return _shared_registry
+
+
+async def send_embeds(send, embeds, files=None, priority: int = priority_interactive, remember: bool = True,
+                      **kwargs):
+    # send is channel.send, user.send or followup.send (with wait=True), only new images are uploaded.
+    # The send waits its turn in the send scheduler, routed by the channel or user send is bound to.
+    # Pass remember=False for messages that will be edited with other attachments, their uploads won't last
+    registry = shared_attachment_registry()
+    files, pending = registry.prepare(embeds, files)
+    async with shared_send_scheduler().turn(priority, message_route(getattr(send, '__self__', None))):
+        message = await send(embeds=embeds, files=files, **kwargs)
+    if remember and not kwargs.get('ephemeral'):
+        registry.remember(message, pending)
+    return message
+
+
+async def respond_embeds(interaction: discord.Interaction, embeds, files=None, **kwargs):
+    # Same as send_embeds() for the first response to an interaction
+    registry = shared_attachment_registry()
+    files, pending = registry.prepare(embeds, files)
+    await interaction.response.send_message(embeds=embeds, files=files, **kwargs)
+    # Ephemeral messages go away with the interaction, their links aren't worth keeping
+    if pending and not kwargs.get('ephemeral'):
+        # The response doesn't come back with the message, fetch it only when there are links to learn
+        try:
+            registry.remember(await interaction.original_response(), pending)
+        except discord.HTTPException as e:
+            logger.info(f"Unable to record attachment links for the response to {interaction.user}: {e}")
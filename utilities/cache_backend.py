@@ -0,0 +1,414 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import socket
+import struct
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Payloads bigger than this are compressed, if compressing actually makes them smaller
+compress_threshold = 1024
+# How long a cache fill may hold its lock, and how long other callers wait on it before loading themselves
+fill_lock_seconds = 10
+fill_wait_seconds = 5
+
+# Entry header: value kind and the time it was stored
+entry_header = struct.Struct('!cd')
+kind_json, kind_json_zlib, kind_bytes, kind_bytes_zlib = b'j', b'J', b'b', b'B'
+
+
+def encode_entry(value, stored_at=None):
+    # JSON values and raw bytes (covers) are stored as-is, no pickling so a shared cache can't run code
+    if isinstance(value, (bytes, bytearray)):
+        kind, compressed_kind, body = kind_bytes, kind_bytes_zlib, bytes(value)
+    else:
+        kind, compressed_kind, body = kind_json, kind_json_zlib, json.dumps(value, separators=(',', ':')).encode()
+    if len(body) > compress_threshold:
+        compressed = zlib.compress(body, 6)
+        # Covers are already compressed images, only keep the zlib copy if it saves a real amount
+        if len(compressed) < len(body) * 0.9:
+            kind, body = compressed_kind, compressed
+    return entry_header.pack(kind, stored_at or time.time()) + body
+
+
+def decode_entry(data):
+    # Returns (value, stored_at)
+    kind, stored_at = entry_header.unpack_from(data)
+    body = data[entry_header.size:]
+    if kind in (kind_json_zlib, kind_bytes_zlib):
+        body = zlib.decompress(body)
+    if kind in (kind_json, kind_json_zlib):
+        return json.loads(body), stored_at
+    return body, stored_at
+
+
+class Fill:
+    # One in-process load of a key, the threads asking for the same key meanwhile wait for its result
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class CacheBackend:
+    name = "base"
+
+    def __init__(self, namespace: str = "bnu"):
+        self.namespace = namespace
+        # Keys being loaded by a thread of this process, so the others wait for that load rather than repeat it
+        self._fills = {}
+        self._fills_lock = threading.Lock()
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    # Storage primitives, implemented by each backend
+    def _get_raw(self, key):
+        raise NotImplementedError
+
+    def _set_raw(self, key, data: bytes, ttl: float):
+        raise NotImplementedError
+
+    def _delete_raw(self, key):
+        raise NotImplementedError
+
+    def _add_raw(self, key, data: bytes, ttl: float):
+        # Set only if the key doesn't exist, returns True if it was set
+        raise NotImplementedError
+
+    def get_entry(self, key):
+        # Returns (value, stored_at) or None, a broken cache is treated as a miss
+        try:
+            data = self._get_raw(self._key(key))
+            return decode_entry(data) if data else None
+        except Exception as e:
+            logger.error(f"{self.name} cache read failed for {key}: {e}")
+            return None
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def set(self, key, value, ttl: float):
+        try:
+            self._set_raw(self._key(key), encode_entry(value), ttl)
+        except Exception as e:
+            logger.error(f"{self.name} cache write failed for {key}: {e}")
+
+    def delete(self, key):
+        try:
+            self._delete_raw(self._key(key))
+        except Exception as e:
+            logger.error(f"{self.name} cache delete failed for {key}: {e}")
+
+    def _acquire_fill(self, key, token):
+        try:
+            return self._add_raw(self._key(f"fill-lock:{key}"), token.encode(), fill_lock_seconds)
+        except Exception as e:
+            logger.error(f"{self.name} cache lock failed for {key}: {e}")
+            # Without a working lock every caller just loads for itself
+            return True
+
+    def _release_fill(self, key, token):
+        lock_key = self._key(f"fill-lock:{key}")
+        try:
+            # Only drop the lock if it is still ours, it may have expired and been taken by someone else
+            if self._get_raw(lock_key) == token.encode():
+                self._delete_raw(lock_key)
+        except Exception as e:
+            logger.error(f"{self.name} cache unlock failed for {key}: {e}")
+
+    def get_or_load(self, key, max_age: float, loader, ttl: float = None):
+        # Returns the cached value if it is younger than max_age, otherwise calls loader() -> (value, cacheable).
+        # Only one caller across threads and replicas loads a key at a time, the rest wait for its result.
+        # Entries are kept for ttl (default max_age) so older copies stay around as a stale fallback
+        entry = self.get_entry(key)
+        if entry and time.time() - entry[1] < max_age:
+            return entry[0]
+
+        with self._fills_lock:
+            fill = self._fills.get(key)
+            leading = fill is None
+            if leading:
+                fill = self._fills[key] = Fill()
+        if not leading:
+            fill.done.wait()
+            if not fill.failed:
+                return fill.value
+            # The load raised, try for ourselves rather than hand its error to every waiter
+            return self._load(key, max_age, loader, ttl)
+
+        try:
+            fill.value = self._load(key, max_age, loader, ttl)
+            return fill.value
+        except BaseException:
+            fill.failed = True
+            raise
+        finally:
+            with self._fills_lock:
+                del self._fills[key]
+            fill.done.set()
+
+    def _load(self, key, max_age: float, loader, ttl: float = None):
+        # Another thread may have filled it just before we started
+        entry = self.get_entry(key)
+        if entry and time.time() - entry[1] < max_age:
+            return entry[0]
+
+        token = uuid.uuid4().hex
+        if not self._acquire_fill(key, token):
+            # Another replica is loading this key, wait a moment for it to land
+            deadline = time.time() + fill_wait_seconds
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = self.get_entry(key)
+                if entry and time.time() - entry[1] < max_age:
+                    return entry[0]
+            token = None
+
+        try:
+            value, cacheable = loader()
+            if cacheable and value is not None:
+                self.set(key, value, ttl or max_age)
+            return value
+        finally:
+            if token:
+                self._release_fill(key, token)
+
+
+class MemoryCache(CacheBackend):
+    name = "memory"
+
+    def __init__(self, namespace: str = "bnu", max_entries: int = 2048, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__(namespace)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (encoded entry, expires at), in least recently used order
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _get_raw(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at < time.time():
+                self._pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return data
+
+    def _pop(self, key):
+        data, _ = self.entries.pop(key)
+        self.total_bytes -= len(data)
+
+    def _set_raw(self, key, data, ttl):
+        with self._lock:
+            if key in self.entries:
+                self._pop(key)
+            self.entries[key] = (data, time.time() + ttl)
+            self.total_bytes += len(data)
+            while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                self._pop(next(iter(self.entries)))
+
+    def _delete_raw(self, key):
+        with self._lock:
+            if key in self.entries:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _add_raw(self, key, data, ttl):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] >= time.time():
+                return False
+        self._set_raw(key, data, ttl)
+        return True
+
+
+class SQLiteCache(CacheBackend):
+    name = "sqlite"
+
+    def __init__(self, namespace: str = "bnu", path: str = 'assets/cache/kavita_cache.sqlite3'):
+        super().__init__(namespace)
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # One connection shared by our threads, WAL lets other processes on the host read while we write
+        self.connection = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)")
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _get_raw(self, key):
+        with self._lock:
+            row = self.connection.execute("SELECT value FROM cache WHERE key = ? AND expires_at >= ?",
+                                          (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _set_raw(self, key, data, ttl):
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                                    (key, data, time.time() + ttl))
+            # Sweep expired rows now and then so the file doesn't grow forever
+            self._writes += 1
+            if self._writes % 500 == 0:
+                self.connection.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+
+    def _delete_raw(self, key):
+        with self._lock:
+            self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _add_raw(self, key, data, ttl):
+        with self._lock:
+            now = time.time()
+            self.connection.execute("DELETE FROM cache WHERE key = ? AND expires_at < ?", (key, now))
+            cursor = self.connection.execute("INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                                             (key, data, now + ttl))
+            return cursor.rowcount == 1
+
+
+class RespError(Exception):
+    pass
+
+
+class RespConnection:
+    # Just enough of the Redis protocol (RESP2) for a cache: send commands, read the replies
+    def __init__(self, host: str = "localhost", port: int = 6379, password: str = None, db: int = 0,
+                 timeout: float = 2.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.reader = self.sock.makefile('rb')
+        if self.password:
+            self._send('AUTH', self.password)
+        if self.db:
+            self._send('SELECT', self.db)
+
+    def close(self):
+        if self.sock:
+            try:
+                self.reader.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.reader = None
+
+    @staticmethod
+    def encode_command(*args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, (bytes, bytearray)):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the cache server")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b'+':
+            return rest.decode()
+        if prefix == b'-':
+            raise RespError(rest.decode())
+        if prefix == b':':
+            return int(rest)
+        if prefix == b'$':
+            length = int(rest)
+            if length == -1:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            count = int(rest)
+            if count == -1:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise RespError(f"Unexpected reply from the cache server: {line!r}")
+
+    def _send(self, *args):
+        self.sock.sendall(self.encode_command(*args))
+        return self._read_reply()
+
+    def command(self, *args):
+        # Reconnect once if the connection dropped since the last command
+        if self.sock is None:
+            self.connect()
+        try:
+            return self._send(*args)
+        except (OSError, ConnectionError):
+            self.close()
+            self.connect()
+            return self._send(*args)
+
+
+class RedisCache(CacheBackend):
+    name = "redis"
+
+    def __init__(self, namespace: str = "bnu", url: str = "redis://localhost:6379/0"):
+        super().__init__(namespace)
+        parsed = urlparse(url)
+        self.connection = RespConnection(host=parsed.hostname or "localhost", port=parsed.port or 6379,
+                                         password=unquote(parsed.password) if parsed.password else None,
+                                         db=int(parsed.path.strip('/') or 0))
+        # RESP is strictly request/reply, so our threads take turns on the one connection
+        self._lock = threading.Lock()
+
+    def _command(self, *args):
+        with self._lock:
+            return self.connection.command(*args)
+
+    def _get_raw(self, key):
+        return self._command('GET', key)
+
+    def _set_raw(self, key, data, ttl):
+        self._command('SET', key, data, 'PX', int(ttl * 1000))
+
+    def _delete_raw(self, key):
+        self._command('DEL', key)
+
+    def _add_raw(self, key, data, ttl):
+        return self._command('SET', key, data, 'NX', 'PX', int(ttl * 1000)) is not None
+
+
+def cache_from_env(namespace: str = "bnu"):
+    # BNU_CACHE_BACKEND picks memory (default), sqlite or redis, BNU_CACHE_URL is the SQLite path or Redis URL
+    backend = os.environ.get('BNU_CACHE_BACKEND', 'memory').lower()
+    url = os.environ.get('BNU_CACHE_URL')
+    try:
+        if backend == 'sqlite':
+            return SQLiteCache(namespace, path=url) if url else SQLiteCache(namespace)
+        if backend == 'redis':
+            cache = RedisCache(namespace, url=url) if url else RedisCache(namespace)
+            cache.connection.command('PING')
+            return cache
+        if backend != 'memory':
+            logger.error(f"Unknown cache backend '{backend}', using the in-process cache.")
+    except Exception as e:
+        logger.error(f"Unable to start the {backend} cache backend, using the in-process cache: {e}")
+    return MemoryCache(namespace)
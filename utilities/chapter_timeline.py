@@ -0,0 +1,162 @@
+import time
+import heapq
+import threading
+from operator import attrgetter
+from collections import OrderedDict
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Reload a timeline from scratch after this long, in case chapters were removed or re-scanned
+timeline_ttl_hours = 6
+# Number of series timelines kept in memory
+max_cached_series = 1024
+
+
+class ChapterEntry:
+    __slots__ = ('id', 'number', 'title', 'title_name', 'created', 'pages', 'volume', 'release_date')
+
+    def __init__(self, chapter_id, number, title, title_name, created, pages, volume, release_date):
+        self.id = chapter_id
+        self.number = number
+        self.title = title
+        self.title_name = title_name
+        self.created = created
+        self.pages = pages
+        self.volume = volume
+        self.release_date = release_date
+
+    @classmethod
+    def from_dto(cls, chapter):
+        # Keep only the fields the chapter embeds use from Kavita's (much larger) chapter DTO
+        return cls(chapter['id'], chapter.get('number') or chapter.get('range'), chapter.get('title'),
+                   chapter.get('titleName'), chapter.get('created') or '', chapter.get('pages'),
+                   chapter.get('volumeTitle'), chapter.get('releaseDate'))
+
+    def as_chapter_info(self):
+        # The subset of the chapter DTO that EmbedBuilder.build_chapter_embed reads
+        return {
+            'id': self.id,
+            'number': self.number,
+            'title': self.title,
+            'titleName': self.title_name,
+            'created': self.created,
+            'pages': self.pages,
+            'volumeTitle': self.volume,
+            'releaseDate': self.release_date
+        }
+
+
+class ChapterTimeline:
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.chapter_ids = {entry.id for entry in self.entries}
+        self.loaded_at = time.time()
+
+    def add(self, entry):
+        if entry.id in self.chapter_ids:
+            return False
+        self.entries.append(entry)
+        self.chapter_ids.add(entry.id)
+        return True
+
+    def latest(self, count: int):
+        # Partial selection, no need to sort every chapter of a long running series to get a few
+        return heapq.nlargest(count, self.entries, key=attrgetter('created'))
+
+
+class ChapterTimelineCache:
+    def __init__(self, kavita_queries):
+        self.kavita_queries = kavita_queries
+        self.timelines = OrderedDict()
+        # (series id, chapter id) being fetched in the background
+        self.pending = set()
+        self._lock = threading.Lock()
+
+    def _cached(self, series_id):
+        with self._lock:
+            timeline = self.timelines.get(series_id)
+            if timeline and time.time() - timeline.loaded_at < timeline_ttl_hours * 3600:
+                self.timelines.move_to_end(series_id)
+                return timeline
+            return None
+
+    def _load(self, series_id):
+        # The one place we pull the full series detail, it's parsed once into compact entries
+        detailed_info = self.kavita_queries.get_series_info(series_id=series_id, verbose=True)
+        if not detailed_info or 'chapters' not in detailed_info:
+            return None
+
+        timeline = ChapterTimeline(ChapterEntry.from_dto(chapter) for chapter in detailed_info['chapters']
+                                   if 'id' in chapter)
+        with self._lock:
+            self.timelines[series_id] = timeline
+            while len(self.timelines) > max_cached_series:
+                self.timelines.popitem(last=False)
+        logger.info(f"Loaded chapter timeline for series {series_id} with {len(timeline.entries)} chapters.")
+        return timeline
+
+    def timeline(self, series_id):
+        return self._cached(series_id) or self._load(series_id)
+
+    def cached_chapter_ids(self, series_id):
+        # Chapter ids of the timeline we hold for the series, however old, without fetching anything
+        with self._lock:
+            timeline = self.timelines.get(series_id)
+            return set(timeline.chapter_ids) if timeline else None
+
+    def recent(self, series_id, count: int = 3):
+        # Returns chapter info dicts for the most recently added chapters, newest first
+        timeline = self.timeline(series_id)
+        if timeline is None:
+            return None
+        return [entry.as_chapter_info() for entry in timeline.latest(count)]
+
+    def add_chapter(self, series_id, chapter):
+        # Fold a newly added chapter into a cached timeline, returns False if there was nothing to update
+        with self._lock:
+            timeline = self.timelines.get(series_id)
+            if timeline is None:
+                return False
+            return timeline.add(ChapterEntry.from_dto(chapter))
+
+    def note_chapter_added(self, series_id, chapter_id):
+        # Only fetch the single chapter if we are holding a timeline that doesn't have it yet
+        with self._lock:
+            timeline = self.timelines.get(series_id)
+            if timeline is None or chapter_id in timeline.chapter_ids:
+                return
+        chapter = self.kavita_queries.get_chapter_info(chapter_id)
+        if chapter and self.add_chapter(series_id, chapter):
+            logger.info(f"Added chapter {chapter_id} to the cached timeline for series {series_id}.")
+
+    def note_recently_updated(self, updated_series):
+        # Only checks what's missing here, the chapters are fetched on the bulk pool so listings don't wait on them
+        missing = []
+        with self._lock:
+            for series in updated_series or []:
+                key = (series.get('seriesId'), series.get('chapterId'))
+                timeline = self.timelines.get(key[0])
+                if timeline and key[1] and key[1] not in timeline.chapter_ids and key not in self.pending:
+                    self.pending.add(key)
+                    missing.append(key)
+        for series_id, chapter_id in missing:
+            self.kavita_queries.bulk_pool.submit(self._fetch_added, series_id, chapter_id)
+
+    def _fetch_added(self, series_id, chapter_id):
+        try:
+            self.note_chapter_added(series_id, chapter_id)
+        except Exception as e:
+            logger.error(f"Failed to add chapter {chapter_id} to the timeline for series {series_id}: {e}")
+        finally:
+            with self._lock:
+                self.pending.discard((series_id, chapter_id))
+
+    def invalidate(self, series_id):
+        with self._lock:
+            self.timelines.pop(series_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.timelines.clear()
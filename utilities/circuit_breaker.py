@@ -0,0 +1,115 @@
+import time
+import threading
+from collections import OrderedDict
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Circuit states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let a single trial request through to see if the endpoint is back
+                self.state = HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info(f"Circuit for {self.name} closed, endpoint is responding again.")
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning(f"Circuit for {self.name} opened after {self.failures} failures, "
+                                   f"failing fast for {self.reset_timeout:.0f} seconds.")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def is_open(self):
+        return self.state != CLOSED
+
+
+class CircuitBreakerRegistry:
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_timeout)
+            return self.breakers[name]
+
+    def open_circuits(self):
+        return [name for name, breaker in list(self.breakers.items()) if breaker.is_open()]
+
+    def close_all(self):
+        for breaker in list(self.breakers.values()):
+            if breaker.is_open():
+                breaker.record_success()
+
+
+class LastKnownGoodCache:
+    def __init__(self, max_entries: int = 512, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(payload):
+        # Only binary payloads (covers) are big enough to be worth counting
+        return len(payload) if isinstance(payload, (bytes, bytearray)) else 0
+
+    def put(self, key, payload):
+        with self._lock:
+            if key in self.entries:
+                self.total_bytes -= self._size(self.entries.pop(key)[0])
+            self.entries[key] = (payload, time.time())
+            self.total_bytes += self._size(payload)
+            # Evict the least recently used entries until we are back under both limits
+            while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.total_bytes -= self._size(evicted)
+
+    def get(self, key):
+        # Returns (payload, stored_at) or None
+        with self._lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
@@ -1,13 +1,77 @@
+import time
+import threading
 from email_validator import validate_email, EmailNotValidError
+from email_validator.deliverability import validate_email_deliverability
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# How long a domain's MX lookup is trusted, and the longest a lookup may take
+domain_cache_seconds = 6 * 3600
+dns_timeout = 5
+max_cached_domains = 4096
+
+
+def normalize_email(email: str):
+    # The normalized address, or raises EmailNotValidError. Syntax only, no DNS, so it's cheap on the event loop
+    return validate_email(email.strip(), check_deliverability=False).normalized
+
+
+class EmailChecker:
+    def __init__(self, ttl: int = domain_cache_seconds):
+        self.ttl = ttl
+        # Domain -> (whether it takes mail, why not, expires at)
+        self.domains = {}
+        self._lock = threading.Lock()
+
+    def check(self, email: str):
+        # Returns (normalized address, None) for a deliverable address, otherwise (None, the reason). Blocking
+        try:
+            valid = validate_email(email.strip(), check_deliverability=False)
+        except EmailNotValidError as e:
+            return None, str(e)
+        deliverable, reason = self.domain_deliverable(valid.ascii_domain, valid.domain)
+        return (valid.normalized, None) if deliverable else (None, reason)
+
+    def domain_deliverable(self, ascii_domain: str, domain: str):
+        now = time.time()
+        with self._lock:
+            cached = self.domains.get(ascii_domain)
+        if cached and cached[2] > now:
+            return cached[:2]
+
+        try:
+            info = validate_email_deliverability(ascii_domain, domain, timeout=dns_timeout)
+        except EmailNotValidError as e:
+            result = (False, str(e))
+        else:
+            if info.get('unknown-deliverability'):
+                # The resolver timed out or failed, let the address through and ask again next time
+                logger.warning(f"Unable to check mail servers for {domain}: {info['unknown-deliverability']}")
+                return True, None
+            result = (True, None)
+
+        with self._lock:
+            if len(self.domains) >= max_cached_domains:
+                self.domains = {key: value for key, value in self.domains.items() if value[2] > now}
+            self.domains[ascii_domain] = (*result, now + self.ttl)
+        return result
+
+
+_shared_checker = None
+
+
+def shared_email_checker():
+    global _shared_checker
+    if _shared_checker is None:
+        _shared_checker = EmailChecker()
+    return _shared_checker
 
 
 def is_email_valid(email):
-    try:
-        # Check if the email is valid
-        valid_email = validate_email(email)
-        # Update with the normalized form of the email
-        email = valid_email.normalized
-        return True
-    except EmailNotValidError as e:
-        # Email is not valid, return false
-        return e
+    # Whether the address is well formed and its domain takes mail, with the domain lookups cached
+    normalized, reason = shared_email_checker().check(email)
+    if not normalized:
+        logger.info(f"Rejected email address {email}: {reason}")
+    return normalized is not None
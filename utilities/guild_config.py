@@ -0,0 +1,75 @@
+import json
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+
+class GuildSettings:
+    def __init__(self, guild_id: int, kavita_server: str = "default", channels: dict = None, jobs: list = None,
+                 subscription_namespace: str = None, federated: bool = False):
+        self.guild_id = int(guild_id)
+        # Name of the Kavita server (from the "kavita_servers" section) this guild talks to
+        self.kavita_server = kavita_server
+        self.channels = channels or {}
+        self.jobs = jobs or []
+        # Subscriptions for this guild are kept apart from other guilds under this namespace
+        self.subscription_namespace = subscription_namespace
+        # Search, recently updated and stats cover every Kavita server, not just kavita_server
+        self.federated = federated
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(guild_id=data['guild_id'],
+                   kavita_server=data.get('kavita_server', "default"),
+                   channels=data.get('channels'),
+                   jobs=data.get('jobs'),
+                   subscription_namespace=data.get('subscription_namespace'),
+                   federated=bool(data.get('federated', False)))
+
+
+class GuildDirectory:
+    def __init__(self, default_guild_id, config_path='assets/subscriptions/guilds.json'):
+        # The guild from bot_config always exists and keeps the single-guild defaults
+        self.default = GuildSettings(default_guild_id)
+        self.guilds = {self.default.guild_id: self.default}
+        self.kavita_servers = {}
+        self.load(config_path)
+
+    def load(self, config_path):
+        # The guilds file is optional, without it the bot runs for the bot_config guild only
+        try:
+            with open(config_path, 'r') as file:
+                config = json.load(file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Failed to load guild config: {e}")
+            return
+
+        # Extra Kavita servers by name, each with an "opds_url" and web "base_url"
+        self.kavita_servers = config.get('kavita_servers', {})
+        for guild_data in config.get('guilds', []):
+            try:
+                settings = GuildSettings.from_dict(guild_data)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Skipping invalid guild config {guild_data}: {e}")
+                continue
+            if settings.kavita_server != "default" and settings.kavita_server not in self.kavita_servers:
+                logger.error(f"Guild {settings.guild_id} uses unknown Kavita server '{settings.kavita_server}', "
+                             f"falling back to the default server.")
+                settings.kavita_server = "default"
+            self.guilds[settings.guild_id] = settings
+            if settings.guild_id == self.default.guild_id:
+                self.default = settings
+        logger.info(f"Loaded config for {len(self.guilds)} guilds and {len(self.kavita_servers)} extra Kavita "
+                    f"servers.")
+
+    def get(self, guild_id):
+        # DMs and unconfigured guilds get the default settings
+        if guild_id is None:
+            return self.default
+        return self.guilds.get(int(guild_id), self.default)
+
+    def __iter__(self):
+        return iter(self.guilds.values())
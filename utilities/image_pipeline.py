@@ -0,0 +1,251 @@
+import asyncio
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageOps
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Size and encoding for each cover variant, Discord shows thumbnails at ~80px and embed images at ~400px wide
+cover_variants = {
+    "thumbnail": {"max_size": (240, 360), "format": "JPEG", "quality": 80},
+    "full": {"max_size": (800, 1200), "format": "JPEG", "quality": 85}
+}
+
+# File extension for each output format
+format_extensions = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+# Cover mosaics: tile size, tiles per row, most tiles in one image and how many mosaics are kept
+mosaic_tile_size = (120, 180)
+mosaic_columns = 5
+mosaic_max_tiles = 20
+mosaic_cache_entries = 32
+# Longest the calling thread waits on a mosaic before the listing goes out without one
+mosaic_timeout_seconds = 15
+
+
+def transcode_cover(cover_data: bytes, max_size, image_format: str = "JPEG", quality: int = 85):
+    # Runs in a worker process: downscale the cover to fit max_size and re-encode it
+    with Image.open(BytesIO(cover_data)) as image:
+        # Let the JPEG decoder skip detail we are about to throw away anyway
+        image.draft("RGB", max_size)
+        image = image.convert("RGB")
+        image.thumbnail(max_size, Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, format=image_format, quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def _ready():
+    return True
+
+
+def compose_mosaic(covers, tile_size=mosaic_tile_size, columns: int = mosaic_columns, quality: int = 80):
+    # Runs in a worker process: crop every cover to the tile shape and lay them out in a grid
+    rows = -(-len(covers) // columns)
+    width, height = tile_size
+    mosaic = Image.new("RGB", (width * min(columns, len(covers)), height * rows), (32, 34, 37))
+    for index, cover_data in enumerate(covers):
+        if not cover_data:
+            continue
+        try:
+            with Image.open(BytesIO(cover_data)) as image:
+                image.draft("RGB", tile_size)
+                tile = ImageOps.fit(image.convert("RGB"), tile_size, Image.LANCZOS)
+        except Exception:
+            # Leave a blank tile for a cover we can't read
+            continue
+        mosaic.paste(tile, ((index % columns) * width, (index // columns) * height))
+    output = BytesIO()
+    mosaic.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+class CoverPipeline:
+    def __init__(self, workers: int = 2, max_entries: int = 512):
+        self.workers = workers
+        self.max_entries = max_entries
+        self.variants = OrderedDict()
+        # Rendered mosaics by the ordered tuple of series ids they show
+        self.mosaics = OrderedDict()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Fork the worker processes up front, a fork once the bot has threads running can deadlock the children on
+        # locks those threads held (logging, connection pools)
+        with self._lock:
+            if not self.workers or self._executor:
+                return
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._executor.submit(_ready)
+        logger.info(f"Started {self.workers} cover transcoding processes.")
+
+    @property
+    def executor(self):
+        # The bot starts the pool at startup, scripts that never call start() get it on first use
+        if self._executor is None:
+            self.start()
+        return self._executor
+
+    @staticmethod
+    def cover_version(cover_data: bytes):
+        # Kavita doesn't version covers, so the content hash stands in for the version
+        return hashlib.blake2b(cover_data, digest_size=16).hexdigest()
+
+    def _cache_key(self, kind, item_id, cover_data, variant):
+        return kind, item_id, self.cover_version(cover_data), variant
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self.variants:
+                self.variants.move_to_end(key)
+                return self.variants[key]
+            return None
+
+    def _store(self, key, result):
+        with self._lock:
+            self.variants[key] = result
+            while len(self.variants) > self.max_entries:
+                self.variants.popitem(last=False)
+
+    def _finish(self, key, cover_data, settings, future):
+        try:
+            variant_data = future.result()
+        except Exception as e:
+            logger.error(f"Failed to transcode {key[0]} cover {key[1]}, using the original: {e}")
+            return cover_data, "jpg"
+
+        # Keep the original if re-encoding didn't make it any smaller
+        if len(variant_data) >= len(cover_data):
+            result = (cover_data, "jpg")
+        else:
+            result = (variant_data, format_extensions.get(settings["format"], "jpg"))
+        self._store(key, result)
+        return result
+
+    def _submit(self, cover_data, settings):
+        if not self.workers:
+            # No worker processes (we're already in one), transcode in the calling thread
+            future = Future()
+            try:
+                future.set_result(transcode_cover(cover_data, settings["max_size"], settings["format"],
+                                                  settings["quality"]))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self.executor.submit(transcode_cover, cover_data, settings["max_size"], settings["format"],
+                                    settings["quality"])
+
+    def variant(self, kind: str, item_id, cover_data: bytes, variant: str = "full"):
+        # Returns (image bytes, file extension) for the requested variant of a cover
+        key = self._cache_key(kind, item_id, cover_data, variant)
+        cached = self._cached(key)
+        if cached:
+            return cached
+
+        settings = cover_variants[variant]
+        try:
+            future = self._submit(cover_data, settings)
+        except Exception as e:
+            logger.error(f"Cover worker pool unavailable, using the original cover: {e}")
+            return cover_data, "jpg"
+        return self._finish(key, cover_data, settings, future)
+
+    async def variant_async(self, kind: str, item_id, cover_data: bytes, variant: str = "full"):
+        # Same as variant() but waits for the worker without blocking the event loop
+        key = self._cache_key(kind, item_id, cover_data, variant)
+        cached = self._cached(key)
+        if cached:
+            return cached
+
+        settings = cover_variants[variant]
+        try:
+            future = self._submit(cover_data, settings)
+        except Exception as e:
+            logger.error(f"Cover worker pool unavailable, using the original cover: {e}")
+            return cover_data, "jpg"
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            # _finish logs the failure and falls back to the original
+            pass
+        return self._finish(key, cover_data, settings, future)
+
+    def cached_mosaic(self, series_ids):
+        with self._lock:
+            key = tuple(series_ids)
+            if key in self.mosaics:
+                self.mosaics.move_to_end(key)
+                return self.mosaics[key]
+            return None
+
+    def mosaic(self, series_ids, covers):
+        # One grid image of the given covers (ordered like series_ids), rendered once per id list
+        key = tuple(series_ids)
+        cached = self.cached_mosaic(key)
+        if cached:
+            return cached
+        future = None
+        try:
+            if self.workers:
+                # The shared pool started at startup, a mosaic is no reason to fork a new one
+                future = self.executor.submit(compose_mosaic, covers)
+                mosaic_data = future.result(timeout=mosaic_timeout_seconds)
+            else:
+                mosaic_data = compose_mosaic(covers)
+        except BrokenProcessPool as e:
+            logger.error(f"Cover worker pool is broken, sending the listing without a mosaic: {e}")
+            return None
+        except FutureTimeoutError:
+            future.cancel()
+            logger.error(f"Cover mosaic for {len(covers)} series took over {mosaic_timeout_seconds}s, "
+                         f"sending the listing without it.")
+            return None
+        except Exception as e:
+            logger.error(f"Failed to render a cover mosaic for {len(covers)} series: {e}")
+            return None
+        with self._lock:
+            self.mosaics[key] = mosaic_data
+            while len(self.mosaics) > mosaic_cache_entries:
+                self.mosaics.popitem(last=False)
+        return mosaic_data
+
+    def forget_series(self, series_id):
+        # A series cover changed, drop the mosaics it appears in
+        with self._lock:
+            for key in [key for key in self.mosaics if series_id in key]:
+                del self.mosaics[key]
+
+    def clear(self):
+        # Variants are keyed by the cover's content and can't go stale, only the mosaics can
+        with self._lock:
+            self.mosaics.clear()
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Shared by every EmbedBuilder so covers are only transcoded once per process
+_shared_pipeline = None
+
+
+def shared_cover_pipeline():
+    global _shared_pipeline
+    if _shared_pipeline is None:
+        _shared_pipeline = CoverPipeline()
+    return _shared_pipeline
+
+
+def reset_shared_cover_pipeline(workers: int = 2):
+    # A forked process can't use its parent's worker pool, so it starts its own shared pipeline
+    global _shared_pipeline
+    _shared_pipeline = CoverPipeline(workers=workers)
+    return _shared_pipeline
@@ -0,0 +1,127 @@
+import time
+import asyncio
+from email_validator import EmailNotValidError
+import utilities.logging_config as logging_config
+from utilities.email_check import normalize_email, shared_email_checker
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Invites handled at once, the DNS lookups and Kavita's invite (and its SMTP send) run on threads
+invite_workers = 2
+# Invites waiting beyond this are turned away
+invite_queue_size = 50
+# An address that was just invited isn't invited again for this long
+recent_invite_seconds = 24 * 3600
+
+
+class InviteRequest:
+    def __init__(self, interaction, kavita, email: str):
+        self.interaction = interaction
+        self.kavita = kavita
+        self.email = email
+        self.queued_at = time.monotonic()
+
+    @property
+    def key(self):
+        # Mail providers ignore the case of the local part, so Foo@ and foo@ are one invite
+        return self.kavita.name, self.email.lower()
+
+
+class InvitePipeline:
+    def __init__(self, admission_control=None, workers: int = invite_workers):
+        # admission_control gets back the rate limit token of an invite that was turned away before being queued
+        self.admission_control = admission_control
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=invite_queue_size)
+        # (Kavita server, normalized address) of invites queued or running, and of recent invites -> sent at
+        self.in_flight = set()
+        self.recent = {}
+        self.checker = shared_email_checker()
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def _recently_invited(self, key):
+        now = time.time()
+        self.recent = {recent_key: sent_at for recent_key, sent_at in self.recent.items()
+                       if now - sent_at < recent_invite_seconds}
+        return key in self.recent
+
+    async def _turn_away(self, interaction, message: str):
+        # Nothing was sent, so the attempt doesn't count against the user's invite-me rate limit
+        if self.admission_control:
+            self.admission_control.refund('invite-me', interaction.user.id, interaction.guild_id)
+        await interaction.response.send_message(message, ephemeral=True)
+
+    async def submit(self, interaction, kavita, email: str):
+        # Answers the interaction with the request's status, the result follows when the invite is done
+        try:
+            email = normalize_email(email)
+        except EmailNotValidError as e:
+            await self._turn_away(interaction, f"`{email}` isn't a valid email address: {e}")
+            return
+        request = InviteRequest(interaction, kavita, email)
+        if request.key in self.in_flight:
+            await self._turn_away(interaction, f"An invite for `{email}` is already on its way.")
+            return
+        if self._recently_invited(request.key):
+            await self._turn_away(interaction, f"An invite was already sent to `{email}` recently, check your junk "
+                                               f"mail if it's not in your inbox.")
+            return
+        try:
+            self.queue.put_nowait(request)
+        except asyncio.QueueFull:
+            logger.warning(f"Invite queue full, turning away the invite for {interaction.user}.")
+            await self._turn_away(interaction, "Too many invites are waiting right now, please try again in a few "
+                                               "minutes.")
+            return
+        self.in_flight.add(request.key)
+        position = self.queue.qsize()
+        logger.info(f"Queued invite for {interaction.user} at position {position}.")
+        # Only the user sees their address, the result follows once the invite is done
+        await interaction.response.send_message(f"Sending an invite to `{email}`" + (
+            f", {position - 1} invites are ahead of yours..." if position > 1 else "..."), ephemeral=True)
+
+    async def run(self):
+        while True:
+            request = await self.queue.get()
+            try:
+                await self.process(request)
+            except Exception as e:
+                logger.exception(f"Invite for {request.interaction.user} failed: {e}")
+                await self._reply(request, "Unable to generate an invite right now, please try again later.")
+            finally:
+                self.in_flight.discard(request.key)
+                self.queue.task_done()
+
+    async def process(self, request: InviteRequest):
+        interaction = request.interaction
+        # The MX lookup and the invite block, so both run on threads
+        email, reason = await asyncio.to_thread(self.checker.check, request.email)
+        if not email:
+            logger.info(f"Invite email for {interaction.user} rejected: {reason}")
+            await self._reply(request, f"Unable to send an invite to `{request.email}`: {reason}")
+            return
+
+        # Invited with the address exactly as checked, the action doesn't look it up again
+        user_invite = await asyncio.to_thread(request.kavita.actions.new_user_invite, email)
+        logger.info(f"Invite for {interaction.user} {'sent' if user_invite else 'failed'} after "
+                    f"{time.monotonic() - request.queued_at:.1f}s.")
+        if not user_invite:
+            await self._reply(request, f"Unable to generate invite with provided email `{email}`, please try again...")
+            return
+        self.recent[request.key] = time.time()
+        # Respond so only the user can see (To keep the email used private)
+        await interaction.followup.send(f"User invite send to `{email}`, you may need to check your junk mail "
+                                        f"if it's not in your inbox, happy reading!", ephemeral=True)
+        await interaction.followup.send(f"User {interaction.user.mention} invited to the BNU Manga server!")
+
+    @staticmethod
+    async def _reply(request, message: str):
+        await request.interaction.followup.send(message, ephemeral=True)
@@ -1,23 +1,34 @@
 import json
 import asyncio
-import discord
+from datetime import datetime
+from functools import partial
 import utilities.logging_config as logging_config
-from api.kavita_query.kavita_config import kavita_base_url
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from utilities.series_embed import EmbedBuilder
+from apscheduler.triggers.interval import IntervalTrigger
+from utilities.notification_subscriptions import subscriptions_path, load_notification_preferences, notification_mode
+from utilities.notification_digest import plan_updates, wants_compact
+from utilities.series_embed import embed_payload
+from utilities.message_bundle import BundleMessage, MessageBundle
+from api.kavita_query.kavita_federation import split_origin_id
 from utilities.emoji_map import generate_emoji_manga_map as map_emojis
 
 # Setup logging
 logger = logging_config.setup_logging()
 
+# How often the server stats snapshot is rebuilt in the background
+stats_snapshot_minutes = 5
+# How often new series are pulled into the random series index
+series_index_minutes = 15
+
 
 class ScheduledJobs:
     def __init__(self, bot):
         self.scheduler = BackgroundScheduler()
         self.bot = bot
-        self.embed_builder = EmbedBuilder(server_address=kavita_base_url, kavita_queries=self.bot.kavita_queries)
         self.load_jobs_from_json()
+        self.load_guild_jobs()
+        self.add_maintenance_jobs()
         logger.info("Job scheduler initialized.")
 
     def load_jobs_from_json(self):
@@ -26,11 +37,29 @@ class ScheduledJobs:
             with open('assets/subscriptions/scheduled_jobs.json', 'r') as file:
                 jobs = json.load(file)['jobs']
                 for job in jobs:
+                    # These jobs predate per guild config and belong to the bot_config guild
+                    job.setdefault('guild_id', self.bot.guild_configs.default.guild_id)
                     self.add_job(job)
         except Exception as e:
             logger.error(f"Failed to load jobs from JSON: {e}")
 
-    def load_subscriptions(self, file_path='assets/subscriptions/subscriptions.json'):
+    def load_guild_jobs(self):
+        # Jobs from the guild config, their channel can be an id or a name from the guild's "channels",
+        # or a list of either ("channel_ids" / "channels") to send the same thing to several channels
+        for settings in self.bot.guild_configs:
+            for guild_job in settings.jobs:
+                try:
+                    job = dict(guild_job, guild_id=settings.guild_id, id=f"{settings.guild_id}:{guild_job['id']}")
+                    if 'channels' in job and 'channel_ids' not in job:
+                        job['channel_ids'] = [settings.channels[name] for name in job['channels']]
+                    if 'channel_id' not in job and 'channel_ids' not in job:
+                        job['channel_id'] = settings.channels[job['channel']]
+                    self.add_job(job)
+                except Exception as e:
+                    logger.error(f"Failed to add job {guild_job} for guild {settings.guild_id}: {e}")
+
+    def load_subscriptions(self, namespace=None):
+        file_path = subscriptions_path(namespace)
         try:
             with open(file_path, 'r') as file:
                 data = json.load(file)
@@ -43,6 +72,10 @@ class ScheduledJobs:
             return {}
 
     def job_function(self, job):
+        # Every shard schedules every job, only the shard connected to the job's guild runs it
+        if not self.bot.owns_guild(job['guild_id']):
+            logger.debug(f"Skipping job '{job['id']}', guild {job['guild_id']} is served by another shard.")
+            return
         job_type = job['type']
         if job_type == 'send_message':
             asyncio.run_coroutine_threadsafe(self.send_message_action(job), self.bot.loop)
@@ -51,71 +84,87 @@ class ScheduledJobs:
         else:
             logger.warning(f"Unknown job type: {job_type}")
 
+    @staticmethod
+    def batch_key(job):
+        # Outbox batch for this run of a job, running it again within the hour only fills in missed recipients
+        return f"{job['id']}:{datetime.now():%Y-%m-%dT%H}"
+
+    def job_channel_ids(self, job):
+        # The channels a job sends to, leaving out any the bot can't see
+        channel_ids = job.get('channel_ids') or [job['channel_id']]
+        found = [channel_id for channel_id in channel_ids if self.bot.get_channel(channel_id)]
+        for channel_id in set(channel_ids) - set(found):
+            logger.error(f"Channel with ID {channel_id} not found.")
+        return found
+
+    async def queue_bundle(self, job, channel_ids, bundle):
+        # Every channel gets the same rendered bundle
+        await self.bot.outbox_sender.queue(self.batch_key(job), [("channel", channel_id, job['guild_id'], bundle)
+                                                                 for channel_id in channel_ids])
+
     async def send_message_action(self, job):
-        channel = self.bot.get_channel(job['channel_id'])
-        if channel:
+        channel_ids = self.job_channel_ids(job)
+        if channel_ids:
             message = job['message']
-            await channel.send(message)
-            logger.info(f"Sent message to channel {job['channel_id']}: {message}")
-        else:
-            logger.error(f"Channel with ID {job['channel_id']} not found.")
+            await self.queue_bundle(job, channel_ids, MessageBundle.text(message))
+            logger.info(f"Queued message to channels {channel_ids}: {message}")
 
     async def run_command_action(self, job):
         command_name = job['command_name']
-        channel_id = job['channel_id']
-        channel = self.bot.get_channel(channel_id)
-        if not channel:
-            logger.error(f"Channel with ID {channel_id} not found.")
+        channel_ids = self.job_channel_ids(job)
+        if not channel_ids:
             return
+        # The Kavita server configured for the job's guild, and every server if the guild is federated
+        kavita = self.bot.kavita_for(job['guild_id'])
+        federation = self.bot.federation_for(job['guild_id'])
 
         if command_name == "server-stats":
-            logger.info(f"Sending daily server stats to {channel_id}.")
+            logger.info(f"Sending daily server stats to {channel_ids}.")
             try:
-                # Get the server stats directly
-                stats_message, embeds = self.bot.kavita_queries.generate_server_stats(daily_update=True)
+                if federation:
+                    # Every server's snapshot, combined
+                    stats_message, embeds = await asyncio.to_thread(federation.stats_messages, None, True)
+                else:
+                    # Serve the stats from the pre-rendered snapshot, building it now if it doesn't exist yet
+                    if not kavita.stats_snapshot.is_ready():
+                        await asyncio.to_thread(kavita.stats_snapshot.refresh)
+                    stats_message, embeds = kavita.stats_snapshot.messages(daily_update=True)
 
                 if stats_message and embeds:
-                    # Send the message to the channel
-                    await channel.send(stats_message)
+                    # The stats message goes out first
+                    messages = [BundleMessage(stats_message)]
 
-                    # Fetch recently updated series
-                    updated_series = self.bot.kavita_queries.get_recently_updated()
-                    if updated_series:
+                    # Recently updated series are captured in the snapshot as well, federated ones are fetched now
+                    updated_series = await asyncio.to_thread(federation.recently_updated) if federation else None
+                    series_names = ([series['seriesName'] for series in updated_series if 'seriesName' in series]
+                                    if federation else kavita.stats_snapshot.recently_updated())
+                    if series_names:
                         logger.info(f"Generating emoji map for recently updated series...")
-                        series_names = [series['seriesName'] for series in updated_series if 'seriesName' in series]
                         emoji_manga_list = map_emojis(manga_titles=series_names, max_titles=10)
 
-                        # Create an embed for the response
-                        embed = discord.Embed(
-                            title="Recently Updated Series",
-                            description="React to see series update info:\n\n" + "\n".join(
-                                f"{emoji_symbol}: {manga}" for emoji_symbol, manga in emoji_manga_list.items()
-                            ),
-                            color=0x4ac694  # You can change the color to match your theme
-                        )
-                        # Path to thumbnail
-                        thumb_img_path = 'assets/images/server_icon.png'
-                        # Use discord.File with the file path directly
-                        file = discord.File(thumb_img_path, filename='thumbnail.jpg')
-                        embed.set_thumbnail(url="attachment://thumbnail.jpg")
-                        embed.set_footer(text=f"\nUse the emoji reacts below to get more info for the selected series:")
-
-                        # Send the emoji message
-                        emoji_message_obj = await channel.send(embed=embed, file=file if file else None)
-
-                        for emoji_symbol in emoji_manga_list.keys():
-                            await asyncio.sleep(0.15)
-                            await emoji_message_obj.add_reaction(emoji_symbol)
-                        # Store the mapping of emojis to the message ID for tracking
-                        self.bot.reaction_messages[emoji_message_obj.id] = emoji_manga_list
+                        # Create an embed for the response, with the listed covers as one mosaic
+                        if federation:
+                            embed, files = await asyncio.to_thread(federation.build_recently_updated_embed,
+                                                                   emoji_manga_list, updated_series)
+                        else:
+                            embed, files = await asyncio.to_thread(
+                                kavita.embed_builder.build_recently_updated_embed, emoji_manga_list,
+                                kavita.stats_snapshot.recently_updated_by_name())
+
+                        # The emoji message, the sender adds the reactions and tracks the message
+                        messages.append(BundleMessage.from_embeds(embeds=[embed], files=files,
+                                                                  reaction_map=emoji_manga_list))
                     else:
-                        await channel.send("No recently updated series available.")
+                        messages.append(BundleMessage("No recently updated series available."))
                 else:
-                    await channel.send("No server stats available.")
+                    messages = [BundleMessage("No server stats available.")]
+                # Rendered once, however many channels it goes to
+                await self.queue_bundle(job, channel_ids, MessageBundle(messages))
             except Exception as e:
                 logger.error(f"Failed to execute command '{command_name}': {e}")
         elif command_name == "user_notifications":
-            await self.check_user_subscriptions()
+            namespace = self.bot.guild_configs.get(job['guild_id']).subscription_namespace
+            await self.check_user_subscriptions(kavita, namespace, batch=self.batch_key(job))
         else:
             logger.error(f"Command '{command_name}' not found in bot.")
 
@@ -129,17 +178,83 @@ class ScheduledJobs:
         )
         logger.info(f"Job '{job['id']}' added with schedule: {job['hour']}:{job['minute']}:{job['second']}")
 
-    async def check_user_subscriptions(self):
-        subs = self.load_subscriptions()
+    def add_maintenance_jobs(self):
+        for name, kavita in self.bot.kavita_servers.items():
+            self.add_server_jobs(name, kavita)
+
+    @staticmethod
+    def server_job_id(job_name, server_name):
+        # The default server keeps the plain job ids
+        return job_name if server_name == "default" else f"{job_name}-{server_name}"
+
+    def add_server_jobs(self, name, kavita):
+        # Probe Kavita in the background so open circuits close as soon as the server recovers
+        job_id = self.server_job_id('kavita-health-probe', name)
+        self.scheduler.add_job(
+            kavita.queries.probe_circuits,
+            IntervalTrigger(seconds=15),
+            id=job_id,
+            max_instances=1,
+            coalesce=True
+        )
+        logger.info(f"Job '{job_id}' added with schedule: every 15 seconds")
+
+        # Keep the server stats snapshot rendered, starting right away so the first request is instant
+        job_id = self.server_job_id('stats-snapshot', name)
+        self.scheduler.add_job(
+            kavita.stats_snapshot.refresh,
+            IntervalTrigger(minutes=stats_snapshot_minutes),
+            id=job_id,
+            next_run_time=datetime.now(),
+            max_instances=1,
+            coalesce=True
+        )
+        kavita.stats_snapshot.on_invalidate = partial(self.refresh_stats_snapshot, name)
+        logger.info(f"Job '{job_id}' added with schedule: every {stats_snapshot_minutes} minutes")
+
+        # Keep the library series index current for /random-manga
+        job_id = self.server_job_id('series-index', name)
+        self.scheduler.add_job(
+            kavita.series_index.refresh,
+            IntervalTrigger(minutes=series_index_minutes),
+            id=job_id,
+            next_run_time=datetime.now(),
+            max_instances=1,
+            coalesce=True
+        )
+        logger.info(f"Job '{job_id}' added with schedule: every {series_index_minutes} minutes")
+
+    def refresh_stats_snapshot(self, server_name="default"):
+        # Pull the next snapshot refresh forward to now
+        try:
+            self.scheduler.modify_job(self.server_job_id('stats-snapshot', server_name), next_run_time=datetime.now())
+        except Exception as e:
+            logger.error(f"Failed to reschedule the server stats snapshot: {e}")
+
+    async def check_user_subscriptions(self, kavita, namespace=None, batch=None):
+        subs = self.load_subscriptions(namespace)
         if not subs:
             logger.info("No subscriptions found.")
             return
 
+        # Resolve every subscribed series once, in bulk, instead of once per subscriber.
+        # Subscriptions can name series on other Kavita servers ("server:id"), each server resolves its own
+        federation = self.bot.federation
+        subscribed_ids = set()
+        for series_ids in subs.values():
+            subscribed_ids.update(series_ids if isinstance(series_ids, list) else [series_ids])
+        series_by_id = await asyncio.to_thread(federation.bulk_by_value, subscribed_ids, kavita.name)
+        metadata_by_id = await asyncio.to_thread(federation.bulk_by_value, subscribed_ids, kavita.name,
+                                                 'get_series_metadata_bulk')
+        # Each series embed is rendered once and re-sent to every subscriber
+        series_payloads = {}
+        preferences = load_notification_preferences()
+        # Every user's messages are queued in the outbox, which sends them at a steady pace and survives restarts
+        deliveries = []
+
         for user_id, series_ids in subs.items():  # Unpacking user_id and series_ids
             try:
-                # Fetch user with user_id
-                user = await self.bot.fetch_user(user_id)
-                logger.info(f"Processing user_id: {user}, series_ids: {series_ids}")
+                logger.info(f"Processing user_id: {user_id}, series_ids: {series_ids}")
 
                 # Ensure series_ids is either a list or int and handle both cases
                 if isinstance(series_ids, int):
@@ -149,26 +264,48 @@ class ScheduledJobs:
                     logger.error(f"Unexpected type for series_ids: {type(series_ids)}. Skipping user {user_id}.")
                     continue  # Skip this user if series_ids is neither an int nor a list
 
-                # Now process each series_id in the list
+                # Collect the user's updates, then send them all at once in the mode they picked
+                mode = notification_mode(user_id, preferences)
+                user_series = []
                 for series_id in series_ids:
-                    if isinstance(series_id, int):  # Ensure series_id is an integer
-                        logger.info(f"Processing series_id: {series_id} for user {user_id}.")
-                        series_metadata = self.bot.kavita_queries.get_series_metadata(series_id)
-                        series_name = self.bot.kavita_queries.get_name_from_id(series_id)
-                        library_id = self.bot.kavita_queries.get_library_id(series_id)
-                        series_embed, file = self.embed_builder.build_series_embed(
-                            series={'id': series_id, 'name': series_name, 'libraryId': library_id},
-                            metadata=series_metadata,
-                            thumbnail=False)
-                        await user.send(embed=series_embed, file=file if file else None)
-                        logger.info(f"Sent notification to user {user_id} for series {series_id}.")
+                    if split_origin_id(series_id)[0] is None:  # Ensure series_id is an id
+                        logger.error(f"Unexpected series_id: {series_id}. Skipping this series.")
+                    elif not (series_by_id.get(series_id) and metadata_by_id.get(series_id)):
+                        logger.error(f"No series info found for ID: {series_id}. Skipping this series.")
                     else:
-                        logger.error(f"Unexpected non-integer series_id: {series_id}. Skipping this series.")
-            except discord.HTTPException as e:
-                logger.error(f"Failed to send notification to user {user_id}: {e}")
+                        # (subscription id, Kavita server, series)
+                        server_name, series = series_by_id[series_id]
+                        user_series.append((series_id, federation.server(server_name), series))
+                if not user_series:
+                    continue
+
+                payloads = None
+                if not wants_compact(mode, len(user_series)):
+                    # Digests show covers as thumbnails, so ten of them fit in one message
+                    thumbnail = mode == "digest"
+                    payloads = []
+                    for series_id, server, series in user_series:
+                        key = (series_id, thumbnail)
+                        if key not in series_payloads:
+                            series_payloads[key] = embed_payload(*await asyncio.to_thread(
+                                server.embed_builder.build_series_embed, series=series,
+                                metadata=metadata_by_id[series_id][1], thumbnail=thumbnail))
+                        payloads.append(series_payloads[key])
+                compact_lines = [f"[{series['name']}]("
+                                 f"{server.embed_builder.build_series_url(series['id'], series['libraryId'])})"
+                                 for _, server, series in user_series]
+
+                messages = plan_updates(mode, payloads, compact_lines, title="Your Series Updates")
+                deliveries.append(("user", user_id, None, MessageBundle.from_payload_messages(messages)))
+                logger.info(f"Prepared {len(user_series)} series updates for user {user_id} in {len(messages)} "
+                            f"{mode} messages.")
             except Exception as e:
                 logger.error(f"An error occurred while checking subscriptions: {e}")
 
+        if deliveries:
+            await self.bot.outbox_sender.queue(batch or f"user_notifications:{namespace}:{datetime.now():%Y-%m-%dT%H}",
+                                               deliveries)
+
     def start_scheduler(self):
         self.scheduler.start()
         logger.info("Scheduler started.")
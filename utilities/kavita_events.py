@@ -0,0 +1,186 @@
+import os
+import time
+import asyncio
+import discord
+from operator import attrgetter
+import utilities.logging_config as logging_config
+from utilities.notification_subscriptions import load_subscriptions, load_notification_preferences, notification_mode
+from utilities.notification_digest import send_updates
+from api.kavita_query.kavita_federation import origin_id, split_origin_id
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Listen to Kavita's event hub unless BNU_KAVITA_EVENTS is turned off
+kavita_events_enabled = os.environ.get('BNU_KAVITA_EVENTS', '1').lower() not in ('0', 'false', 'no')
+
+# A library scan sends a burst of events, wait for it to go quiet before acting on them
+event_debounce_seconds = 10
+# but never hold the first queued event back longer than this, a long scan still sends updates as it goes
+event_max_wait_seconds = 60
+# Most new chapters sent in one notification
+max_notified_chapters = 3
+
+
+class KavitaEventHandler:
+    def __init__(self, bot, kavita):
+        self.bot = bot
+        self.kavita = kavita
+        # Series changed since the last flush
+        self.pending = set()
+        # When the oldest pending event was queued
+        self.pending_since = None
+        # Chapter ids per series as of the last look, new chapters are the ones missing from here
+        self.known_chapters = {}
+        self._flush_task = None
+        # Series being looked at in the background since they were subscribed to
+        self._tracking_tasks = set()
+
+    def handlers(self):
+        # Kavita hub event name -> handler
+        return {
+            'SeriesAdded': self.on_series_added,
+            'SeriesRemoved': self.on_series_removed,
+            'ScanSeries': self.on_series_scanned,
+            'CoverUpdate': self.on_cover_update,
+            'LibraryModified': self.on_library_modified
+        }
+
+    async def on_series_added(self, body):
+        self.kavita.series_index.add_series(body['libraryId'], body['seriesId'])
+        self.queue(body['seriesId'])
+
+    async def on_series_removed(self, body):
+        self.kavita.series_index.remove_series(body['seriesId'])
+        self.kavita.queries.invalidate_series(body['seriesId'])
+        self.known_chapters.pop(body['seriesId'], None)
+        self.kavita.stats_snapshot.invalidate("series removed")
+
+    async def on_series_scanned(self, body):
+        self.queue(body['seriesId'])
+
+    async def on_cover_update(self, body):
+        self.kavita.queries.invalidate_cover(str(body.get('entityType', '')).lower(), body['id'])
+        # Federated mosaics know the series by its origin tagged id
+        self.kavita.embed_builder.cover_pipeline.forget_series(origin_id(self.kavita.name, body['id']))
+
+    async def on_library_modified(self, body):
+        # Libraries were added or removed, rebuild the series index rather than guess
+        await asyncio.to_thread(self.kavita.series_index.refresh)
+
+    def queue(self, series_id: int):
+        self.pending.add(series_id)
+        now = time.monotonic()
+        if self.pending_since is None:
+            self.pending_since = now
+        # Restart the quiet period on every event, up to the longest wait since the first one
+        if self._flush_task:
+            self._flush_task.cancel()
+        delay = min(event_debounce_seconds, self.pending_since + event_max_wait_seconds - now)
+        self._flush_task = asyncio.create_task(self._flush_later(max(delay, 0)))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        series_ids, self.pending = self.pending, set()
+        self.pending_since = None
+        self._flush_task = None
+        for series_id in series_ids:
+            try:
+                new_chapters = await asyncio.to_thread(self.refresh_series, series_id)
+                if new_chapters:
+                    await self.notify_subscribers(series_id, new_chapters)
+            except Exception as e:
+                logger.error(f"Failed to process Kavita update for series {series_id}: {e}")
+        self.kavita.stats_snapshot.invalidate(f"{len(series_ids)} series updated")
+
+    def refresh_series(self, series_id: int):
+        # Reload the series after a change, returns chapter info for the chapters we hadn't seen yet
+        known = self.known_chapters.get(series_id)
+        if known is None:
+            # Not tracked yet, a timeline fetched before the change still tells us what was there
+            known = self.kavita.queries.chapter_timeline.cached_chapter_ids(series_id)
+        self.kavita.queries.invalidate_series(series_id)
+        timeline = self.kavita.queries.chapter_timeline.timeline(series_id)
+        if timeline is None:
+            return []
+        self.known_chapters[series_id] = set(timeline.chapter_ids)
+        if known is None:
+            # First time we look at this series, everything counts as known
+            return []
+        new_entries = [entry for entry in timeline.entries if entry.id not in known]
+        new_entries.sort(key=attrgetter('created'), reverse=True)
+        if new_entries:
+            logger.info(f"Kavita added {len(new_entries)} chapters to series {series_id}.")
+        return [entry.as_chapter_info() for entry in new_entries[:max_notified_chapters]]
+
+    def subscription_namespaces(self, owned_only: bool = True):
+        # Subscription namespace -> home Kavita server name, for the guilds that can subscribe to this server's
+        # series (and that this shard serves). Federated guilds can subscribe to any server's
+        namespaces = {}
+        for settings in self.bot.guild_configs:
+            if self.bot.kavita_for(settings.guild_id) is not self.kavita and not settings.federated:
+                continue
+            if owned_only and not self.bot.owns_guild(settings.guild_id):
+                continue
+            namespaces[settings.subscription_namespace] = settings.kavita_server
+        return namespaces
+
+    def subscriptions(self, owned_only: bool = True):
+        # (user id, series id on this server) of every subscription to this server's series
+        for namespace, home_server in self.subscription_namespaces(owned_only).items():
+            for user_id, user_series in load_subscriptions(namespace).items():
+                for value in user_series:
+                    server_name, series_id = split_origin_id(value, home_server)
+                    if server_name == self.kavita.name:
+                        yield user_id, series_id
+
+    def subscribed_series(self):
+        return {series_id for _, series_id in self.subscriptions(owned_only=False)}
+
+    def remember_chapters(self, series_id: int):
+        # Note the current chapters of a series, unless an update already did
+        timeline = self.kavita.queries.chapter_timeline.timeline(series_id)
+        if timeline is not None:
+            self.known_chapters.setdefault(series_id, set(timeline.chapter_ids))
+
+    def track(self, series_id: int):
+        # A series subscribed to after warm_up, note its chapters now or its first update would only set the baseline
+        if series_id in self.known_chapters:
+            return
+        task = asyncio.create_task(asyncio.to_thread(self.remember_chapters, series_id))
+        self._tracking_tasks.add(task)
+        task.add_done_callback(self._tracking_tasks.discard)
+
+    def warm_up(self):
+        # Remember the current chapters of every subscribed series so the first update can be told apart
+        for series_id in self.subscribed_series():
+            self.remember_chapters(series_id)
+        logger.info(f"Tracking chapters of {len(self.known_chapters)} subscribed series on Kavita server "
+                    f"'{self.kavita.name}'.")
+
+    async def notify_subscribers(self, series_id: int, new_chapters):
+        user_ids = {user_id for user_id, subscribed_id in self.subscriptions() if subscribed_id == series_id}
+        if not user_ids:
+            return
+
+        # Render once, every DM gets fresh embeds built from the same payloads
+        rendered, _ = await self.bot.render_workers.render(self.kavita, 'series-update', series_id, new_chapters)
+        if not rendered:
+            logger.error(f"Unable to render the update for series {series_id}, no notifications sent.")
+            return
+        series_payload, chapter_payloads = rendered
+        series_name = series_payload[0].get('title')
+        compact_lines = [f"**{series_name}** - Chapter {chapter.get('title') or chapter.get('number')}"
+                         for chapter in new_chapters]
+
+        preferences = load_notification_preferences()
+        for user_id in user_ids:
+            try:
+                user = await self.bot.fetch_user(int(user_id))
+                # The series and its new chapters go out together, in the user's preferred mode
+                await send_updates(user, notification_mode(user_id, preferences), [series_payload] + chapter_payloads,
+                                   compact_lines, title="New Chapters",
+                                   content="New chapters are up for a series you follow:")
+                logger.info(f"Sent update for series {series_id} to user {user_id}.")
+            except discord.HTTPException as e:
+                logger.error(f"Failed to send update for series {series_id} to user {user_id}: {e}")
@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import traceback
+import utilities.logging_config as logging_config
+from utilities.profiler import frame_label, project_root
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Event loop lag (seconds) that counts as a stall
+stall_threshold = float(os.environ.get('BNU_STALL_THRESHOLD', 0.5))
+# How often the loop checks in, and how often the watchdog thread looks at it
+beat_interval = 0.1
+check_interval = 0.05
+# Stall metrics are written here (JSON) at most this often, for dashboards and /debug-stalls after a restart
+stall_metrics_path = os.environ.get('BNU_STALL_METRICS_PATH', 'assets/cache/loop_stalls.json')
+metrics_write_seconds = 60
+# Frames of the blocked stack kept in the log
+stack_depth = 12
+# Commands still listed as running after this long are assumed to have failed without completing
+command_expiry_seconds = 900
+
+
+def blocking_frame(frame):
+    # The innermost frame in the bot's own code, that's the call to fix even when the time goes in a library
+    innermost = frame
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(project_root):
+            return frame
+        frame = frame.f_back
+    return innermost
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = stall_threshold, metrics_path: str = stall_metrics_path):
+        self.threshold = threshold
+        self.metrics_path = metrics_path
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.current_lag = 0.0
+        # Blocking frame label -> {'count', 'total_seconds', 'worst_seconds', 'last_command', 'stack'}
+        self.hotspots = {}
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        # Interaction id -> (command name, user, started), for naming what was running when the loop stalled
+        self.commands = {}
+        # (blocking frame label, stack, commands) taken by the watchdog thread during the current stall
+        self._capture = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._changed = False
+        self._task = None
+        self._thread = None
+
+    def start(self):
+        # Call from the event loop
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='bnu-loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+        self.write_metrics()
+
+    def command_started(self, interaction):
+        now = time.monotonic()
+        for interaction_id, (_, _, started) in list(self.commands.items()):
+            if now - started > command_expiry_seconds:
+                del self.commands[interaction_id]
+        name = interaction.command.qualified_name if interaction.command else interaction.type.name
+        self.commands[interaction.id] = (name, str(interaction.user), now)
+
+    def command_finished(self, interaction):
+        self.commands.pop(interaction.id, None)
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(beat_interval)
+            now = time.monotonic()
+            self.last_beat = now
+            self.current_lag = now - started - beat_interval
+            if self.current_lag >= self.threshold:
+                self._record(self.current_lag)
+            else:
+                # Too short to count, don't let its stack be blamed for the next stall
+                self._capture = None
+
+    def _watch(self):
+        last_write = time.monotonic()
+        while not self._stop.wait(check_interval):
+            now = time.monotonic()
+            # The heartbeat sleeps beat_interval between beats, only the time past that is lag
+            if now - self.last_beat >= self.threshold + beat_interval and self._capture is None:
+                self._capture = self._capture_loop()
+            if now - last_write >= metrics_write_seconds:
+                last_write = now
+                self.write_metrics()
+
+    def _capture_loop(self):
+        # The loop thread's stack right now, while it's still stuck
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return None
+        stack = ''.join(traceback.format_stack(frame)[-stack_depth:])
+        commands = [f"/{name} by {user}" for name, user, _ in list(self.commands.values())]
+        return frame_label(blocking_frame(frame).f_code), stack, commands
+
+    def _record(self, lag: float):
+        # On the loop once it's running again: the stall is over and we know how long it took
+        capture, self._capture = self._capture, None
+        hotspot, stack, commands = capture or ("unknown (blocked between checks)", "", [])
+        running = ', '.join(commands) or "no command"
+        with self._lock:
+            self.stalls += 1
+            self.stalled_seconds += lag
+            entry = self.hotspots.setdefault(hotspot, {'count': 0, 'total_seconds': 0.0, 'worst_seconds': 0.0})
+            entry['count'] += 1
+            entry['total_seconds'] += lag
+            entry['worst_seconds'] = max(entry['worst_seconds'], lag)
+            entry['last_command'] = running
+            entry['stack'] = stack
+            self._changed = True
+        logger.warning(f"Event loop blocked for {lag:.2f}s in {hotspot} while running {running}.\n{stack}")
+
+    def metrics(self):
+        # Blocking hotspots, the most time lost first
+        with self._lock:
+            hotspots = sorted(({'hotspot': hotspot, **entry} for hotspot, entry in self.hotspots.items()),
+                              key=lambda entry: entry['total_seconds'], reverse=True)
+            return {
+                'threshold_seconds': self.threshold,
+                'current_lag_seconds': round(self.current_lag, 4),
+                'stalls': self.stalls,
+                'stalled_seconds': round(self.stalled_seconds, 3),
+                'hotspots': hotspots
+            }
+
+    def write_metrics(self):
+        if not self._changed:
+            return
+        self._changed = False
+        try:
+            os.makedirs(os.path.dirname(self.metrics_path) or '.', exist_ok=True)
+            temp_path = f"{self.metrics_path}.tmp"
+            with open(temp_path, 'w') as file:
+                json.dump(dict(self.metrics(), written_at=time.time()), file, indent=2)
+            os.replace(temp_path, self.metrics_path)
+        except OSError as e:
+            logger.error(f"Failed to write loop stall metrics to {self.metrics_path}: {e}")
@@ -0,0 +1,94 @@
+import json
+import base64
+from io import BytesIO
+import discord
+from utilities.attachment_registry import send_embeds
+from utilities.send_scheduler import shared_send_scheduler, priority_broadcast
+
+
+class BundleMessage:
+    # One rendered message: text, embeds (as JSON), attachments as (file name, bytes) and the emoji reactions
+    # it's seeded with (emoji -> series name, for the recently updated listing). Read only once built
+    __slots__ = ('content', 'embeds', 'files', 'reaction_map')
+
+    def __init__(self, content=None, embeds=(), files=(), reaction_map=None):
+        object.__setattr__(self, 'content', content)
+        object.__setattr__(self, 'embeds', tuple(json.dumps(embed_data, sort_keys=True) for embed_data in embeds))
+        object.__setattr__(self, 'files', tuple((filename, bytes(data)) for filename, data in files))
+        object.__setattr__(self, 'reaction_map', tuple((reaction_map or {}).items()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Bundle messages can't be changed once rendered")
+
+    @classmethod
+    def from_embeds(cls, content=None, embeds=(), files=(), reaction_map=None):
+        # From discord embeds and files, reading the files once
+        return cls(content, [embed.to_dict() for embed in embeds],
+                   [(file.filename, file.fp.read()) for file in files if file], reaction_map)
+
+    @classmethod
+    def from_payloads(cls, content=None, payloads=(), reaction_map=None):
+        # From embed payloads (see series_embed.embed_payload)
+        return cls(content, [embed_data for embed_data, _ in payloads],
+                   [cover for _, cover in payloads if cover], reaction_map)
+
+    def to_dict(self, store_file=None):
+        # JSON safe form. store_file(bytes) -> reference lets the caller keep the attachment bytes elsewhere,
+        # otherwise they're inlined as base64
+        return {
+            'content': self.content,
+            'embeds': [json.loads(embed_json) for embed_json in self.embeds],
+            'files': [(filename, store_file(data) if store_file else base64.b64encode(data).decode())
+                      for filename, data in self.files],
+            'reaction_map': dict(self.reaction_map) or None
+        }
+
+    @classmethod
+    def from_dict(cls, data, load_file=None):
+        files = []
+        for filename, reference in data['files']:
+            file_data = load_file(reference) if load_file else base64.b64decode(reference)
+            if file_data is not None:
+                files.append((filename, file_data))
+        return cls(data['content'], data['embeds'], files, data.get('reaction_map'))
+
+    async def send(self, destination, priority: int = priority_broadcast):
+        # Fresh discord objects for every send, returns the sent message
+        embeds = [discord.Embed.from_dict(json.loads(embed_json)) for embed_json in self.embeds]
+        files = [discord.File(BytesIO(data), filename=filename) for filename, data in self.files]
+        if embeds:
+            return await send_embeds(destination.send, embeds, files, priority=priority, content=self.content)
+        return await shared_send_scheduler().send(priority, destination, content=self.content, files=files)
+
+
+class MessageBundle:
+    # The messages a job renders once and sends to any number of targets, in order
+    __slots__ = ('messages',)
+
+    def __init__(self, messages):
+        object.__setattr__(self, 'messages', tuple(messages))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Message bundles can't be changed once rendered")
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    @classmethod
+    def from_payload_messages(cls, messages):
+        # (content, embed payloads) pairs, as planned by notification_digest
+        return cls(BundleMessage.from_payloads(content, payloads) for content, payloads in messages)
+
+    @classmethod
+    def text(cls, *contents):
+        return cls(BundleMessage(content) for content in contents)
+
+    def to_dict(self, store_file=None):
+        return {'messages': [message.to_dict(store_file) for message in self.messages]}
+
+    @classmethod
+    def from_dict(cls, data, load_file=None):
+        return cls(BundleMessage.from_dict(message, load_file) for message in data['messages'])
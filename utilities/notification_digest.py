@@ -0,0 +1,86 @@
+import discord
+from utilities.series_embed import embed_payload, embed_from_payload
+from utilities.attachment_registry import send_embeds
+from utilities.send_scheduler import shared_send_scheduler, priority_bulk
+
+# Discord's limits for one message: 10 embeds, 6000 characters across all of them, 4096 per description.
+# Compact list embeds are kept well under the description limit so a few of them share a message
+digest_max_embeds = 10
+digest_max_characters = 6000
+compact_description_length = 2000
+# Digests with more updates than this switch to the compact list
+compact_threshold = 20
+
+# Per user delivery modes, "digest" is the default
+notification_modes = {
+    "digest": "Updates packed into as few messages as possible, as a compact list when there are many",
+    "compact": "Always a compact list of links, no covers",
+    "separate": "One message per series"
+}
+
+
+def pack_messages(items, size=len):
+    # Group embeds (or embed payloads, with a matching size function) into messages within Discord's limits
+    messages, current, current_size = [], [], 0
+    for item in items:
+        item_size = size(item)
+        if current and (len(current) >= digest_max_embeds or current_size + item_size > digest_max_characters):
+            messages.append(current)
+            current, current_size = [], 0
+        current.append(item)
+        current_size += item_size
+    if current:
+        messages.append(current)
+    return messages
+
+
+def payload_size(payload):
+    return len(discord.Embed.from_dict(payload[0]))
+
+
+def compact_embeds(title: str, lines):
+    # One line per update, split over as many embeds as the description limit needs
+    embeds, description = [], ""
+    for line in lines:
+        if description and len(description) + len(line) + 1 > compact_description_length:
+            embeds.append(discord.Embed(title=title, description=description, color=0x4ac694))
+            description = ""
+        description += f"{line}\n"
+    if description:
+        embeds.append(discord.Embed(title=title, description=description, color=0x4ac694))
+    return embeds
+
+
+def wants_compact(mode: str, update_count: int):
+    return mode == "compact" or (mode == "digest" and update_count > compact_threshold)
+
+
+def plan_updates(mode: str, payloads, compact_lines, title: str = "Series Updates", content=None):
+    # The messages a user gets for their updates in their preferred mode, as (content, embed payloads) pairs.
+    # payloads can be None when wants_compact(), so covers are only rendered for modes that show them
+    if wants_compact(mode, len(compact_lines)):
+        messages = pack_messages([embed_payload(embed) for embed in compact_embeds(title, compact_lines)],
+                                 size=payload_size)
+    elif mode == "separate":
+        messages = [[payload] for payload in payloads]
+    else:
+        messages = pack_messages(payloads, size=payload_size)
+    return [(content if index == 0 else None, message_payloads) for index, message_payloads in enumerate(messages)]
+
+
+async def send_updates(user, mode: str, payloads, compact_lines, title: str = "Series Updates", content=None,
+                       priority: int = priority_bulk):
+    # Send a user their updates in their preferred mode, returns the number of messages sent
+    messages = plan_updates(mode, payloads, compact_lines, title, content)
+    for message_content, message_payloads in messages:
+        embeds, files = [], []
+        for payload in message_payloads:
+            embed, file = embed_from_payload(payload)
+            embeds.append(embed)
+            if file:
+                files.append(file)
+        if embeds:
+            await send_embeds(user.send, embeds, files, priority=priority, content=message_content)
+        else:
+            await shared_send_scheduler().send(priority, user, content=message_content)
+    return len(messages)
@@ -2,18 +2,51 @@ import json
 
 # Path to the JSON file
 subscriptions_file = 'assets/subscriptions/subscriptions.json'
+# Per user notification preferences, shared by every guild
+preferences_file = 'assets/subscriptions/notification_preferences.json'
+
+
+# Guilds with their own subscription namespace get their own file next to the default one
+def subscriptions_path(namespace=None):
+    if not namespace:
+        return subscriptions_file
+    return subscriptions_file.replace('.json', f'_{namespace}.json')
 
 
 # Load subscriptions from the file
-def load_subscriptions():
+def load_subscriptions(namespace=None):
     try:
-        with open(subscriptions_file, 'r') as f:
+        with open(subscriptions_path(namespace), 'r') as f:
             return json.load(f)
     except FileNotFoundError:
         return {}
 
 
 # Save subscriptions to the file
-def save_subscriptions(subscriptions):
-    with open(subscriptions_file, 'w') as f:
+def save_subscriptions(subscriptions, namespace=None):
+    with open(subscriptions_path(namespace), 'w') as f:
         json.dump(subscriptions, f, indent=4)
+
+
+# Load the notification preferences of every user
+def load_notification_preferences():
+    try:
+        with open(preferences_file, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# Set how a user wants their notifications delivered
+def save_notification_mode(user_id, mode):
+    preferences = load_notification_preferences()
+    preferences.setdefault(str(user_id), {})['mode'] = mode
+    with open(preferences_file, 'w') as f:
+        json.dump(preferences, f, indent=4)
+
+
+# A user's notification delivery mode, digests unless they picked something else
+def notification_mode(user_id, preferences=None):
+    if preferences is None:
+        preferences = load_notification_preferences()
+    return preferences.get(str(user_id), {}).get('mode', 'digest')
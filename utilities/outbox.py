@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import discord
+import utilities.logging_config as logging_config
+from utilities.message_bundle import MessageBundle
+from utilities.send_scheduler import shared_send_scheduler, priority_broadcast, priority_bulk
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Where queued broadcasts and DMs wait until they're delivered
+outbox_path = os.environ.get('BNU_OUTBOX_PATH', 'assets/cache/outbox.sqlite3')
+# Pause between recipients, so a large fan-out is spread out instead of hitting Discord's DM limits in a burst
+outbox_send_interval = 0.5
+# Deliveries claimed per round, and how often the sender looks for due ones when nothing wakes it
+outbox_claim_size = 20
+outbox_poll_seconds = 15
+# Retry backoff, and the attempts before a delivery is given up
+retry_base_seconds = 30
+retry_max_seconds = 3600
+max_attempts = 6
+# A delivery claimed longer ago than this was left behind by a sender that died, it's picked up again
+claim_lease_seconds = 600
+# Finished deliveries (and attachments nothing uses any more) are kept this long
+keep_finished_seconds = 7 * 86400
+
+
+class Outbox:
+    def __init__(self, path: str = outbox_path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # One row per recipient of a batch with its message bundle, sent_count marks how far through it we got
+        self.connection.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                                "id INTEGER PRIMARY KEY AUTOINCREMENT, batch TEXT NOT NULL, "
+                                "target_kind TEXT NOT NULL, target_id INTEGER NOT NULL, guild_id INTEGER, "
+                                "messages TEXT NOT NULL, sent_count INTEGER NOT NULL DEFAULT 0, "
+                                "state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                                "next_attempt_at REAL NOT NULL, claimed_by TEXT, claimed_at REAL, last_error TEXT, "
+                                "created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+                                "UNIQUE (batch, target_kind, target_id))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt_at)")
+        # Attachments by content hash, a cover sent to a thousand subscribers is stored once
+        self.connection.execute("CREATE TABLE IF NOT EXISTS outbox_files "
+                                "(hash TEXT PRIMARY KEY, data BLOB NOT NULL, used_at REAL NOT NULL)")
+        self._lock = threading.Lock()
+
+    def enqueue(self, batch: str, deliveries):
+        # deliveries are (target kind "user" or "channel", target id, guild id or None, MessageBundle).
+        # A recipient already queued in this batch is skipped, so re-running a job only fills the gaps.
+        # Returns the number of deliveries added
+        now = time.time()
+        added = 0
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # A bundle sent to many targets is serialized once, its attachments stored once by hash
+                serialized = {}
+                for target_kind, target_id, guild_id, bundle in deliveries:
+                    if id(bundle) not in serialized:
+                        serialized[id(bundle)] = json.dumps(
+                            bundle.to_dict(store_file=lambda data: self._store_file(data, now)))
+                    cursor = self.connection.execute(
+                        "INSERT OR IGNORE INTO outbox (batch, target_kind, target_id, guild_id, messages, "
+                        "next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (batch, target_kind, int(target_id), guild_id, serialized[id(bundle)], now, now, now))
+                    added += cursor.rowcount
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return added
+
+    def _store_file(self, data: bytes, now: float):
+        file_hash = hashlib.sha1(data).hexdigest()
+        self.connection.execute("INSERT INTO outbox_files (hash, data, used_at) VALUES (?, ?, ?) "
+                                "ON CONFLICT (hash) DO UPDATE SET used_at = excluded.used_at",
+                                (file_hash, data, now))
+        return file_hash
+
+    def claim(self, owner: str, limit: int = outbox_claim_size, can_send=None):
+        # Take the deliveries that are due (or whose sender died) for owner, oldest first.
+        # can_send(target_kind, guild_id) filters out deliveries another shard should make
+        now = time.time()
+        claimed = []
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT id, batch, target_kind, target_id, guild_id, messages, sent_count, attempts FROM outbox "
+                "WHERE (state = 'pending' AND next_attempt_at <= ?) OR (state = 'sending' AND claimed_at < ?) "
+                "ORDER BY id LIMIT ?", (now, now - claim_lease_seconds, limit * 5)).fetchall()
+            for delivery_id, batch, target_kind, target_id, guild_id, messages, sent_count, attempts in rows:
+                if len(claimed) >= limit:
+                    break
+                if can_send and not can_send(target_kind, guild_id):
+                    continue
+                # Another sender sharing the file may have taken it since we looked
+                cursor = self.connection.execute(
+                    "UPDATE outbox SET state = 'sending', claimed_by = ?, claimed_at = ?, updated_at = ? "
+                    "WHERE id = ? AND (state = 'pending' OR (state = 'sending' AND claimed_at < ?))",
+                    (owner, now, now, delivery_id, now - claim_lease_seconds))
+                if cursor.rowcount:
+                    bundle = MessageBundle.from_dict(json.loads(messages), load_file=self._load_file)
+                    claimed.append({'id': delivery_id, 'batch': batch, 'target_kind': target_kind,
+                                    'target_id': target_id, 'guild_id': guild_id, 'bundle': bundle,
+                                    'sent_count': sent_count, 'attempts': attempts})
+        return claimed
+
+    def _load_file(self, file_hash: str):
+        # Caller holds the lock
+        row = self.connection.execute("SELECT data FROM outbox_files WHERE hash = ?", (file_hash,)).fetchone()
+        return row[0] if row else None
+
+    def progress(self, delivery_id: int, sent_count: int):
+        # Called after every message, so a restart resumes after the last one that went out
+        with self._lock:
+            self.connection.execute("UPDATE outbox SET sent_count = ?, claimed_at = ?, updated_at = ? WHERE id = ?",
+                                    (sent_count, time.time(), time.time(), delivery_id))
+
+    def complete(self, delivery_id: int):
+        self._finish(delivery_id, 'sent', None)
+
+    def fail(self, delivery_id: int, error: str):
+        self._finish(delivery_id, 'failed', error)
+
+    def _finish(self, delivery_id: int, state: str, error):
+        with self._lock:
+            self.connection.execute("UPDATE outbox SET state = ?, last_error = ?, claimed_by = NULL, updated_at = ? "
+                                    "WHERE id = ?", (state, error, time.time(), delivery_id))
+
+    def retry(self, delivery_id: int, attempts: int, error: str):
+        # Back off exponentially, giving up after max_attempts. Returns False once it gave up
+        if attempts >= max_attempts:
+            self.fail(delivery_id, error)
+            return False
+        delay = min(retry_base_seconds * 2 ** (attempts - 1), retry_max_seconds)
+        with self._lock:
+            self.connection.execute("UPDATE outbox SET state = 'pending', attempts = ?, next_attempt_at = ?, "
+                                    "last_error = ?, claimed_by = NULL, updated_at = ? WHERE id = ?",
+                                    (attempts, time.time() + delay, error, time.time(), delivery_id))
+        return True
+
+    def release(self, owner: str):
+        # Hand our claimed deliveries back on shutdown, so the next start doesn't wait out the lease
+        with self._lock:
+            self.connection.execute("UPDATE outbox SET state = 'pending', claimed_by = NULL WHERE state = 'sending' "
+                                    "AND claimed_by = ?", (owner,))
+
+    def sweep(self):
+        cutoff = time.time() - keep_finished_seconds
+        with self._lock:
+            self.connection.execute("DELETE FROM outbox WHERE state IN ('sent', 'failed') AND updated_at < ?",
+                                    (cutoff,))
+            self.connection.execute("DELETE FROM outbox_files WHERE used_at < ?", (cutoff,))
+
+    def results(self, batch: str):
+        # Per target results of a batch: (target kind, target id) -> (state, last error)
+        with self._lock:
+            rows = self.connection.execute("SELECT target_kind, target_id, state, last_error FROM outbox "
+                                           "WHERE batch = ?", (batch,)).fetchall()
+        return {(target_kind, target_id): (state, error) for target_kind, target_id, state, error in rows}
+
+    def counts(self):
+        # Deliveries by state, for the logs
+        with self._lock:
+            return dict(self.connection.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall())
+
+
+class OutboxSender:
+    def __init__(self, bot, outbox: Outbox):
+        self.bot = bot
+        self.outbox = outbox
+        # Identifies this process's claims
+        self.owner = uuid.uuid4().hex
+        self._wake = asyncio.Event()
+
+    async def queue(self, batch: str, deliveries):
+        # Store the deliveries and get the sender going on them, returns the number added
+        added = await asyncio.to_thread(self.outbox.enqueue, batch, deliveries)
+        logger.info(f"Queued {added} deliveries for '{batch}'.")
+        self._wake.set()
+        return added
+
+    def can_send(self, target_kind: str, guild_id):
+        # DMs can go out from any shard, channel messages from the shard connected to the guild
+        return target_kind == "user" or guild_id is None or self.bot.owns_guild(guild_id)
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        await asyncio.to_thread(self.outbox.sweep)
+        logger.info(f"Outbox sender started, deliveries by state: {await asyncio.to_thread(self.outbox.counts)}")
+        while not self.bot.is_closed():
+            self._wake.clear()
+            deliveries = await asyncio.to_thread(self.outbox.claim, self.owner, outbox_claim_size, self.can_send)
+            await self.broadcast([delivery for delivery in deliveries if delivery['target_kind'] == "channel"])
+            for delivery in deliveries:
+                if delivery['target_kind'] == "user":
+                    await self.deliver(delivery)
+                    await asyncio.sleep(outbox_send_interval)
+            if not deliveries:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), outbox_poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def broadcast(self, deliveries):
+        # Channel deliveries go out side by side, every channel has its own rate limit. The first one of each
+        # batch goes alone, so its attachments are uploaded once and the rest link to them
+        batches = {}
+        for delivery in deliveries:
+            batches.setdefault(delivery['batch'], []).append(delivery)
+        for batch, batch_deliveries in batches.items():
+            await self.deliver(batch_deliveries[0])
+            await asyncio.gather(*(self.deliver(delivery) for delivery in batch_deliveries[1:]))
+            results = await asyncio.to_thread(self.outbox.results, batch)
+            states = [state for (target_kind, _), (state, _) in results.items() if target_kind == "channel"]
+            sent, failed = states.count('sent'), states.count('failed')
+            logger.info(f"Broadcast '{batch}': {sent} of {len(states)} channels delivered, {failed} failed, "
+                        f"{len(states) - sent - failed} pending.")
+
+    async def destination(self, delivery):
+        if delivery['target_kind'] == "user":
+            return await self.bot.fetch_user(delivery['target_id'])
+        return self.bot.get_channel(delivery['target_id']) or await self.bot.fetch_channel(delivery['target_id'])
+
+    async def deliver(self, delivery):
+        delivery_id = delivery['id']
+        target = f"{delivery['target_kind']} {delivery['target_id']}"
+        try:
+            destination = await self.destination(delivery)
+            bundle = delivery['bundle']
+            for index in range(delivery['sent_count'], len(bundle)):
+                await self.send(destination, bundle[index])
+                await asyncio.to_thread(self.outbox.progress, delivery_id, index + 1)
+            await asyncio.to_thread(self.outbox.complete, delivery_id)
+            logger.info(f"Delivered {len(bundle)} messages to {target}.")
+        except (discord.Forbidden, discord.NotFound) as e:
+            # DMs closed, user or channel gone: retrying won't help
+            await asyncio.to_thread(self.outbox.fail, delivery_id, str(e))
+            logger.error(f"Giving up on delivery to {target}: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempts = delivery['attempts'] + 1
+            if await asyncio.to_thread(self.outbox.retry, delivery_id, attempts, str(e)):
+                logger.warning(f"Delivery to {target} failed (attempt {attempts}), retrying later: {e}")
+            else:
+                logger.error(f"Giving up on delivery to {target} after {attempts} attempts: {e}")
+
+    async def send(self, destination, message):
+        # Channel broadcasts go ahead of DM fan-out, both give way to anyone using the bot
+        priority = priority_bulk if isinstance(destination, discord.abc.User) else priority_broadcast
+        sent = await message.send(destination, priority)
+
+        if message.reaction_map:
+            reaction_map = dict(message.reaction_map)
+            # The message is out, a missing reaction isn't worth sending it again
+            try:
+                await shared_send_scheduler().add_reactions(priority, sent, reaction_map)
+            except discord.HTTPException as e:
+                logger.error(f"Failed to add reactions to message {sent.id}: {e}")
+            # Store the mapping of emojis to the message ID for tracking
+            self.bot.reaction_messages[sent.id] = reaction_map
+        return sent
+
+    def close(self):
+        self.outbox.release(self.owner)
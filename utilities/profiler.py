@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Seconds between samples (100 a second), far enough apart that the sampler doesn't slow the bot down
+sample_interval = 0.01
+# Longest a profile may run, however it was started
+max_profile_seconds = 300
+# Frames (file name, function) a thread sits in while it has nothing to do, samples ending there are left out
+idle_frames = {
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('connection.py', '_poll'),
+}
+# Where the time usually goes on slow commands, called out in the summary
+focus_paths = ('kavita_query', 'series_embed', 'message_templates', 'stats_snapshot', 'image_pipeline')
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def frame_label(code):
+    # "utilities/series_embed.py:build_series_embed", paths outside the bot are shortened to the file name
+    path = code.co_filename
+    if path.startswith(project_root):
+        path = os.path.relpath(path, project_root)
+    else:
+        path = os.path.basename(path)
+    return f"{path}:{code.co_name}"
+
+
+def collapse_stack(frame, thread_name: str):
+    # Root first, semicolon separated, the format flamegraph.pl and speedscope read
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ';'.join(reversed(labels))
+
+
+def is_idle(frame):
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in idle_frames
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = sample_interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name='bnu-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.stopped_at = time.time()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + max_profile_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or is_idle(frame):
+                    continue
+                self.stacks[collapse_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        # One "stack count" line per distinct stack, heaviest first
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+    def summary(self, top: int = 8):
+        # Busiest frames in the bot's Kavita, embed and template code, by samples they were on the stack for
+        duration = (self.stopped_at or time.time()) - self.started_at
+        on_stack = Counter()
+        for stack, count in self.stacks.items():
+            for label in set(stack.split(';')):
+                if any(path in label for path in focus_paths):
+                    on_stack[label] += count
+        lines = [f"{self.samples} samples over {duration:.1f}s, {sum(self.stacks.values())} busy thread samples."]
+        lines += [f"`{label}` {count}" for label, count in on_stack.most_common(top)]
+        return '\n'.join(lines)
+
+
+class ProfileSession:
+    # A profile started by /debug-profile: runs for a number of seconds, or until a command has completed
+    # a number of times. done is set once it has stopped
+    def __init__(self, requested_by, seconds: int = None, command_name: str = None, invocations: int = None):
+        self.requested_by = requested_by
+        self.seconds = min(seconds or max_profile_seconds, max_profile_seconds)
+        self.command_name = command_name
+        self.remaining = invocations
+        self.profiler = SamplingProfiler()
+        self.done = threading.Event()
+
+    def describe(self):
+        if self.command_name:
+            return f"the next {self.remaining} `/{self.command_name}` calls"
+        return f"{self.seconds}s"
+
+    def start(self):
+        if self.profiler.started_at is None:
+            self.profiler.start()
+
+    def command_started(self, command_name: str):
+        # Profiles waiting on a command only start sampling when it is first used
+        if command_name == self.command_name:
+            self.start()
+
+    def command_completed(self, command_name: str):
+        if command_name != self.command_name or not self.profiler.running():
+            return
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.finish()
+
+    def finish(self):
+        # Returns whether anything was sampled
+        if not self.done.is_set():
+            self.profiler.stop()
+            self.done.set()
+        return self.profiler.started_at is not None
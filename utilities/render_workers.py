@@ -0,0 +1,208 @@
+import os
+import asyncio
+import threading
+from functools import partial
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import utilities.logging_config as logging_config
+from utilities.image_pipeline import reset_shared_cover_pipeline
+from utilities.series_embed import embed_payload
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Number of worker processes for Kavita fetching and embed rendering. With 0 the work runs on threads in the
+# gateway process instead, the results are the same serialized embed payloads either way
+render_worker_count = int(os.environ.get('BNU_RENDER_WORKERS', '0') or 0)
+# Cache invalidations kept for the workers to catch up on, a worker further behind than this drops all its caches
+invalidation_log_size = 256
+
+# Kavita clients of a worker process, by server name, and the last invalidation the worker has applied
+_worker_queries = {}
+_applied_invalidation = 0
+
+
+def _init_worker(server_configs):
+    # Runs once in every worker process: log in to each Kavita server
+    from api.kavita_query.kavitaqueries import KavitaQueries
+    from kavita_api import reset_shared_http_session
+    # Covers are transcoded in the worker itself, it is already off the gateway process
+    reset_shared_cover_pipeline(workers=0)
+    reset_shared_http_session()
+    for name, (server_url, server_address) in server_configs.items():
+        queries = KavitaQueries(server_url=server_url, server_address=server_address)
+        if not queries.authenticate():
+            logger.error(f"Render worker {os.getpid()} failed to authenticate with Kavita server '{name}'.")
+        _worker_queries[name] = queries
+    logger.info(f"Render worker {os.getpid()} ready for {len(_worker_queries)} Kavita servers.")
+
+
+def _ping():
+    return os.getpid()
+
+
+def apply_invalidation(kavita_queries, kind: str, args):
+    # Replay an invalidation the gateway's Kavita clients made on this process's copy of them
+    if kind == "series":
+        kavita_queries.invalidate_series(*args)
+    elif kind == "cover":
+        kavita_queries.invalidate_cover(*args)
+    elif kind == "recently-updated":
+        kavita_queries.chapter_timeline.note_recently_updated(*args)
+
+
+def _apply_invalidations(invalidations):
+    # invalidations is the gateway's recent log of (sequence number, server name, kind, args), oldest first
+    global _applied_invalidation
+    if not invalidations:
+        return
+    if invalidations[0][0] > _applied_invalidation + 1:
+        # Some fell out of the log before this worker saw them, start over rather than serve stale data
+        for queries in _worker_queries.values():
+            queries.forget_local_caches()
+    for sequence, server_name, kind, args in invalidations:
+        if sequence > _applied_invalidation and server_name in _worker_queries:
+            apply_invalidation(_worker_queries[server_name], kind, args)
+    _applied_invalidation = invalidations[-1][0]
+
+
+def render_series(kavita_queries, series_id: int, thumbnail: bool = False, verbose: bool = False):
+    # Series embed payload, or None if Kavita has no data for the series
+    metadata = kavita_queries.get_series_metadata(series_id)
+    series = kavita_queries.get_series_info(series_id=series_id, verbose=verbose)
+    if not (metadata and series):
+        return None
+    return embed_payload(*kavita_queries.embed_builder.build_series_embed(series=series, metadata=metadata,
+                                                                          thumbnail=thumbnail))
+
+
+def render_series_with_chapters(kavita_queries, series_id: int):
+    # Series embed payload plus the payloads of its most recent chapters
+    metadata = kavita_queries.get_series_metadata(series_id)
+    series = kavita_queries.get_series_info(series_id)
+    if not (metadata and series):
+        return None
+    series_payload = embed_payload(*kavita_queries.embed_builder.build_series_embed(series=series,
+                                                                                    metadata=metadata))
+    recent_chapters = kavita_queries.get_recent_chapters(series_id)
+    chapter_embeds = kavita_queries.send_recent_chapters_embed(series=series, recent_chapters=recent_chapters)
+    return series_payload, [embed_payload(embed, file) for embed, file in chapter_embeds or []]
+
+
+def render_series_update(kavita_queries, series_id: int, chapters):
+    # Series embed payload plus payloads for the given (newly added) chapters, for update notifications
+    metadata = kavita_queries.get_series_metadata(series_id)
+    series = kavita_queries.get_series_info(series_id)
+    if not (metadata and series):
+        return None
+    series_payload = embed_payload(*kavita_queries.embed_builder.build_series_embed(series=series,
+                                                                                    metadata=metadata,
+                                                                                    thumbnail=True))
+    chapter_embeds = kavita_queries.send_recent_chapters_embed(series=series, recent_chapters=chapters)
+    return series_payload, [embed_payload(embed, file) for embed, file in chapter_embeds or []]
+
+
+def render_series_list(kavita_queries, series_list, thumbnail: bool = True):
+    # Embed payloads for a list of series entries (e.g. one page of search results), skipping any without metadata
+    metadata_by_id = kavita_queries.get_series_metadata_bulk(series['seriesId'] for series in series_list)
+    payloads = []
+    for series in series_list:
+        metadata = metadata_by_id.get(series['seriesId'])
+        if metadata:
+            payloads.append(embed_payload(*kavita_queries.embed_builder.build_series_embed(series, metadata,
+                                                                                           thumbnail=thumbnail)))
+    return payloads
+
+
+# Render tasks by name, so only the name and arguments cross the process boundary
+render_tasks = {
+    'series': render_series,
+    'series-with-chapters': render_series_with_chapters,
+    'series-update': render_series_update,
+    'series-list': render_series_list
+}
+
+
+def run_render_task(kavita_queries, task: str, args):
+    # Returns the task result and the stale data notice (if any) of the clients that produced it
+    result = render_tasks[task](kavita_queries, *args)
+    return result, kavita_queries.stale_notice()
+
+
+def _run_in_worker(server_name: str, task: str, args, invalidations=()):
+    # Also returns (worker pid, last invalidation applied), so the gateway only sends what's newer next time
+    _apply_invalidations(invalidations)
+    return run_render_task(_worker_queries[server_name], task, args), (os.getpid(), _applied_invalidation)
+
+
+class RenderWorkers:
+    def __init__(self, kavita_servers, workers: int = render_worker_count):
+        self.kavita_servers = kavita_servers
+        self.workers = workers
+        self._executor = None
+        # Every worker holds its own Kavita caches, so the gateway's invalidations are logged and sent along with
+        # each task for the worker that picks it up to apply first
+        self.invalidations = deque(maxlen=invalidation_log_size)
+        self._invalidation_sequence = 0
+        # Worker pid -> the last invalidation it applied, as of its last task
+        self.worker_sequences = OrderedDict()
+        self._invalidation_lock = threading.Lock()
+        if self.enabled:
+            for name, server in kavita_servers.items():
+                server.queries.invalidation_listeners.append(partial(self.note_invalidation, name))
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def note_invalidation(self, server_name: str, kind: str, args):
+        with self._invalidation_lock:
+            self._invalidation_sequence += 1
+            self.invalidations.append((self._invalidation_sequence, server_name, kind, args))
+
+    def _invalidations_to_send(self):
+        # Only what the furthest behind worker we know of hasn't applied yet. Any other worker sees a gap and drops
+        # its caches, the newest entry always goes along so one that's behind can tell
+        with self._invalidation_lock:
+            applied = min(self.worker_sequences.values(), default=0)
+            pending = tuple(entry for entry in self.invalidations if entry[0] > applied)
+            return pending or tuple(self.invalidations)[-1:]
+
+    def _worker_caught_up(self, pid: int, applied: int):
+        with self._invalidation_lock:
+            self.worker_sequences[pid] = applied
+            self.worker_sequences.move_to_end(pid)
+            # A worker that died makes way for its replacement
+            while len(self.worker_sequences) > self.workers:
+                self.worker_sequences.popitem(last=False)
+
+    def start(self):
+        # Start the workers up front, before the bot has threads of its own running
+        if not self.enabled or self._executor:
+            return
+        server_configs = {name: (server.server_url, server.server_address)
+                          for name, server in self.kavita_servers.items()}
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(server_configs,))
+        self._executor.submit(_ping)
+        logger.info(f"Started {self.workers} render worker processes.")
+
+    async def render(self, kavita, task: str, *args):
+        # Run a render task for a KavitaServer, returns (serialized result, stale data notice)
+        if not self.enabled:
+            return await asyncio.to_thread(run_render_task, kavita.queries, task, args)
+        self.start()
+        loop = asyncio.get_running_loop()
+        try:
+            rendered, worker = await loop.run_in_executor(self._executor, _run_in_worker, kavita.name, task, args,
+                                                          self._invalidations_to_send())
+            self._worker_caught_up(*worker)
+            return rendered
+        except Exception as e:
+            logger.error(f"Render worker failed on '{task}', rendering in the gateway process instead: {e}")
+            return await asyncio.to_thread(run_render_task, kavita.queries, task, args)
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,118 @@
+import math
+import asyncio
+import discord
+import utilities.logging_config as logging_config
+from utilities.series_embed import embed_from_payload
+from utilities.attachment_registry import shared_attachment_registry
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Series shown per page, and how long the buttons keep working after the last click
+search_page_size = 3
+search_view_timeout = 300
+
+
+class SearchResultsView(discord.ui.View):
+    def __init__(self, render_workers, kavita, user_id: int, search_query: str, results, federation=None):
+        super().__init__(timeout=search_view_timeout)
+        self.render_workers = render_workers
+        self.kavita = kavita
+        self.user_id = user_id
+        self.search_query = search_query
+        # The raw search results, pages are only rendered when someone looks at them
+        self.results = results
+        # Set for federated searches, whose results each name the Kavita server they came from
+        self.federation = federation
+        self.page = 0
+        self.rendered_pages = {}
+        self.message = None
+
+    @property
+    def page_count(self):
+        return max(1, math.ceil(len(self.results) / search_page_size))
+
+    def _render_task(self, page: int):
+        # Start (or reuse) the render of a page, so a prefetch in flight is awaited instead of repeated
+        if page not in self.rendered_pages:
+            page_results = self.results[page * search_page_size:(page + 1) * search_page_size]
+            self.rendered_pages[page] = asyncio.ensure_future(self._render_results(page_results))
+        return self.rendered_pages[page]
+
+    async def _render_results(self, page_results):
+        if not self.federation:
+            return await self.render_workers.render(self.kavita, 'series-list', page_results)
+        # Each result is rendered by its own server, side by side, and kept in rank order
+        rendered = await asyncio.gather(*(
+            self.render_workers.render(self.federation.server(series['server']), 'series-list', [series])
+            for series in page_results))
+        payloads = [payload for series_payloads, _ in rendered for payload in series_payloads or []]
+        return payloads, next((notice for _, notice in rendered if notice), None)
+
+    async def page_contents(self, page: int):
+        # Returns (embeds, files, stale notice) for a page, and prefetches the one after it
+        try:
+            payloads, notice = await self._render_task(page)
+        except Exception as e:
+            # Let the next view of this page try again
+            self.rendered_pages.pop(page, None)
+            raise e
+        if page + 1 < self.page_count:
+            self._render_task(page + 1)
+
+        embeds, files = [], []
+        for payload in payloads or []:
+            embed, file = embed_from_payload(payload)
+            embeds.append(embed)
+            if file:
+                files.append(file)
+        if embeds:
+            embeds[-1].set_footer(text=f"Page {page + 1}/{self.page_count} - {len(self.results)} results for "
+                                       f"\"{self.search_query}\"")
+        self._update_buttons()
+        return embeds, files, notice
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        # Only the user who searched can flip through the pages
+        if interaction.user.id != self.user_id:
+            await interaction.response.send_message("Run `/manga-search` to browse your own results.", ephemeral=True)
+            return False
+        return True
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        await interaction.response.defer()
+        self.page = page
+        embeds, files, _ = await self.page_contents(page)
+        if not embeds:
+            embeds = [discord.Embed(description="Unable to load this page of results.", color=0x4ac694)]
+        # Covers uploaded by other messages are linked instead of attached again. This message's own uploads are
+        # deleted by the next page turn, so they aren't remembered, and any link to the ones being dropped is forgotten
+        registry = shared_attachment_registry()
+        files, _ = registry.prepare(embeds, files)
+        registry.forget(interaction.message.attachments if interaction.message else None)
+        self.message = await interaction.edit_original_response(embeds=embeds, attachments=files, view=self)
+
+    @discord.ui.button(label="Prev", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, max(self.page - 1, 0))
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, min(self.page + 1, self.page_count - 1))
+
+    async def on_timeout(self):
+        # Grey the buttons out once they stop working, and drop the rendered pages
+        for page_task in self.rendered_pages.values():
+            page_task.cancel()
+        self.rendered_pages.clear()
+        if self.message:
+            self.previous_page.disabled = True
+            self.next_page.disabled = True
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException as e:
+                logger.info(f"Unable to disable search buttons for \"{self.search_query}\": {e}")
@@ -0,0 +1,188 @@
+import time
+import asyncio
+import aiohttp
+import discord
+from contextlib import asynccontextmanager
+import utilities.logging_config as logging_config
+from utilities.admission_control import TokenBucket
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Send priorities, lower goes first: replies to commands, replies to reactions, channel broadcasts, bulk DMs
+priority_interactive = 0
+priority_reaction = 1
+priority_broadcast = 2
+priority_bulk = 3
+
+# Discord allows 50 requests a second per bot, leave some room for the gateway process' other calls
+global_send_rate = 40
+global_send_burst = 40
+# Background sends leave this many requests of a route's bucket for foreground traffic
+background_reserve = 1
+# Longest a background send yields to foreground traffic before going anyway, so it can't starve
+max_yield_seconds = 10
+
+
+def route_key(method: str, path: str):
+    # "POST channels/123/messages" style key for an API path. Only the major parameter (the id right after
+    # channels/guilds/webhooks) is kept, message ids, emojis and tokens are masked like Discord groups its limits
+    parts = path.split('/api/', 1)[-1].split('/')
+    if parts and parts[0].startswith('v') and parts[0][1:].isdigit():
+        parts = parts[1:]
+    for index in range(2, len(parts)):
+        if parts[index].isdigit() or len(parts[index]) > 40 or parts[index - 1] in ('messages', 'reactions'):
+            parts[index] = '{id}'
+    return f"{method.upper()} {'/'.join(parts)}"
+
+
+def message_route(destination):
+    # Route key for sending a message to a channel or user, DM channels are only known once they've been opened
+    if not isinstance(destination, discord.abc.Messageable):
+        return None
+    channel = destination.dm_channel if isinstance(destination, discord.abc.User) else destination
+    return route_key("POST", f"channels/{channel.id}/messages") if channel else None
+
+
+def reaction_route(message):
+    return route_key("PUT", f"channels/{message.channel.id}/messages/{message.id}/reactions/emoji/@me")
+
+
+def is_interactive(route: str):
+    # Interaction responses and followups (the interaction webhook)
+    path = route.split(' ', 1)[-1]
+    return path.startswith('interactions/') or path.startswith('webhooks/')
+
+
+class RouteState:
+    def __init__(self):
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, headers, status: int):
+        now = time.monotonic()
+        if status == 429:
+            # Rate limited after all, nothing left until Discord says so
+            self.remaining = 0
+            self.reset_at = now + float(headers.get('Retry-After', 1))
+            return
+        if 'X-RateLimit-Remaining' in headers:
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            self.reset_at = now + float(headers.get('X-RateLimit-Reset-After', 0))
+
+    def delay(self, reserve: int = 0):
+        # Seconds to wait before this route can take another request without running dry
+        now = time.monotonic()
+        if self.remaining is None or now >= self.reset_at or self.remaining > reserve:
+            return 0.0
+        return self.reset_at - now
+
+
+class SendScheduler:
+    def __init__(self):
+        # Sends waiting for or holding a turn, per priority
+        self.pending = [0, 0, 0, 0]
+        # Interaction requests on the wire right now, seen through the HTTP trace
+        self.interactive_in_flight = 0
+        # Route key -> RouteState, learned from Discord's rate limit headers
+        self.routes = {}
+        self.global_bucket = TokenBucket(global_send_rate, global_send_burst)
+        self.rate_limited = 0
+        self._changed = asyncio.Condition()
+
+    def trace_config(self):
+        # Handed to the discord client (http_trace) so we see every request it makes and its rate limit headers
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_request_end.append(self._on_request_end)
+        trace.on_request_exception.append(self._on_request_exception)
+        return trace
+
+    async def _on_request_start(self, session, context, params):
+        context.route = route_key(params.method, params.url.path)
+        context.interactive = is_interactive(context.route)
+        if context.interactive:
+            self.interactive_in_flight += 1
+
+    async def _on_request_end(self, session, context, params):
+        response = params.response
+        self.routes.setdefault(context.route, RouteState()).update(response.headers, response.status)
+        if response.status == 429:
+            self.rate_limited += 1
+            logger.warning(f"Rate limited on {context.route}, background sends will hold off until it resets.")
+        await self._request_done(context)
+
+    async def _on_request_exception(self, session, context, params):
+        await self._request_done(context)
+
+    async def _request_done(self, context):
+        if getattr(context, 'interactive', False):
+            self.interactive_in_flight -= 1
+            await self._notify()
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _busier_than(self, priority: int):
+        # Whether traffic that should go before this priority is waiting or on the wire
+        if any(self.pending[:priority]):
+            return True
+        return priority >= priority_broadcast and self.interactive_in_flight > 0
+
+    def _delay(self, priority: int, route: str = None):
+        delay = 0.0
+        if route and route in self.routes:
+            delay = self.routes[route].delay(background_reserve if priority >= priority_broadcast else 0)
+        if delay:
+            return delay
+        return self.global_bucket.try_consume()
+
+    @asynccontextmanager
+    async def turn(self, priority: int, route: str = None):
+        # Hold this around a send: waits for higher priority traffic to clear and for the route to have room
+        self.pending[priority] += 1
+        try:
+            deadline = time.monotonic() + max_yield_seconds
+            while True:
+                if self._busier_than(priority) and time.monotonic() < deadline:
+                    async with self._changed:
+                        try:
+                            await asyncio.wait_for(self._changed.wait(), deadline - time.monotonic())
+                        except asyncio.TimeoutError:
+                            pass
+                    continue
+                delay = self._delay(priority, route)
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+            if route in self.routes and self.routes[route].remaining:
+                # Count this send against the route until Discord's headers tell us where it really stands
+                self.routes[route].remaining -= 1
+            yield
+        finally:
+            self.pending[priority] -= 1
+            await self._notify()
+
+    async def send(self, priority: int, destination, *args, **kwargs):
+        # destination.send(*args, **kwargs) in its turn
+        async with self.turn(priority, message_route(destination)):
+            return await destination.send(*args, **kwargs)
+
+    async def add_reactions(self, priority: int, message, emojis, pause: float = 0.15):
+        # Seed a message with reactions, each in its turn
+        for emoji_symbol in emojis:
+            await asyncio.sleep(pause)
+            async with self.turn(priority, reaction_route(message)):
+                await message.add_reaction(emoji_symbol)
+
+
+# Shared by everything that sends, so all outbound traffic is ordered together
+_shared_scheduler = None
+
+
+def shared_send_scheduler():
+    global _shared_scheduler
+    if _shared_scheduler is None:
+        _shared_scheduler = SendScheduler()
+    return _shared_scheduler
@@ -1,20 +1,43 @@
-import os
 import re
 import discord
 from io import BytesIO
 from datetime import datetime
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import utilities.logging_config as logging_config
+from utilities.image_pipeline import shared_cover_pipeline, mosaic_max_tiles
+from utilities.attachment_registry import asset_file
 
 # Setup logging
 logger = logging_config.setup_logging()
 
 
+def embed_payload(embed, file=None):
+    # Flatten an embed and its attachment into plain data that can be pickled, cached or sent to another process
+    cover = None
+    if file:
+        cover = (file.filename, file.fp.read())
+        file.fp.close()
+    return embed.to_dict(), cover
+
+
+def embed_from_payload(payload):
+    # Rebuild a fresh embed and file, discord objects can't be reused across sends
+    embed_data, cover = payload
+    file = None
+    if cover:
+        filename, cover_data = cover
+        file = discord.File(BytesIO(cover_data), filename=filename)
+    return discord.Embed.from_dict(embed_data), file
+
+
 class EmbedBuilder:
-    def __init__(self, server_address, kavita_queries):
+    def __init__(self, server_address, kavita_queries, cover_pipeline=None):
         self.server_address = server_address
         self.kavita_queries = kavita_queries
-        self.cover_image_file = None
+        # Downscaled cover variants, shared between builders unless one is given
+        self.cover_pipeline = cover_pipeline or shared_cover_pipeline()
+        # Threads for fetching chapter summaries and covers side by side
+        self.fetch_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='embed-fetch')
 
     def build_series_url(self, series_id, series_library):
         return f"{self.server_address}/library/{series_library}/series/{series_id}"
@@ -23,19 +46,18 @@ class EmbedBuilder:
         return (f"\n\n**Author**:\n- {metadata['writers'][0]['name']}"
                 f"\n**Summary**:\n{metadata['summary']}\n[**Read here**]({series_url})")
 
-    def build_series_embed(self, series, metadata, thumbnail: bool = False):
+    @staticmethod
+    def series_fields(series):
+        # Pull the id, name and library out of the different series shapes Kavita returns
         if 'value' in series:
-            series_id = series['value']['id']
-            series_name = series['value']['name']
-            series_library = series['value']['libraryId']
+            return series['value']['id'], series['value']['name'], series['value']['libraryId']
         elif 'id' in series:
-            series_id = series['id']
-            series_name = series['name']
-            series_library = series['libraryId']
+            return series['id'], series['name'], series['libraryId']
         else:
-            series_id = series['seriesId']
-            series_name = series['name']
-            series_library = series['libraryId']
+            return series['seriesId'], series['name'], series['libraryId']
+
+    def build_series_embed(self, series, metadata, thumbnail: bool = False):
+        series_id, series_name, series_library = self.series_fields(series)
         series_url = self.build_series_url(series_id, series_library)
 
         description = self.build_description(metadata, series_url)
@@ -46,119 +68,179 @@ class EmbedBuilder:
             color=0x4ac694  # Kavita favicon color
         )
 
-        series_cover_path = self.kavita_queries.get_series_cover(series_id)
-        if series_cover_path:
-            # Use the temporary file directly
-            file_to_send = discord.File(series_cover_path, filename=f"series_cover_{series_id}.jpg")
-            image_url = f"attachment://series_cover_{series_id}.jpg"
-            # Set the image as a thumbnail if thumbnail version is requested, else use static image
-            embed.set_thumbnail(url=image_url) if thumbnail else embed.set_image(url=image_url)
+        series_cover = self.kavita_queries.get_series_cover(series_id)
+        if series_cover:
+            file_to_send = self.attach_cover(embed, "series", series_id, series_cover, thumbnail)
 
             # Return the embed and the file
             return embed, file_to_send
         else:
             return embed, None
 
+    def attach_cover(self, embed, kind, item_id, cover_data, thumbnail: bool = False):
+        return self._attach_variant(embed, kind, item_id, self._cover_variant(kind, item_id, cover_data, thumbnail),
+                                    thumbnail)
+
+    def _cover_variant(self, kind, item_id, cover_data, thumbnail: bool = False):
+        # Pick the cover variant that matches how Discord will display it
+        return self.cover_pipeline.variant(kind, item_id, cover_data, "thumbnail" if thumbnail else "full")
+
+    def _chapter_cover_variant(self, chapter_id, thumbnail: bool = False):
+        chapter_cover = self.kavita_queries.get_chapter_cover(chapter_id)
+        return self._cover_variant("chapter", chapter_id, chapter_cover, thumbnail) if chapter_cover else None
+
+    def _attach_variant(self, embed, kind, item_id, variant, thumbnail: bool = False):
+        variant_data, extension = variant
+        filename = f"{kind}_cover_{item_id}.{extension}"
+        image_url = f"attachment://{filename}"
+        # Set the image as a thumbnail if thumbnail version is requested, else use static image
+        embed.set_thumbnail(url=image_url) if thumbnail else embed.set_image(url=image_url)
+        return discord.File(BytesIO(variant_data), filename=filename)
+
+    def series_thumbnail(self, series_id):
+        series_cover = self.kavita_queries.get_series_cover(series_id)
+        return self._cover_variant("series", series_id, series_cover, thumbnail=True)[0] if series_cover else None
+
+    def build_mosaic(self, series_ids, fetch_thumbnail=None):
+        # One grid image of the series' thumbnail covers, rendered once per ordered id list. Returns bytes or None.
+        # fetch_thumbnail(series id) gets each cover, this server's series_thumbnail unless given
+        series_ids = list(series_ids)[:mosaic_max_tiles]
+        if not series_ids:
+            return None
+        cached = self.cover_pipeline.cached_mosaic(series_ids)
+        if cached:
+            return cached
+        thumbnails = list(self.fetch_pool.map(fetch_thumbnail or self.series_thumbnail, series_ids))
+        if not any(thumbnails):
+            return None
+        return self.cover_pipeline.mosaic(series_ids, thumbnails)
+
+    def build_recently_updated_embed(self, emoji_manga_list, series_ids_by_name, fetch_thumbnail=None):
+        # The recently updated listing, with a mosaic of the listed covers in emoji order
+        embed = discord.Embed(
+            title="Recently Updated Series",
+            description="React to see series update info:\n\n" + "\n".join(
+                f"{emoji_symbol}: {manga}" for emoji_symbol, manga in emoji_manga_list.items()
+            ),
+            color=0x4ac694  # You can change the color to match your theme
+        )
+        # The server icon, uploaded once and linked after that
+        files = [asset_file('assets/images/server_icon.png', filename='thumbnail.jpg')]
+        embed.set_thumbnail(url="attachment://thumbnail.jpg")
+
+        series_ids = [series_ids_by_name[manga] for manga in emoji_manga_list.values() if manga in series_ids_by_name]
+        mosaic = self.build_mosaic(series_ids, fetch_thumbnail)
+        if mosaic:
+            files.append(discord.File(BytesIO(mosaic), filename='recently_updated.jpg'))
+            embed.set_image(url="attachment://recently_updated.jpg")
+        embed.set_footer(text=f"\nUse the emoji reacts below to get more info for the selected series:")
+        return embed, files
+
     def build_chapter_embed(self, series_name, chapter_info, thumbnail: bool = False):
         series = self.kavita_queries.search_server(series_name)
-        if series:
-            series_id = series['series'][0]['seriesId']
-            series_library = series['series'][0]['libraryId']
+        if series and series.get('series'):
+            series_context = {
+                'id': series['series'][0]['seriesId'],
+                'name': series_name,
+                'libraryId': series['series'][0]['libraryId']
+            }
+            chapter_embeds = self.build_chapter_embeds(series_context, [chapter_info], thumbnail=thumbnail)
+            return chapter_embeds[0] if chapter_embeds else None
+        else:
+            return None
 
-            chapter_id = chapter_info['id']
-            chapter_title = chapter_info['title']
+    def build_chapter_embeds(self, series, chapters, thumbnail: bool = False):
+        # Render embeds for several chapters of one series. The series URL is resolved once and every chapter
+        # summary and cover is fetched in a single concurrent wave instead of one after another
+        series_id, series_name, series_library = self.series_fields(series)
+        series_url = self.build_series_url(series_id, series_library)
+        chapters = [chapter_info for chapter_info in chapters if 'id' in chapter_info]
+
+        summaries = [self.fetch_pool.submit(self.kavita_queries.get_chapter_metadata, chapter_info['id'])
+                     for chapter_info in chapters]
+        covers = [self.fetch_pool.submit(self._chapter_cover_variant, chapter_info['id'], thumbnail)
+                  for chapter_info in chapters]
+
+        chapter_embeds = []
+        for chapter_info, summary, cover in zip(chapters, summaries, covers):
+            embed = self.render_chapter_embed(series_name, series_url, chapter_info, summary.result())
+            cover_variant = cover.result()
+            if cover_variant:
+                file_to_send = self._attach_variant(embed, "chapter", chapter_info['id'], cover_variant, thumbnail)
+                chapter_embeds.append((embed, file_to_send))
+            else:
+                chapter_embeds.append((embed, None))
+        return chapter_embeds
 
-            series_url = self.build_series_url(series_id, series_library)
-            chapter_url = f"{series_url}/chapter/{chapter_id}"
-            chapter_summary = self.kavita_queries.get_chapter_metadata(chapter_id)
+    def render_chapter_embed(self, series_name, series_url, chapter_info, chapter_summary):
+        chapter_id = chapter_info['id']
+        chapter_title = chapter_info['title']
+        chapter_url = f"{series_url}/chapter/{chapter_id}"
 
-            # Build a list of pertinent info about the chapter
-            chapter_info_lines = []
+        # Build a list of pertinent info about the chapter
+        chapter_info_lines = []
 
-            # Check if releaseDate exists and is not the placeholder date
-            if chapter_info.get('releaseDate'):
-                release_date = datetime.fromisoformat(chapter_info['releaseDate'].replace('Z', '+00:00'))
+        # Check if releaseDate exists and is not the placeholder date
+        if chapter_info.get('releaseDate'):
+            release_date = datetime.fromisoformat(chapter_info['releaseDate'].replace('Z', '+00:00'))
 
-                # Only append if the release date is valid
-                if release_date.strftime('%B %d, %Y %H:%M:%S') != 'January 01, 0001 00:00:00':
-                    chapter_info_lines.append(
-                        f"**Original Release Date:** {release_date.strftime('%B %d, %Y %H:%M:%S')}")
+            # Only append if the release date is valid
+            if release_date.strftime('%B %d, %Y %H:%M:%S') != 'January 01, 0001 00:00:00':
+                chapter_info_lines.append(
+                    f"**Original Release Date:** {release_date.strftime('%B %d, %Y %H:%M:%S')}")
 
-            if chapter_info.get('pages'):
-                chapter_info_lines.append(f"**Pages:** {chapter_info['pages']}")
+        if chapter_info.get('pages'):
+            chapter_info_lines.append(f"**Pages:** {chapter_info['pages']}")
 
-            if chapter_info.get('volumeTitle'):
-                chapter_info_lines.append(f"**Volume:** {chapter_info['volumeTitle']}")
+        if chapter_info.get('volumeTitle'):
+            chapter_info_lines.append(f"**Volume:** {chapter_info['volumeTitle']}")
 
-            if chapter_info.get('created'):
-                created_date_str = chapter_info['created']
-                # Remove decimal places if present
-                if '.' in created_date_str:
-                    created_date_str = created_date_str[
-                                       :created_date_str.index('.')]  # Keep only the part before the decimal
+        if chapter_info.get('created'):
+            created_date_str = chapter_info['created']
+            # Remove decimal places if present
+            if '.' in created_date_str:
+                created_date_str = created_date_str[
+                                   :created_date_str.index('.')]  # Keep only the part before the decimal
 
-                # Add timezone info if it ends with 'Z'
-                if created_date_str.endswith('Z'):
-                    created_date_str = created_date_str[:-1] + '+00:00'  # Replace 'Z' with '+00:00'
-                elif created_date_str[-6] == ':':
-                    # Ensure there's a proper timezone if one is indicated
-                    created_date_str = created_date_str[:-6] + '+00:00'
+            # Add timezone info if it ends with 'Z'
+            if created_date_str.endswith('Z'):
+                created_date_str = created_date_str[:-1] + '+00:00'  # Replace 'Z' with '+00:00'
+            elif created_date_str[-6] == ':':
+                # Ensure there's a proper timezone if one is indicated
+                created_date_str = created_date_str[:-6] + '+00:00'
 
-                added = datetime.fromisoformat(created_date_str)
-                chapter_info_lines.append(f"**Added to Server:** {added.strftime('%B %d, %Y %H:%M:%S')}")
+            added = datetime.fromisoformat(created_date_str)
+            chapter_info_lines.append(f"**Added to Server:** {added.strftime('%B %d, %Y %H:%M:%S')}")
 
-            chapter_info_lines.append(f"[**Read here**]({chapter_url})")
+        chapter_info_lines.append(f"[**Read here**]({chapter_url})")
 
-            # Join the chapter info lines into a single string
-            chapter_info_text = "\n".join(chapter_info_lines)
+        # Join the chapter info lines into a single string
+        chapter_info_text = "\n".join(chapter_info_lines)
 
-            if chapter_summary and len(chapter_summary) > 140:
-                chapter_summary = chapter_summary[:140] + '...' # Truncate and add ellipsis
-            description = f"{chapter_summary}\n"
+        if chapter_summary and len(chapter_summary) > 140:
+            chapter_summary = chapter_summary[:140] + '...' # Truncate and add ellipsis
+        description = f"{chapter_summary}\n"
 
-            embed = discord.Embed(
-                title=f"{series_name}",
-                color=0x4ac694  # Kavita favicon color
-            )
+        embed = discord.Embed(
+            title=f"{series_name}",
+            color=0x4ac694  # Kavita favicon color
+        )
 
-            # Customize the chapter name in case there is a legitimate chapter title
-            if chapter_info.get('titleName') and chapter_info['titleName'].replace('.', '') != chapter_title:
-                chapter_title_full = f"{chapter_title} - {chapter_info['titleName']}"
-            else:
-                chapter_title_full = chapter_title
-            # Customize the chapter info for the embed
-            embed.add_field(name="Chapter", value=f"{chapter_title_full}", inline=False)
-            embed.add_field(name="Summary:", value=description, inline=False) if description else None
-            embed.add_field(name="Chapter Info", value=chapter_info_text or "No additional information available.",
-                            inline=False)
-
-            chapter_cover_path = self.kavita_queries.get_chapter_cover(chapter_id)
-            if chapter_cover_path:
-                # Use the temporary file directly
-                file_to_send = discord.File(chapter_cover_path, filename=f"chapter_cover_{chapter_id}.jpg")
-                image_url = f"attachment://chapter_cover_{chapter_id}.jpg"
-                # Set the image as a thumbnail if thumbnail version is requested, else use static image
-                embed.set_thumbnail(url=image_url) if thumbnail else embed.set_image(url=image_url)
-
-                # Return the embed and the file
-                return embed, file_to_send
-            else:
-                return embed, None
+        # Customize the chapter name in case there is a legitimate chapter title
+        if chapter_info.get('titleName') and chapter_info['titleName'].replace('.', '') != chapter_title:
+            chapter_title_full = f"{chapter_title} - {chapter_info['titleName']}"
         else:
-            return None
+            chapter_title_full = chapter_title
+        # Customize the chapter info for the embed
+        embed.add_field(name="Chapter", value=f"{chapter_title_full}", inline=False)
+        embed.add_field(name="Summary:", value=description, inline=False) if description else None
+        embed.add_field(name="Chapter Info", value=chapter_info_text or "No additional information available.",
+                        inline=False)
 
-    def cleanup_temp_cover(self, temp_file_path):
-        # Check to see if there is a temp file and remove it if there is
-        if temp_file_path:
-            try:
-                os.remove(temp_file_path)
-                logger.info(f"Temporary cover file {temp_file_path} deleted successfully.")
-            except OSError as e:
-                logger.error(f"Error deleting temporary cover file: {e}")
+        return embed
 
     def create_server_address_embed(self):
         server_name = "BNU Manga Server"
-        thumb_img_path = 'assets/images/server_icon.png'
 
         embed = discord.Embed(
             title=server_name,
@@ -166,8 +248,8 @@ class EmbedBuilder:
             color=0x4ac694
         )
 
-        # Use discord.File with the file path directly
-        file = discord.File(thumb_img_path, filename='header.jpg')
+        # The server icon, uploaded once and linked after that
+        file = asset_file('assets/images/server_icon.png', filename='header.jpg')
         embed.set_thumbnail(url="attachment://header.jpg")
 
         embed.set_footer(text="--Read responsibly!!--")
@@ -0,0 +1,225 @@
+import time
+import random
+import bisect
+import threading
+from array import array
+from collections import deque
+import utilities.logging_config as logging_config
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+# Kavita filter and sort enums used by the series listing endpoint
+filter_field_libraries = 19
+filter_comparison_equal = 0
+filter_combination_and = 1
+sort_field_created = 2
+
+# Series listing page size, and how often the whole index is rebuilt to drop deleted series
+listing_page_size = 500
+full_refresh_hours = 24
+
+# How many recent picks per channel won't be repeated
+no_repeat_window = 25
+
+
+class LibraryIndex:
+    def __init__(self, library_id: int, name: str):
+        self.library_id = library_id
+        self.name = name
+        # Series ids in a flat int array for O(1) random access, with a reverse map for O(1) removal
+        self.series_ids = array('i')
+        self.positions = {}
+        # Optional popularity weights, kept parallel to series_ids
+        self.weights = array('d')
+        self._cumulative = None
+
+    def __len__(self):
+        return len(self.series_ids)
+
+    def __contains__(self, series_id):
+        return series_id in self.positions
+
+    def add(self, series_id: int, weight: float = 1.0):
+        if series_id in self.positions:
+            return False
+        self.positions[series_id] = len(self.series_ids)
+        self.series_ids.append(series_id)
+        self.weights.append(weight)
+        self._cumulative = None
+        return True
+
+    def remove(self, series_id: int):
+        # Swap the last entry into the removed slot so the arrays stay dense
+        position = self.positions.pop(series_id, None)
+        if position is None:
+            return False
+        last_id = self.series_ids.pop()
+        last_weight = self.weights.pop()
+        if position < len(self.series_ids):
+            self.series_ids[position] = last_id
+            self.weights[position] = last_weight
+            self.positions[last_id] = position
+        self._cumulative = None
+        return True
+
+    def update_weights(self, weights):
+        # Read counts move, every series gets its current weight (the default once it's no longer among the most read)
+        changed = False
+        for position, series_id in enumerate(self.series_ids):
+            weight = weights.get(series_id, 1.0)
+            if self.weights[position] != weight:
+                self.weights[position] = weight
+                changed = True
+        if changed:
+            self._cumulative = None
+
+    def sample(self, weighted: bool = False):
+        if not self.series_ids:
+            return None
+        if not weighted:
+            return self.series_ids[random.randrange(len(self.series_ids))]
+
+        # Weighted picks bisect a cumulative weight table that is rebuilt only after changes
+        if self._cumulative is None:
+            cumulative, total = array('d'), 0.0
+            for weight in self.weights:
+                total += weight
+                cumulative.append(total)
+            self._cumulative = cumulative
+        pick = random.random() * self._cumulative[-1]
+        return self.series_ids[min(bisect.bisect_right(self._cumulative, pick), len(self.series_ids) - 1)]
+
+
+class SeriesIndex:
+    def __init__(self, kavita_queries):
+        self.kavita_queries = kavita_queries
+        self.libraries = {}
+        self.last_full_refresh = 0
+        # Recent picks per channel, as a FIFO plus a set for fast membership checks
+        self.recent_picks = {}
+        self._lock = threading.Lock()
+
+    def library(self, library_name_or_id):
+        # Look a library up by id or (case insensitive) name
+        if isinstance(library_name_or_id, int) or str(library_name_or_id).isdigit():
+            return self.libraries.get(int(library_name_or_id))
+        wanted = str(library_name_or_id).strip().lower()
+        for library in self.libraries.values():
+            if library.name.lower() == wanted:
+                return library
+        return None
+
+    def refresh(self):
+        # Called by the job scheduler, rebuilds everything once a day and only pulls new series otherwise
+        full = time.time() - self.last_full_refresh >= full_refresh_hours * 3600
+        libraries = self.kavita_queries.get_libraries()
+        if libraries is None:
+            logger.warning("Unable to refresh the series index, keeping the previous one.")
+            return False
+
+        weights = self._popularity_weights()
+        for library_info in libraries:
+            library_id = library_info['id']
+            with self._lock:
+                library = self.libraries.get(library_id)
+                incremental = library is not None and not full
+                # Listing Kavita is slow, so it runs on a copy of the known ids and samples carry on meanwhile
+                known = set(library.positions) if incremental else set()
+
+            series_ids = self._pull_series(library_id, known, stop_at_known=incremental)
+            if series_ids is None:
+                logger.warning(f"Unable to list the series in library '{library_info['name']}', "
+                               f"keeping the previous index.")
+                continue
+            if incremental:
+                with self._lock:
+                    library.name = library_info['name']
+                    added = sum(library.add(series_id) for series_id in series_ids)
+                    library.update_weights(weights)
+            else:
+                # A full rebuild fills a new index and swaps it in whole
+                library = LibraryIndex(library_id, library_info['name'])
+                added = sum(library.add(series_id, weights.get(series_id, 1.0)) for series_id in series_ids)
+                with self._lock:
+                    self.libraries[library_id] = library
+            if added:
+                logger.info(f"Series index for library '{library.name}' now has {len(library)} series "
+                            f"({added} added).")
+
+        with self._lock:
+            # Forget libraries that no longer exist
+            for library_id in set(self.libraries) - {library['id'] for library in libraries}:
+                del self.libraries[library_id]
+        if full:
+            self.last_full_refresh = time.time()
+        return True
+
+    def _pull_series(self, library_id, known, stop_at_known):
+        # Page through the library newest first, stopping early once a page only has series we know.
+        # Returns the ids of the series not in known, or None if Kavita couldn't list the library
+        new_ids = []
+        page = 1
+        while True:
+            series_page = self.kavita_queries.get_library_series_page(library_id, page, listing_page_size)
+            if series_page is None:
+                # Don't swap in a half built index
+                return None
+            if not series_page:
+                break
+            page_new = [series['id'] for series in series_page if series['id'] not in known]
+            known.update(page_new)
+            new_ids.extend(page_new)
+            if len(series_page) < listing_page_size or (stop_at_known and not page_new):
+                break
+            page += 1
+        return new_ids
+
+    def _popularity_weights(self):
+        # Boost the most read series by their read counts
+        stats = self.kavita_queries.get_server_stats() or {}
+        weights = {}
+        for entry in stats.get('mostReadSeries', []):
+            series_id = entry.get('value', {}).get('id')
+            if series_id is not None:
+                weights[series_id] = 1.0 + float(entry.get('count', 0))
+        return weights
+
+    def add_series(self, library_id: int, series_id: int):
+        # Keep the index current when we learn about a new series outside of a refresh
+        with self._lock:
+            library = self.libraries.get(library_id)
+            if library:
+                library.add(series_id)
+
+    def remove_series(self, series_id: int):
+        with self._lock:
+            for library in self.libraries.values():
+                library.remove(series_id)
+
+    def sample(self, library_name_or_id, channel_id=None, weighted: bool = False, attempts: int = 8):
+        with self._lock:
+            library = self.library(library_name_or_id)
+            if not library or not len(library):
+                return None
+
+            if channel_id is None:
+                return library.sample(weighted)
+
+            recent_queue, recent_set = self.recent_picks.setdefault(channel_id, (deque(), set()))
+            # Only avoid repeats while there's something else left to pick
+            window = min(no_repeat_window, len(library) - 1)
+            series_id = library.sample(weighted)
+            for _ in range(attempts):
+                if series_id not in recent_set:
+                    break
+                series_id = library.sample(weighted)
+
+            recent_queue.append(series_id)
+            recent_set.add(series_id)
+            while len(recent_queue) > window:
+                expired = recent_queue.popleft()
+                # A repeat forced by a tiny library may still be in the window
+                if expired not in recent_queue:
+                    recent_set.discard(expired)
+            return series_id
@@ -0,0 +1,99 @@
+import time
+import threading
+import utilities.logging_config as logging_config
+from utilities.series_embed import embed_payload, embed_from_payload
+from assets.message_templates.server_status_template import server_status_template, stats_reply_line
+
+# Setup logging
+logger = logging_config.setup_logging()
+
+
+class StatsSnapshot:
+    def __init__(self, kavita_queries):
+        self.kavita_queries = kavita_queries
+        self.embed_builder = kavita_queries.embed_builder
+        # The latest rendered snapshot, swapped in whole so readers never see a half built one
+        self.current = None
+        self.recently_updated_ids = None
+        # Called when the snapshot should be rebuilt ahead of schedule (set by the job scheduler)
+        self.on_invalidate = None
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        # Render the stats messages and embeds, this is slow and should run off the event loop
+        with self._refresh_lock:
+            stats = self.kavita_queries.get_server_stats()
+            if not stats:
+                logger.warning("Unable to refresh the server stats snapshot, keeping the previous one.")
+                return False
+
+            stats_text, most_read = server_status_template(data=stats)
+            daily_text, _ = server_status_template(data=stats, daily_update=True)
+
+            series_embeds = []
+            # (read count, payload) of each most read series, so several servers' lists can be merged
+            most_read_embeds = []
+            metadata_by_id = self.kavita_queries.get_series_metadata_bulk(series['value']['id']
+                                                                          for series in most_read)
+            for series in most_read:
+                metadata = metadata_by_id.get(series['value']['id'])
+                if not metadata:
+                    continue
+                # Keep the cover bytes so every send gets a fresh attachment without another download
+                payload = embed_payload(*self.embed_builder.build_series_embed(series, metadata, thumbnail=True))
+                series_embeds.append(payload)
+                most_read_embeds.append((series.get('count', 0), payload))
+
+            updated_series = self.kavita_queries.get_recently_updated() or []
+            self.recently_updated_ids = self._series_ids(updated_series)
+
+            self.current = {
+                'stats': stats,
+                'most_read': most_read_embeds,
+                'stats_text': stats_text,
+                'daily_text': daily_text,
+                'series_embeds': series_embeds,
+                'recently_updated': [series['seriesName'] for series in updated_series if 'seriesName' in series],
+                'recently_updated_by_name': {series['seriesName']: series.get('seriesId')
+                                             for series in updated_series if 'seriesName' in series},
+                'built_at': time.time()
+            }
+            logger.info(f"Server stats snapshot refreshed with {len(series_embeds)} series embeds.")
+            return True
+
+    def invalidate(self, reason: str = "library changed"):
+        logger.info(f"Server stats snapshot invalidated: {reason}.")
+        if self.on_invalidate:
+            self.on_invalidate()
+
+    @staticmethod
+    def _series_ids(updated_series):
+        return [series.get('seriesId') for series in updated_series]
+
+    def note_recently_updated(self, updated_series):
+        # Rebuild early if a fresh recently updated listing differs from the one in the snapshot
+        if updated_series is None or self.recently_updated_ids is None:
+            return
+        if self._series_ids(updated_series) != self.recently_updated_ids:
+            self.invalidate("recently updated series changed")
+
+    def is_ready(self):
+        return self.current is not None
+
+    def messages(self, interaction=None, daily_update=False):
+        # Build fresh embeds and files from the snapshot, discord objects can't be reused across sends
+        snapshot = self.current
+        if not snapshot:
+            return None, None
+
+        stats_message = stats_reply_line(interaction) + (snapshot['daily_text'] if daily_update
+                                                         else snapshot['stats_text'])
+        embeds = [embed_from_payload(payload) for payload in snapshot['series_embeds']]
+        return stats_message, embeds
+
+    def recently_updated(self):
+        return list(self.current['recently_updated']) if self.current else []
+
+    def recently_updated_by_name(self):
+        # Series name -> id for the recently updated listing, for its cover mosaic
+        return dict(self.current['recently_updated_by_name']) if self.current else {}